@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# -*- coding: UTF-8 -*-
+
+"""
+
+Measures `new_record` throughput of StatsCollector and ShardedStatsCollector
+as the number of recording threads grows.
+
+    python benchmarks/stats_threads.py [--records N] [--threads 1,2,4,8]
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stubby.stats import StatsCollector, ShardedStatsCollector
+from stubby.stats import URLHitCollector, MethodHitCollector, WordHitCollector
+
+
+def build(cls):
+    return cls("stats", URLHitCollector("url-hits"),
+               MethodHitCollector("method-hits"),
+               WordHitCollector("word-hits"))
+
+
+def measure(cls, threads, records):
+    stats = build(cls)
+    urls = ["/api/v1/items/{}?page={}".format(i % 97, i % 7)
+            for i in range(1000)]
+    start = threading.Event()
+
+    def work():
+        new_record = stats.new_record
+        start.wait()
+        for i in range(records):
+            new_record("GET", urls[i % 1000])
+
+    pool = [threading.Thread(target=work) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    t0 = time.time()
+    start.set()
+    for t in pool:
+        t.join()
+    elapsed = time.time() - t0
+    total = stats.get_stats()["method-hits"].get("GET", 0)
+    assert total == threads * records, (total, threads * records)
+    return threads * records / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=50000,
+                        help="Records per thread.")
+    parser.add_argument("--threads", default="1,2,4,8",
+                        help="Comma separated thread counts.")
+    args = parser.parse_args()
+    counts = [int(n) for n in args.threads.split(",")]
+    print("{:>8} {:>16} {:>16}".format("threads", "locked rec/s",
+                                       "sharded rec/s"))
+    for n in counts:
+        locked = measure(StatsCollector, n, args.records)
+        sharded = measure(ShardedStatsCollector, n, args.records)
+        print("{:>8} {:>16,.0f} {:>16,.0f}".format(n, locked, sharded))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+# -*- coding: UTF-8 -*-
+
+"""
+
+Benchmarks the stats collectors, the in-process WSGI request path, and a
+Stubby server over loopback. Results are written as JSON, and compared
+against a baseline when one is given. Benchmarks slower than the baseline
+by more than --threshold are flagged, and make the run exit with 1.
+
+    python benchmarks/suite.py [--parts micro,wsgi,e2e] [--quick]
+        [--output results.json] [--baseline baseline.json]
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import sys
+import json
+import time
+import socket
+import random
+import logging
+import argparse
+import platform
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from six import BytesIO
+from wsgiref.util import setup_testing_defaults
+
+from stubby import replay
+from stubby.app import Application
+from stubby.parser import CLIParser
+from stubby.server import ServerFactory
+from stubby.normalize import URLNormalizer
+from stubby.stats import StatsCollector, ShardedStatsCollector
+from stubby.stats import URLHitCollector, MethodHitCollector
+from stubby.stats import WordHitCollector, TopURLHitCollector
+from stubby.stats import CountMinURLCollector, DistinctCollector
+from stubby.stats import HistogramCollector, RateCollector
+
+
+parts = ("micro", "wsgi", "e2e")
+methods = ("GET", "GET", "GET", "POST", "PUT", "DELETE")
+
+
+def uniform(n, seed=1):
+    rnd = random.Random(seed)
+    return ["/api/v1/items/{}?page={}".format(rnd.randrange(1000),
+                                              rnd.randrange(10))
+            for _ in range(n)]
+
+
+def zipfian(n, seed=1):
+    pick = replay.Zipf(10000, seed=seed)
+    return ["/api{}/detail".format(pick()[1]) for _ in range(n)]
+
+
+def unique(n, seed=1):
+    return ["/api/v1/orders/{}/lines/{}".format(seed * n + i, i % 7)
+            for i in range(n)]
+
+
+distributions = (("uniform", uniform), ("zipf", zipfian),
+                 ("unique", unique))
+
+
+def collectors():
+    """Returns (name, factory) of the collectors to benchmark."""
+    normalizer = URLNormalizer(query="sort")
+
+    def default(cls):
+        return lambda: cls("stats", URLHitCollector("url-hits"),
+                           MethodHitCollector("method-hits"),
+                           WordHitCollector("word-hits"))
+
+    return (
+        ("url-hits", lambda: URLHitCollector("url-hits")),
+        ("url-hits-normalized",
+         lambda: URLHitCollector("url-hits", normalizer)),
+        ("method-hits", lambda: MethodHitCollector("method-hits")),
+        ("word-hits", lambda: WordHitCollector("word-hits")),
+        ("top-url-hits", lambda: TopURLHitCollector("top-url-hits")),
+        ("cms-url-hits", lambda: CountMinURLCollector("cms-url-hits")),
+        ("distinct", lambda: DistinctCollector("distinct")),
+        ("histograms", lambda: HistogramCollector("histograms")),
+        ("rates", lambda: RateCollector("rates")),
+        ("stats", default(StatsCollector)),
+        ("sharded-stats", default(ShardedStatsCollector)),
+    )
+
+
+def best(fn, repeat):
+    """Returns the shortest of `repeat` timed calls of `fn`."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        fn()
+        times.append(time.time() - t0)
+    return min(times)
+
+
+def bench_micro(records, repeat):
+    results = {}
+    for dist, generate in distributions:
+        urls = generate(records)
+        for name, factory in collectors():
+            collector = [None]
+
+            def record():
+                c = collector[0] = factory()
+                new_record = c.new_record
+                for i, url in enumerate(urls):
+                    new_record(methods[i % 6], url, elapsed=0.0005, size=i)
+
+            seconds = best(record, repeat)
+            key = "micro/{}/{}/new_record".format(name, dist)
+            results[key] = {"ops": records / seconds}
+            rounds = 20
+            seconds = best(lambda: [collector[0].get_stats()
+                                    for _ in range(rounds)], repeat)
+            key = "micro/{}/{}/get_stats".format(name, dist)
+            results[key] = {"ops": rounds / seconds}
+    return results
+
+
+class Config(object):
+    """Provides the default command line config, for the application."""
+
+    def __init__(self, args):
+        self._config = CLIParser("st")._parse(args)
+
+    def get_config(self):
+        return self._config
+
+
+def bench_wsgi(records, repeat):
+    cfg = Config(["-x"])
+    stats = StatsCollector("stats", URLHitCollector("url-hits"),
+                           MethodHitCollector("method-hits"),
+                           WordHitCollector("word-hits"))
+    app = Application(cfg, logging.getLogger("bench"), stats,
+                      ServerFactory(cfg))
+    app.register_routes()
+    environs = []
+    for i, url in enumerate(zipfian(min(records, 10000))):
+        path, _, query = url.partition("?")
+        environ = {"REQUEST_METHOD": methods[i % 6], "PATH_INFO": path,
+                   "QUERY_STRING": query, "CONTENT_LENGTH": "0"}
+        setup_testing_defaults(environ)
+        environs.append(environ)
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    def dispatch():
+        for i in range(records):
+            environ = dict(environs[i % len(environs)])
+            environ["wsgi.input"] = BytesIO()
+            for _ in app._wsgi(environ, start_response):
+                pass
+
+    seconds = best(dispatch, repeat)
+    return {"wsgi/stub-route": {"ops": records / seconds}}
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def bench_e2e(records, repeat, backends=("threaded", "asyncio")):
+    results = {}
+    for backend in backends:
+        port = free_port()
+        target = "http://127.0.0.1:{}".format(port)
+        devnull = open(os.devnull, "w")
+        proc = subprocess.Popen(
+            [sys.executable, "st", "-a", "127.0.0.1", "-p", str(port),
+             "-s", backend], cwd=root, stdout=devnull, stderr=devnull)
+        try:
+            for _ in range(100):
+                try:
+                    replay.method_hits(target, 1.0)
+                    break
+                except (IOError, ValueError):
+                    time.sleep(0.1)
+            reports = [replay.run(target, replay.Zipf(1000, seed=1),
+                                  records, connections=8, verify=True)
+                       for _ in range(repeat)]
+        finally:
+            proc.terminate()
+            proc.wait()
+            devnull.close()
+        report = max(reports, key=lambda r: r["throughput"])
+        results["e2e/{}".format(backend)] = {
+            "ops": report["throughput"],
+            "p50-us": report["latency-us"]["p50"],
+            "p99-us": report["latency-us"]["p99"],
+            "verified": all(r["verified"] for r in reports),
+        }
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Flags the benchmarks whose ops fell by more than `threshold`."""
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if not base:
+            continue
+        change = result["ops"] / base["ops"] - 1
+        result["change"] = round(change, 4)
+        if change < -threshold:
+            result["regression"] = True
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--parts", default=",".join(parts),
+                        help="Comma separated parts to run.")
+    parser.add_argument("--records", type=int, default=20000,
+                        help="Records (or requests) per measurement.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Measurements per benchmark. The best counts.")
+    parser.add_argument("--quick", action="store_true", default=False,
+                        help="A short run, for a sanity check.")
+    parser.add_argument("--output", default=None,
+                        help="File to write the results to.")
+    parser.add_argument("--baseline", default=None,
+                        help="Results of an earlier run to compare with.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Slowdown beyond which a change is flagged.")
+    args = parser.parse_args()
+    if args.quick:
+        args.records, args.repeat = 2000, 1
+    selected = args.parts.split(",")
+
+    results = {}
+    if "micro" in selected:
+        results.update(bench_micro(args.records, args.repeat))
+    if "wsgi" in selected:
+        results.update(bench_wsgi(args.records, args.repeat))
+    if "e2e" in selected:
+        results.update(bench_e2e(min(args.records, 5000), args.repeat))
+    for result in results.values():
+        result["ops"] = round(result["ops"], 1)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"],
+                                  args.threshold)
+
+    for key, result in sorted(results.items()):
+        flag = " REGRESSION" if result.get("regression") else ""
+        change = "{:+.1%}".format(result["change"]) \
+            if "change" in result else ""
+        print("{:<52} {:>14,.0f} {:>8}{}".format(key, result["ops"],
+                                                  change, flag))
+    output = {
+        "meta": {"python": platform.python_version(),
+                 "platform": platform.platform(),
+                 "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                 "records": args.records, "repeat": args.repeat},
+        "results": results,
+        "regressions": regressions,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
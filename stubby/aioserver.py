@@ -0,0 +1,378 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""
+
+This module has an asyncio based HTTP/1.1 front end for the application.
+Connections are multiplexed on a single event loop, so idle and persistent
+connections cost only memory. Stubbed requests are served by calling the
+WSGI application inline on the loop, as their handler only records them.
+Delayed responses (see `stubby.server`) wait on the loop as well.
+
+Other requests are served on a thread. Requests with larger (or chunked)
+bodies read the body from the connection as it arrives, so that a body is
+never held in memory as a whole. The control routes (`/_st/*` and
+`/metrics`) may wait on other processes, such as on the workers for their
+stats in cluster mode. Stubbed requests still block the loop while they
+wait on a full queue, as they do if the stats or the journal use the
+`block` policy.
+
+This module requires Python 3.5+ and is only imported when the `asyncio`
+server is selected.
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import io
+import sys
+import asyncio
+import logging
+import bottle
+
+from urllib.parse import unquote
+
+
+log = logging.getLogger(__name__)
+reasons = {400: "Bad Request", 413: "Payload Too Large",
+           431: "Request Header Fields Too Large"}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status):
+        super(HTTPError, self).__init__(status)
+        self.status = status
+
+
+class Body(object):
+    """
+    Reads a request body from a connection, decoding it if it's chunked
+    (when `length` is None). A body longer than `max_body` ends early,
+    and is marked `too_large`.
+    """
+
+    def __init__(self, conn, length, max_body):
+        self._reader = conn._reader
+        self._readline = conn._readline
+        self._left = length
+        self._chunked = length is None
+        self._max_body = max_body
+        self._size = 0
+        self.done = length == 0
+        self.too_large = False
+
+    async def read(self, n):
+        """Returns up to `n` bytes of the body, or b"" at its end."""
+        if self.done:
+            return b""
+        if self._chunked and not self._left:
+            line = await self._readline()
+            try:
+                self._left = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise HTTPError(400)
+            if self._left == 0:
+                # Skip the trailer, up to the blank line which ends it.
+                while (await self._readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                self.done = True
+                return b""
+            if self._size + self._left > self._max_body:
+                self.too_large = self.done = True
+                return b""
+        data = await self._reader.read(min(n, self._left))
+        if not data:
+            raise asyncio.IncompleteReadError(b"", self._left)
+        self._left -= len(data)
+        self._size += len(data)
+        if not self._left:
+            if self._chunked:
+                await self._reader.readexactly(2)
+            else:
+                self.done = True
+        return data
+
+    async def drain(self):
+        """Reads and discards what's left of the body."""
+        while await self.read(65536):
+            pass
+
+
+class BodyInput(io.RawIOBase):
+    """
+    A `wsgi.input` for an application running on a thread, which reads a
+    `Body` on the event loop. The body is terminated: reads return b""
+    at its end.
+    """
+
+    def __init__(self, body, loop):
+        super(BodyInput, self).__init__()
+        self._body = body
+        self._loop = loop
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        data = asyncio.run_coroutine_threadsafe(
+            self._body.read(len(buf)), self._loop).result()
+        buf[:len(data)] = data
+        return len(data)
+
+
+class Connection(object):
+    """Serves the requests arriving on a single client connection."""
+
+    max_header_size = 65536
+    # Bodies up to this size are read before the application is called
+    # on the loop. Larger ones are read by the application, on a thread.
+    inline_body = 65536
+    # Requests for these paths are served on a thread.
+    threaded_paths = ("/_st/", "/metrics")
+
+    def __init__(self, server, reader, writer):
+        self._server = server
+        self._reader = reader
+        self._writer = writer
+        peer = writer.get_extra_info("peername") or ("", 0)
+        self._base = dict(server.base_environ)
+        self._base["REMOTE_ADDR"] = peer[0]
+        self._base["REMOTE_PORT"] = str(peer[1])
+
+    async def serve(self):
+        try:
+            keep_alive = True
+            while keep_alive:
+                keep_alive = await self._serve_one()
+        except HTTPError as e:
+            self._send_error(e.status)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ConnectionError):
+            pass
+        except Exception as e:
+            log.exception(e)
+        finally:
+            self._writer.close()
+
+    async def _readline(self):
+        timeout = self._server.keepalive or None
+        try:
+            return await asyncio.wait_for(self._reader.readline(), timeout)
+        except (asyncio.LimitOverrunError, ValueError):
+            raise HTTPError(431)
+
+    async def _serve_one(self):
+        line = await self._readline()
+        if not line:
+            return False
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(400)
+        headers, size = [], 0
+        while True:
+            line = await self._readline()
+            size += len(line)
+            if size > self.max_header_size:
+                raise HTTPError(431)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, sep, value = line.decode("latin-1").partition(":")
+            if not sep:
+                raise HTTPError(400)
+            headers.append((name.strip(), value.strip()))
+
+        environ = self._environ(method, target, version, headers)
+        te = environ.get("HTTP_TRANSFER_ENCODING", "").lower()
+        if "chunked" in te:
+            length = None
+        else:
+            try:
+                length = int(environ.get("CONTENT_LENGTH") or 0)
+            except ValueError:
+                raise HTTPError(400)
+            if length > self._server.max_body:
+                raise HTTPError(413)
+        body = None
+        if length is not None and length <= self.inline_body:
+            data = await self._reader.readexactly(length) if length else b""
+            environ["wsgi.input"] = io.BytesIO(data)
+        else:
+            body = Body(self, length, self._server.max_body)
+            environ["wsgi.input"] = io.BufferedReader(
+                BodyInput(body, asyncio.get_event_loop()), self.inline_body)
+            environ["wsgi.input_terminated"] = True
+            environ["wsgi.multithread"] = True
+            if length is None:
+                # The body is decoded as it's read.
+                environ.pop("HTTP_TRANSFER_ENCODING", None)
+                environ.pop("CONTENT_LENGTH", None)
+
+        conn = environ.get("HTTP_CONNECTION", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = "close" not in conn
+        else:
+            keep_alive = "keep-alive" in conn
+        if not self._server.keepalive:
+            keep_alive = False
+        return await self._respond(environ, version, keep_alive, body)
+
+    def _environ(self, method, target, version, headers):
+        environ = dict(self._base)
+        path, _, query = target.partition("?")
+        environ["REQUEST_METHOD"] = method
+        environ["PATH_INFO"] = unquote(path, "latin-1")
+        environ["QUERY_STRING"] = query
+        environ["SERVER_PROTOCOL"] = version
+        for name, value in headers:
+            key = name.upper().replace("-", "_")
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[key] = value
+                continue
+            key = "HTTP_" + key
+            if key in environ:
+                value = "{},{}".format(environ[key], value)
+            environ[key] = value
+        return environ
+
+    async def _respond(self, environ, version, keep_alive, body=None):
+        state = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            state["status"] = status
+            state["headers"] = response_headers
+            return self._writer.write
+
+        if body is None and not environ["PATH_INFO"].startswith(
+                self.threaded_paths):
+            result = self._server.app(environ, start_response)
+        else:
+            environ["wsgi.multithread"] = True
+            result = await asyncio.get_event_loop().run_in_executor(
+                None, self._server.app, environ, start_response)
+        if body is not None:
+            # What the application didn't read is discarded, so that the
+            # next request on the connection can be read.
+            await body.drain()
+            if body.too_large:
+                if hasattr(result, "close"):
+                    result.close()
+                raise HTTPError(413)
+        delay = environ.get("stubby.delay")
+        if delay:
+            await asyncio.sleep(delay)
+        if environ.get("stubby.drop"):
+            if hasattr(result, "close"):
+                result.close()
+            self._writer.transport.abort()
+            return False
+        try:
+            names = set(k.lower() for k, _ in state["headers"])
+            chunked = False
+            head = ["{} {}\r\n".format(version, state["status"])]
+            head.extend("{}: {}\r\n".format(k, v)
+                        for k, v in state["headers"])
+            if "content-length" not in names:
+                if version == "HTTP/1.1" and keep_alive:
+                    chunked = True
+                    head.append("Transfer-Encoding: chunked\r\n")
+                else:
+                    keep_alive = False
+            if not keep_alive:
+                head.append("Connection: close\r\n")
+            elif version != "HTTP/1.1":
+                head.append("Connection: keep-alive\r\n")
+            head.append("\r\n")
+            self._writer.write("".join(head).encode("latin-1"))
+            for data in result:
+                if not data:
+                    continue
+                if chunked:
+                    data = b"%x\r\n" % len(data) + data + b"\r\n"
+                self._writer.write(data)
+                await self._writer.drain()
+            if chunked:
+                self._writer.write(b"0\r\n\r\n")
+            await self._writer.drain()
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return keep_alive
+
+    def _send_error(self, status):
+        reason = reasons.get(status, "Error")
+        self._writer.write(
+            "HTTP/1.1 {} {}\r\nContent-Length: 0\r\nConnection: close"
+            "\r\n\r\n".format(status, reason).encode("latin-1"))
+
+
+class AsyncioServer(bottle.ServerAdapter):
+    """Runs the application on an asyncio event loop."""
+
+    def run(self, handler):
+        self.app = handler
+        self.keepalive = self.options.get("keepalive", 15)
+        self.max_body = self.options.get("max_body", 64 * 1024 * 1024)
+        backlog = self.options.get("backlog", 1024)
+        self.base_environ = {
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SCRIPT_NAME": "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": False,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "stubby.defer": True,
+        }
+
+        async def on_connect(reader, writer):
+            await Connection(self, reader, writer).serve()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        sock = self.options.get("sock")
+        if sock is not None:
+            server = asyncio.start_server(
+                on_connect, sock=sock, backlog=backlog,
+                limit=Connection.max_header_size)
+        else:
+            server = asyncio.start_server(
+                on_connect, self.host, self.port, backlog=backlog,
+                limit=Connection.max_header_size)
+        srv = loop.run_until_complete(server)
+        try:
+            loop.run_forever()
+        finally:
+            srv.close()
+            loop.run_until_complete(srv.wait_closed())
+            if hasattr(loop, "shutdown_default_executor"):
+                # Applications still reading a body on a thread need the
+                # loop to run until they're done.
+                loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
@@ -36,16 +36,124 @@ __author__ = "Praveen Shirali <praveengshirali@gmail.com>"
 
 import os
 import sys
+import json
+import base64
+import time
 import logging
 import bottle
+import random
 import signal
-import pprint
 
 from .trace import traceable
+from .server import bind_socket
+from .body import read_body, read_head
+from .metrics import content_type as metrics_content_type
 
 
 log = logging.getLogger(__name__)
+access_log = logging.getLogger("stubby.access")
 all_methods = ("GET", "POST", "PUT", "DELETE", "PATCH")
+timer = getattr(time, "perf_counter", time.time)
+
+
+def iter_json(data, chunk_size=65536):
+    """Encodes data as JSON, yielding chunks of about `chunk_size` bytes."""
+    chunk, size = [], 0
+    for part in json.JSONEncoder().iterencode(data):
+        chunk.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield "".join(chunk).encode("utf-8")
+            chunk, size = [], 0
+    if chunk:
+        yield "".join(chunk).encode("utf-8")
+
+
+def iter_rows(stats, after=None):
+    """
+    Flattens stats into rows, one for each value which isn't a dict, in
+    the order of their keys (compared as strings). The row holds the
+    collector's name and the keys leading to the value. If `after` (the
+    path of a row, as returned by `row_path`) is given, only the rows
+    which sort after it are returned.
+    """
+    stack = [([], stats, after)]
+    while stack:
+        path, value, bound = stack.pop()
+        if not isinstance(value, dict):
+            if bound is None:
+                yield {"collector": path[0], "keys": path[1:],
+                       "value": value}
+            continue
+        if not bound:
+            # Every row under this dict sorts after the row at `after`.
+            bound = None
+        children = []
+        for key, v in sorted(value.items(), key=lambda kv: "{}".format(
+                kv[0])):
+            if bound is None:
+                children.append((path + [key], v, None))
+                continue
+            k = "{}".format(key)
+            if k == bound[0]:
+                children.append((path + [key], v, bound[1:]))
+            elif k > bound[0]:
+                children.append((path + [key], v, None))
+        stack.extend(reversed(children))
+
+
+def row_path(row):
+    """Returns the path of a row: its collector's name and keys."""
+    return [row["collector"]] + ["{}".format(k) for k in row["keys"]]
+
+
+def encode_cursor(path):
+    """Returns the cursor which continues after the row at `path`."""
+    data = json.dumps(path, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Returns the row path held by a cursor from `encode_cursor`. Raises
+    ValueError if it isn't one.
+    """
+    path = json.loads(base64.urlsafe_b64decode(
+        cursor.encode("ascii")).decode("utf-8"))
+    if not isinstance(path, list) or not all(
+            isinstance(k, type("")) for k in path):
+        raise ValueError("Not a cursor: {}".format(cursor))
+    return path
+
+
+def iter_ndjson(stats, cursor=None, limit=None, header=None,
+                chunk_size=65536):
+    """
+    Encodes stats as newline delimited JSON rows, sorted by their keys,
+    starting after the row at the `cursor` path. If `limit` rows are
+    sent and more remain, the last line holds the cursor for the next
+    page. As the cursor holds the last row's keys, rather than a count of
+    rows, pages stay in step when counters are added in between them. A
+    `header`, if given, is sent as the first line.
+    """
+    chunk, size, sent, last = [], 0, 0, None
+    if header is not None:
+        chunk.append(json.dumps(header) + "\n")
+    for row in iter_rows(stats, cursor):
+        if limit is not None and sent >= limit:
+            chunk.append(json.dumps({"cursor": encode_cursor(
+                row_path(last))}) + "\n")
+            break
+        line = json.dumps(row) + "\n"
+        chunk.append(line)
+        size += len(line)
+        sent += 1
+        last = row
+        if size >= chunk_size:
+            yield "".join(chunk).encode("utf-8")
+            chunk, size = [], 0
+    if chunk:
+        yield "".join(chunk).encode("utf-8")
 
 
 class SignalHandler(object):
@@ -69,6 +177,7 @@ class SignalHandler(object):
         log.debug("Invoking handler for signal {}".format(self._sigstr))
         data = self._handler()
         if data:
+            import pprint
             print("- " * 40)
             pprint.pprint(data)
             print("- " * 40)
@@ -83,7 +192,9 @@ class SignalHandler(object):
 class Application(object):
     """This class represents the application with the webserver at its core"""
 
-    def __init__(self, cfg, logger, stats_collector):
+    def __init__(self, cfg, logger, stats_collector, server,
+                 normalizer=None, persister=None, rules=None, metrics=None,
+                 profiler=None, dumper=None):
         """
         Args:
             cfg (stubby.contract.ConfigContract): The config instance
@@ -92,15 +203,40 @@ class Application(object):
             stats_collector (stubby.contract.StatsCollectorContract):
                 The instance of the stats collector which must be used
                 to store request stats.
+            server (stubby.contract.ServerContract): Provides the HTTP
+                server on which the application runs.
+            normalizer (stubby.normalize.URLNormalizer): If given, URLs
+                are turned into templates before any collector sees them.
+                Collectors can also be given a normalizer of their own.
+            persister (stubby.persist.StatsPersister): If given, stats
+                are restored on startup and saved periodically.
+            rules (stubby.rules.ResponseRules): If given, requests which
+                match a rule are answered with the rule's response.
+            metrics (stubby.metrics.MetricsRenderer): If given, stats are
+                exposed to Prometheus on `/metrics`.
+            profiler (stubby.profiler.Profiler): If given, the application
+                can be profiled on demand through `/_st/profile`.
+            dumper (stubby.dumper.StatsDumper): If given, SIGUSR1 dumps
+                the stats to a file in the background, instead of printing
+                them from the signal handler.
         """
         self._config = cfg.get_config()
         self._logger = logger
+        self._stats = stats_collector
         self._get_stats = stats_collector.get_stats
         self._reset_stats = stats_collector.reset_stats
         self._new_record = stats_collector.new_record
+        self._normalize = normalizer.normalize if normalizer else None
         self._srv = bottle.Bottle()
-        self._opts = dict(host=self._config.address,
-                          port=self._config.port,
+        self._server = server
+        self._persister = persister
+        self._rules = rules if rules else None
+        self._metrics = metrics
+        self._profiler = profiler
+        self._dumper = dumper
+        self._access_rate = self._config.access_log
+        self._opts = dict(server=server.get_server(self._config.address,
+                                                   self._config.port),
                           quiet=True)
         self._help_info = {}
 
@@ -118,12 +254,33 @@ class Application(object):
 
     def register_routes(self):
         if self._config.skip_ctrl is False:
-            self._route("/_st/stats", ["GET"], self._get_stats,
-                        desc="Show request statistics collected so far")
+            self._route("/_st/stats", ["GET"], self._show_stats,
+                        desc=("Show request statistics collected so far. "
+                              "Filter with collector=, method=, prefix= "
+                              "and top=. since=<version> returns only the "
+                              "counters changed since that version. "
+                              "format=ndjson streams one row per counter, "
+                              "paged with limit= and cursor=. Other query "
+                              "parameters (such as `url`) are passed on "
+                              "to the collectors."))
+            self._route("/_st/rates", ["GET"], self._show_rates,
+                        desc=("Show 1s, 10s and 60s request rates, and "
+                              "the recent history of request counts"))
             self._route("/_st/reset", ["GET"], self._reset_stats,
                         desc="Reset current stats")
             self._route("/_st/help", ["GET"], self._show_help,
                         desc="Show this help.")
+            if self._profiler is not None:
+                self._route("/_st/profile", ["GET"], self._profile,
+                            desc=("Profile request handling for seconds= "
+                                  "(30) with mode=sample (stack sampling, "
+                                  "saved as collapsed stacks) or "
+                                  "mode=cprofile (saved as pstats). Without "
+                                  "parameters, shows the last profile."))
+            if self._metrics is not None:
+                self._route("/metrics", ["GET"], self._show_metrics,
+                            desc=("Show the request counters and histograms "
+                                  "in the OpenMetrics text format"))
         else:
             log.info("*** Detected option `--skip-ctrl`.")
             log.info("    Skipped registering control routes.")
@@ -132,8 +289,23 @@ class Application(object):
 
     def run(self):
         self.start_up()
-        SignalHandler("SIGUSR1", self._get_stats)
+        # Stop on SIGTERM as on Ctrl+C, so that the stats are saved and
+        # the collectors closed.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        cluster = None
+        if self._config.workers > 1:
+            from .cluster import Cluster
+            cluster = Cluster(self._config.workers, self._stats)
+            self._get_stats = cluster.get_stats
+            self._reset_stats = cluster.reset_stats
+        if self._dumper is not None:
+            self._dumper.start(self._get_stats)
+            SignalHandler("SIGUSR1", self._dumper.request)
+        else:
+            SignalHandler("SIGUSR1", self._get_stats)
         SignalHandler("SIGUSR2", self._reset_stats)
+        if self._profiler is not None and hasattr(signal, "SIGRTMIN"):
+            SignalHandler("SIGRTMIN", self._profile_signal)
         self.register_routes()
         try:
             log.info("Bottle {} web-server listening on http://{}:{}".format(
@@ -141,14 +313,64 @@ class Application(object):
                 self._config.address,
                 self._config.port
             ))
+            log.info("Server backend: {}".format(self._server.name))
             log.info("Press Ctrl+C to stop the server.")
-            self._srv.run(**self._opts)
+            if cluster is None:
+                self._serve()
+            else:
+                self._run_workers(cluster)
         except Exception as e:
             log.exception(e)
         finally:
             print("")
             log.info("Bye.")
 
+    def _run_workers(self, cluster):
+        sock = bind_socket(self._config.address, self._config.port,
+                           self._config.backlog)
+        self._opts["server"] = self._server.get_server(
+            self._config.address, self._config.port, sock=sock)
+        log.info("Forking {} workers".format(self._config.workers))
+        try:
+            cluster.run(self._serve)
+        finally:
+            sock.close()
+
+    def _serve(self, worker=None):
+        if self._persister is not None:
+            self._persister.start(worker)
+        try:
+            bottle.run(self._wsgi, **self._opts)
+        finally:
+            if self._persister is not None:
+                self._persister.stop()
+            self._stats.close()
+
+    def _wsgi(self, environ, start_response):
+        environ["stubby.start"] = timer()
+        if self._access_rate and random.random() < self._access_rate:
+            return self._logged(environ, start_response)
+        if self._profiler is not None and self._profiler.tracing:
+            return self._profiler.call(self._srv, environ, start_response)
+        return self._srv(environ, start_response)
+
+    def _logged(self, environ, start_response):
+        status = []
+
+        def logged_start_response(s, headers, exc_info=None):
+            status.append(s)
+            return start_response(s, headers, exc_info)
+
+        result = self._srv(environ, logged_start_response)
+        query = environ.get("QUERY_STRING")
+        access_log.info("{} \"{} {}{} {}\" {} {:.3f}ms".format(
+            environ.get("REMOTE_ADDR", "-"), environ.get("REQUEST_METHOD"),
+            environ.get("PATH_INFO", ""), "?" + query if query else "",
+            environ.get("SERVER_PROTOCOL"),
+            status[0].split(" ", 1)[0] if status else "-",
+            (timer() - environ["stubby.start"]) * 1000))
+        return result
+
     def _route(self, url, methods, handler, desc="", meta=None):
         self._srv.route(url, methods, handler)
         h_url = url if meta is None else meta
@@ -157,12 +379,114 @@ class Application(object):
         log.debug("Registered route {}".format(h_key))
 
     def _stub_handler(self, url):
-        path = bottle.request.path
-        query = bottle.request.urlparts.query
-        method = bottle.request.method
+        request = bottle.request
+        path = request.path
+        query = request.urlparts.query
+        method = request.method
         if query:
-            path = "{}?{}".format(path, query)
-        self._new_record(method, path)
+            path = path + "?" + query
+        if self._normalize is not None:
+            path = self._normalize(path)
+        environ = request.environ
+        size = environ.get("CONTENT_LENGTH")
+        size = int(size) if size and size.isdigit() else None
+        body = body_size = body_hash = None
+        config = self._config
+        if config.body == "stream":
+            body_size, body, body_hash = read_body(
+                environ, config.body_chunk, config.capture_body,
+                config.body_hash)
+            if size is None:
+                size = body_size
+        elif config.capture_body and (size or "chunked" in environ.get(
+                "HTTP_TRANSFER_ENCODING", "").lower()):
+            body = read_head(environ, config.capture_body, config.body_chunk)
+        rule = fault = delay = None
+        if self._rules is not None:
+            rule = self._rules.match(method, request.path, request.query,
+                                     environ)
+            if rule is not None and rule.fault is not None:
+                fault, delay = rule.fault.decide()
+        elapsed = timer() - environ.get("stubby.start", 0)
+        self._new_record(method, path, elapsed=elapsed, size=size,
+                         query=query, headers=request.headers, body=body,
+                         body_size=body_size, body_hash=body_hash,
+                         rule=rule.name if rule else None, fault=fault,
+                         delay=delay)
+        if rule is None:
+            return
+        if delay:
+            if environ.get("stubby.defer"):
+                environ["stubby.delay"] = delay
+            else:
+                # The server can't delay responses without a thread.
+                time.sleep(delay)
+        if fault == "drop":
+            environ["stubby.drop"] = True
+        r = rule.fault.response if fault == "error" else rule.response
+        response = bottle.response
+        response.status = r.status
+        for name, value in r.headers:
+            response.set_header(name, value)
+        return r.body
+
+    def _show_stats(self):
+        query = dict(bottle.request.query.decode().items())
+        fmt = query.pop("format", "json")
+        try:
+            limit = query.pop("limit", None)
+            limit = int(limit) if limit else None
+            if limit is not None and limit < 1:
+                raise ValueError
+            if int(query.get("top") or 0) < 0:
+                raise ValueError
+            if "since" in query:
+                int(query["since"])
+        except ValueError:
+            raise bottle.HTTPError(400, "limit, top and since must be "
+                                        "integers (limit above 0, top 0 "
+                                        "or above)")
+        cursor = query.pop("cursor", None)
+        try:
+            cursor = decode_cursor(cursor) if cursor else None
+        except (ValueError, TypeError):
+            raise bottle.HTTPError(400, "cursor must be one sent with a "
+                                        "previous page")
+        stats = self._get_stats(query or None)
+        if fmt == "ndjson":
+            header = None
+            if "since" in query:
+                header = {"version": stats["version"], "full": stats["full"]}
+                stats = stats["stats"]
+            bottle.response.content_type = "application/x-ndjson"
+            return iter_ndjson(stats, cursor, limit, header)
+        bottle.response.content_type = "application/json"
+        return iter_json(stats)
+
+    def _show_rates(self):
+        return self._get_stats({"kind": "rates"})
+
+    def _show_metrics(self):
+        bottle.response.content_type = metrics_content_type
+        return self._metrics.render(self._get_stats)
+
+    def _profile(self):
+        query = bottle.request.query
+        if "seconds" not in query and "mode" not in query:
+            return self._profiler.status()
+        try:
+            return self._profiler.start(float(query.get("seconds", 30)),
+                                        query.get("mode", "sample"))
+        except ValueError as e:
+            raise bottle.HTTPError(400, "{}".format(e))
+        except RuntimeError as e:
+            raise bottle.HTTPError(409, "{}".format(e))
+
+    def _profile_signal(self):
+        try:
+            return self._profiler.start()
+        except RuntimeError as e:
+            log.warning("{}".format(e))
 
     def _show_help(self):
         return self._help_info
@@ -0,0 +1,184 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+
+"""
+
+This module has a fast path for assembling the application at startup.
+
+Aglyph reads the context from `app-context.xml` and assembles each
+component. The first start turns the context into a plain `plan` (the
+dotted-name, strategy and arguments of every component) which is cached
+next to the XML file. Later starts assemble the components from the plan,
+without importing Aglyph, for as long as the XML file is unchanged.
+Contexts which use Aglyph features the plan can't express are always
+assembled by Aglyph.
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import io
+import os
+import json
+import time
+import hashlib
+import logging
+import importlib
+
+
+log = logging.getLogger(__name__)
+plan_version = 1
+strategies = ("singleton", "prototype")
+value_types = (type(""), str, int, float, bool, type(None))
+
+
+class Timings(object):
+    """Records the time at which each phase of the startup ended."""
+
+    def __init__(self):
+        self._start = time.time()
+        self._last = self._start
+        self._phases = []
+
+    def mark(self, phase):
+        now = time.time()
+        self._phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self):
+        phases = " | ".join("{} {:.1f}ms".format(p, t * 1000)
+                            for p, t in self._phases)
+        return "Startup: {} | total {:.1f}ms".format(
+            phases, (self._last - self._start) * 1000)
+
+
+def cache_path(path):
+    head, tail = os.path.split(os.path.abspath(path))
+    return os.path.join(head, ".{}.plan.json".format(tail))
+
+
+def context_key(path):
+    """Identifies the content of the context file."""
+    st = os.stat(path)
+    with open(path, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return {"mtime": st.st_mtime, "size": st.st_size, "sha1": digest}
+
+
+def to_plan(context):
+    """
+    Returns the plan of an Aglyph context, or None if the context uses
+    features which the plan can't express.
+    """
+    from aglyph.component import Reference
+
+    def arg(value):
+        if isinstance(value, Reference):
+            return ["ref", "{}".format(value)]
+        if isinstance(value, value_types):
+            return ["value", value]
+        raise ValueError(value)
+
+    plan = {}
+    for cid, c in context.items():
+        if type(c).__name__ != "Component" or c.strategy not in strategies \
+                or c.factory_name or c.member_name or c.attributes \
+                or c.parent_id or c.after_inject or c.before_clear:
+            return None
+        try:
+            plan[cid] = {
+                "dotted_name": c.dotted_name,
+                "strategy": c.strategy,
+                "args": [arg(v) for v in c.args],
+                "keywords": {k: arg(v) for k, v in c.keywords.items()},
+            }
+        except ValueError:
+            return None
+    return plan
+
+
+class PlanAssembler(object):
+    """Assembles components from a plan, as Aglyph's Assembler would."""
+
+    def __init__(self, plan):
+        self._plan = plan
+        self._singletons = {}
+
+    def _resolve(self, arg):
+        kind, value = arg
+        return self.assemble(value) if kind == "ref" else value
+
+    def assemble(self, component_id):
+        if component_id in self._singletons:
+            return self._singletons[component_id]
+        spec = self._plan[component_id]
+        module, _, name = spec["dotted_name"].rpartition(".")
+        cls = getattr(importlib.import_module(module), name)
+        obj = cls(*[self._resolve(a) for a in spec["args"]],
+                  **{str(k): self._resolve(v)
+                     for k, v in spec["keywords"].items()})
+        if spec["strategy"] == "singleton":
+            self._singletons[component_id] = obj
+        return obj
+
+
+def get_assembler(path, use_cache=True):
+    """
+    Returns an assembler for the context in `path`: a `PlanAssembler`
+    when the cached plan is current, or else Aglyph's Assembler (after
+    caching the plan, when the context allows one).
+    """
+    if use_cache:
+        key = context_key(path)
+        cache = cache_path(path)
+        try:
+            with io.open(cache, encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached.get("version") == plan_version and \
+                    cached.get("key") == key:
+                return PlanAssembler(cached["plan"])
+        except (IOError, OSError, ValueError):
+            pass
+
+    from aglyph.context import XMLContext
+    from aglyph.assembler import Assembler
+
+    context = XMLContext(path)
+    if use_cache:
+        plan = to_plan(context)
+        if plan is not None:
+            try:
+                tmp = "{}.{}".format(cache, os.getpid())
+                with io.open(tmp, "w", encoding="utf-8") as f:
+                    f.write(json.dumps({"version": plan_version,
+                                        "key": key, "plan": plan}))
+                os.rename(tmp, cache)
+            except (IOError, OSError) as e:
+                log.debug("Can't cache the assembly plan: {}".format(e))
+    return Assembler(context)
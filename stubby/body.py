@@ -0,0 +1,150 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import unicode_literals, print_function
+
+
+"""
+
+This module reads request bodies off `wsgi.input` in chunks of a fixed
+size, so that a body is never held in memory as a whole, however large it
+is. As it reads, it counts the bytes of the body, keeps its first few
+bytes if asked to, and hashes it, so that repeated bodies can be spotted.
+
+Bodies sent with `Transfer-Encoding: chunked` are decoded as they are
+read.
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import zlib
+import hashlib
+
+
+algorithms = ("crc32", "md5", "sha1", "sha256")
+
+
+class CRC32(object):
+    """A `hashlib` style wrapper of `zlib.crc32`."""
+
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+
+    def hexdigest(self):
+        return "{:08x}".format(self._crc & 0xffffffff)
+
+
+def new_hash(algorithm):
+    """Returns a hash object for one of `algorithms`."""
+    if algorithm == "crc32":
+        return CRC32()
+    return hashlib.new(algorithm)
+
+
+def iter_body(environ, chunk=65536):
+    """
+    Yields the request body in chunks of up to `chunk` bytes. Reads no
+    further than the body, so that the next request on a persistent
+    connection is left intact.
+    """
+    stream = environ["wsgi.input"]
+    if "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower():
+        for data in iter_chunked(stream, chunk):
+            yield data
+        return
+    if environ.get("wsgi.input_terminated"):
+        # The server ends the stream at the end of the body.
+        for data in iter(lambda: stream.read(chunk), b""):
+            yield data
+        return
+    try:
+        left = int(environ.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        return
+    while left > 0:
+        data = stream.read(min(chunk, left))
+        if not data:
+            return
+        left -= len(data)
+        yield data
+
+
+def iter_chunked(stream, chunk=65536):
+    """Yields the decoded data of a chunked body, in up to `chunk` bytes."""
+    while True:
+        line = stream.readline(1024)
+        try:
+            size = int(line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            return
+        if size == 0:
+            # Skip the trailer, up to the blank line which ends the body.
+            while stream.readline(65536) not in (b"\r\n", b"\n", b""):
+                pass
+            return
+        while size > 0:
+            data = stream.read(min(chunk, size))
+            if not data:
+                return
+            size -= len(data)
+            yield data
+        stream.readline(1024)
+
+
+def read_body(environ, chunk=65536, keep=0, algorithm=None):
+    """
+    Reads the whole request body in chunks, and returns its size, its
+    first `keep` bytes, and its hex digest by `algorithm` (or None).
+    """
+    size = 0
+    head = []
+    digest = new_hash(algorithm) if algorithm else None
+    for data in iter_body(environ, chunk):
+        if size < keep:
+            head.append(data[:keep - size])
+        size += len(data)
+        if digest is not None:
+            digest.update(data)
+    return (size, b"".join(head),
+            digest.hexdigest() if digest is not None else None)
+
+
+def read_head(environ, keep, chunk=65536):
+    """
+    Reads only the first `keep` bytes of the request body, and returns
+    them. The server discards the rest.
+    """
+    head = []
+    size = 0
+    for data in iter_body(environ, min(chunk, keep)):
+        head.append(data)
+        size += len(data)
+        if size >= keep:
+            break
+    return b"".join(head)[:keep]
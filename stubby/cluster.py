@@ -0,0 +1,275 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+
+"""
+
+This module implements the pre-fork multi-process mode. The master process
+forks worker processes which accept connections on a shared listening
+socket. Each worker keeps its own stats collector, and answers requests
+for its stats on a local control socket. Any process can then build a
+merged view of the stats across all workers.
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import os
+import sys
+import json
+import time
+import errno
+import pickle
+import shutil
+import signal
+import socket
+import logging
+import tempfile
+import threading
+
+from six.moves import socketserver
+
+from .stats import merge_snapshots, collate
+
+
+log = logging.getLogger(__name__)
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Answers a single command sent over a worker's control socket."""
+
+    def handle(self):
+        command = json.loads(self.rfile.readline().decode("utf-8"))
+        stats = self.server.stats_collector
+        if command.get("cmd") == "snapshot":
+            reply = stats.snapshot()
+        elif command.get("cmd") == "reset":
+            stats.reset_stats()
+            reply = True
+        else:
+            reply = None
+        self.wfile.write(pickle.dumps(reply, pickle.HIGHEST_PROTOCOL))
+
+
+class ControlServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Cluster(object):
+    """
+    Forks worker processes and provides the merged stats across them. The
+    control sockets live in a private temporary directory, and are only
+    reachable by the user running Stubby.
+    """
+
+    def __init__(self, workers, stats_collector, timeout=5.0,
+                 min_uptime=1.0, max_failures=5):
+        """
+        Args:
+            workers (int): The number of worker processes to fork.
+            stats_collector (stubby.stats.StatsCollector): The collector
+                which each worker records stats into. It must support
+                `snapshot()`.
+            timeout (float): Seconds to wait for a worker's reply.
+            min_uptime (float): Workers which exit sooner than this many
+                seconds after starting have failed to start. They are
+                restarted after a delay which doubles with each failure.
+            max_failures (int): The cluster stops once a worker has
+                failed to start this many times in a row.
+        """
+        self._workers = workers
+        self._stats = stats_collector
+        self._timeout = timeout
+        self._min_uptime = min_uptime
+        self._max_failures = max_failures
+        self._dir = tempfile.mkdtemp(prefix="stubby-")
+        self._pids = {}
+        self._started = {}
+        self._failures = {}
+        self._stopping = False
+
+    def _address(self, index):
+        return os.path.join(self._dir, "worker-{}.sock".format(index))
+
+    def _command(self, index, cmd):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self._timeout)
+        try:
+            sock.connect(self._address(index))
+            sock.sendall(json.dumps({"cmd": cmd}).encode("utf-8") + b"\n")
+            chunks = []
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+        finally:
+            sock.close()
+        return pickle.loads(b"".join(chunks))
+
+    def _broadcast(self, cmd):
+        replies = []
+        for index in range(self._workers):
+            try:
+                replies.append(self._command(index, cmd))
+            except (socket.error, EOFError, pickle.UnpicklingError) as e:
+                log.warning("Worker {} did not reply to '{}': {}".format(
+                    index, cmd, e))
+        return replies
+
+    def get_stats(self, query=None):
+        """
+        Returns the stats merged across all workers. Workers keep their
+        own versions, so a query for changes (`since`) is answered with
+        the full stats.
+        """
+        merged = merge_snapshots(self._broadcast("snapshot"))
+        if query and "since" in query:
+            stats = collate(merged, query)
+            return {"version": 0, "full": sorted(stats), "stats": stats}
+        return collate(merged, query)
+
+    def reset_stats(self):
+        """Resets the stats on all workers."""
+        self._broadcast("reset")
+
+    def run(self, serve):
+        """
+        Forks the workers, each of which calls `serve` with its index,
+        and waits for them. Workers which die unexpectedly are replaced,
+        after a delay if they die soon after starting.
+        """
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            for index in range(self._workers):
+                self._spawn(index, serve)
+            while self._pids:
+                try:
+                    pid, status = os.wait()
+                except OSError:
+                    break
+                index = self._pids.pop(pid, None)
+                if index is None or self._stopping:
+                    continue
+                delay = self._backoff(index)
+                if delay is None:
+                    log.error("Worker {} (pid {}) exited with status {}, "
+                              "and failed to start {} times in a row. "
+                              "Stopping.".format(index, pid, status,
+                                                 self._max_failures))
+                    break
+                log.warning("Worker {} (pid {}) exited with status {}. "
+                            "Restarting it in {:.1f}s.".format(
+                                index, pid, status, delay))
+                time.sleep(delay)
+                self._spawn(index, serve)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop()
+
+    def _backoff(self, index):
+        """
+        Returns the seconds to wait before restarting a worker which has
+        exited, or None if it has failed to start too many times.
+        """
+        if time.time() - self._started[index] >= self._min_uptime:
+            self._failures[index] = 0
+            return 0
+        failures = self._failures.get(index, 0) + 1
+        self._failures[index] = failures
+        if failures >= self._max_failures:
+            return None
+        return self._min_uptime * 0.1 * 2 ** (failures - 1)
+
+    def _spawn(self, index, serve):
+        self._started[index] = time.time()
+        pid = os.fork()
+        if pid:
+            self._pids[pid] = index
+            return
+        code = 0
+        try:
+            # Workers are stopped by the master (with SIGTERM), and not by
+            # the SIGINT which Ctrl+C sends to the whole process group.
+            # Only the first SIGTERM stops a worker, so that another one
+            # (such as from the master, after one sent to the group)
+            # doesn't cut its shutdown short.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, _terminate)
+            address = self._address(index)
+            if os.path.exists(address):
+                os.unlink(address)
+            control = ControlServer(address, ControlHandler)
+            control.stats_collector = self._stats
+            t = threading.Thread(target=control.serve_forever,
+                                 name="stubby-control")
+            t.daemon = True
+            t.start()
+            log.info("Worker {} started with pid = {}".format(
+                index, os.getpid()))
+            serve(index)
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            log.exception(e)
+            code = 1
+        finally:
+            # `os._exit` skips `atexit`, where log handlers are flushed.
+            logging.shutdown()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def _stop(self):
+        self._stopping = True
+        # Workers are left to finish stopping (and saving their stats),
+        # however many more times the master is asked to stop.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in list(self._pids):
+            while True:
+                try:
+                    os.waitpid(pid, 0)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                break
+        self._pids.clear()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def _terminate(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
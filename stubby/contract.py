@@ -71,12 +71,20 @@ class StatsCollectorContract(with_metaclass(ABCMeta)):
         """Returns the name of the stats collector."""
 
     @abstractmethod
-    def new_record(self, method, url):
+    def new_record(self, method, url, elapsed=None, size=None, query=None,
+                   **kwargs):
         """
         Adds a new record into the stat collector.
         Args:
             method (str): The HTTP method supported by the stub server.
             url (str): The URL of the request.
+            elapsed (float): Seconds spent serving the request so far.
+            size (int): The `Content-Length` of the request, if any.
+            query (str): The raw query string of the request, if any.
+        Collectors must accept (and may ignore) further keyword arguments,
+        so that records can carry more information over time. A record
+        which is added some time after the request (such as from a
+        buffer) carries the time of the request in `ts`.
         """
 
     @abstractmethod
@@ -86,9 +94,14 @@ class StatsCollectorContract(with_metaclass(ABCMeta)):
         """
 
     @abstractmethod
-    def get_stats(self):
+    def get_stats(self, query=None):
         """
-        Returns the current stats in the following format:
+        Returns the current stats. `query` is an optional dict of
+        parameters (such as the query of a `/_st/stats` request) which
+        a collector may use to answer a narrower question. Collectors
+        ignore the parameters they don't understand.
+
+        Counting collectors return the stats in the following format:
         {
             "<http-method>": {
                 <uri>: <count>,
@@ -97,3 +110,55 @@ class StatsCollectorContract(with_metaclass(ABCMeta)):
             ...
         }
         """
+
+
+class CollectorContract(StatsCollectorContract):
+    """
+    This contract must be implemented by the individual collectors which
+    a StatsCollector manages. Their records must add up, so that the
+    shards of a collector, and the snapshots of worker processes, can be
+    merged.
+    """
+
+    @abstractmethod
+    def merge(self, other):
+        """
+        Adds the records held by `other`, a collector of the same type,
+        into this collector. `other` may be recording concurrently, so
+        its state must only be read with atomic copies (such as `dict()`
+        of a Counter).
+        """
+
+
+class TrackedCollectorContract(CollectorContract):
+    """
+    This contract must be implemented by the collectors which track the
+    counters changed between checkpoints, so that only the changes need
+    be reported (and persisted).
+    """
+
+    @abstractmethod
+    def apply_changes(self, changes, full=False):
+        """
+        Sets the counters reported by `get_changes` (or by `get_stats`,
+        if `full`) to the reported values.
+        """
+
+
+class ServerContract(with_metaclass(ABCMeta)):
+    """
+    This contract must be implemented by the service which provides the
+    HTTP server on which the application runs.
+    """
+
+    @abstractproperty
+    def name(self):
+        """Returns the name of the selected server."""
+
+    @abstractmethod
+    def get_server(self, host, port, sock=None):
+        """
+        Returns a `bottle.ServerAdapter` instance which serves on the
+        given host and port. If `sock` is given, the server accepts
+        connections on that (already listening) socket instead.
+        """
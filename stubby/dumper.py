@@ -0,0 +1,132 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+
+"""
+
+This module has the stats dumper, which writes the stats to a file when
+asked to by a signal. The signal handler only sets an event; a background
+thread takes the stats and writes them, so that the server carries on
+serving while a large dump is written.
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import os
+import io
+import gzip
+import json
+import time
+import logging
+import threading
+
+from .trace import traceable
+
+
+log = logging.getLogger(__name__)
+
+
+@traceable
+class StatsDumper(object):
+    """
+    Dumps the stats as JSON to `--dump PATH`, or if PATH is a directory
+    (or not given), to a timestamped file in it (or in the system's
+    temporary directory). Dumps are compressed with gzip if PATH ends
+    with `.gz`, or with `compress` for timestamped files. Requests which
+    arrive while one is pending are coalesced into it, and counted.
+    """
+
+    def __init__(self, cfg, compress=False):
+        """
+        Args:
+            cfg (stubby.contract.ConfigContract): The config instance
+                from which to retrieve the path to dump to.
+        """
+        self._path = cfg.get_config().dump
+        self._compress = compress
+        self._requested = threading.Event()
+        self._get_stats = None
+        self._pid = None
+        self.dumps = 0
+        self.coalesced = 0
+
+    def start(self, get_stats):
+        """Starts the dumper thread, which dumps what `get_stats` returns."""
+        self._get_stats = get_stats
+        self._pid = os.getpid()
+        t = threading.Thread(target=self._run, name="stubby-dumper")
+        t.daemon = True
+        t.start()
+
+    def request(self):
+        """Asks for a dump. Safe to call from a signal handler."""
+        if self._pid != os.getpid():
+            # A forked worker has no dumper thread of its own yet.
+            self._requested = threading.Event()
+            self.start(self._get_stats)
+        if self._requested.is_set():
+            self.coalesced += 1
+        else:
+            self._requested.set()
+
+    def _target(self):
+        path = self._path
+        if path and not os.path.isdir(path):
+            return path, path.endswith(".gz")
+        if path is None:
+            import tempfile
+            path = tempfile.gettempdir()
+        name = "stubby-stats-{}-{}-{}.json{}".format(
+            os.getpid(), time.strftime("%Y%m%d-%H%M%S"), self.dumps + 1,
+            ".gz" if self._compress else "")
+        return os.path.join(path, name), self._compress
+
+    def _run(self):
+        while True:
+            self._requested.wait()
+            self._requested.clear()
+            try:
+                self._dump()
+            except Exception as e:
+                log.exception(e)
+
+    def _dump(self):
+        t0 = time.time()
+        stats = self._get_stats()
+        path, compress = self._target()
+        tmp = "{}.tmp".format(path)
+        raw = gzip.open(tmp, "wb") if compress else io.open(tmp, "wb")
+        with raw:
+            for part in json.JSONEncoder().iterencode(stats):
+                raw.write(part.encode("utf-8"))
+        os.rename(tmp, path)
+        self.dumps += 1
+        log.info("Stats dumped to {} in {:.1f}ms ({} dumps, {} requests "
+                 "coalesced)".format(path, (time.time() - t0) * 1000,
+                                     self.dumps, self.coalesced))
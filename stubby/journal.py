@@ -0,0 +1,273 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+
+"""
+
+This module has the request journal, a collector which records every
+request (timestamp, method, path, query, headers and optionally the body)
+as a line of JSON. Records are queued in memory and written out in
+batches by a background thread, so the request thread never waits on the
+disk (unless asked to, when the queue is full).
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import os
+import gzip
+import json
+import time
+import base64
+import logging
+import threading
+
+from six.moves import queue
+
+from .stats import BaseCollector, ProcessLocal, ProcessThread
+from .trace import traceable
+
+
+log = logging.getLogger(__name__)
+policies = ("drop", "block")
+compressions = ("none", "gzip", "zstd")
+
+
+class JournalWriter(ProcessLocal):
+    """
+    Writes queued records to the journal file in batches, and rotates the
+    file when it grows beyond `rotate_bytes` or gets older than
+    `rotate_seconds`. Rotated files are renamed to `<path>.<timestamp>`.
+    Records put after the writer is closed are dropped.
+    """
+
+    counters = ("written", "dropped", "rotated")
+
+    def __init__(self, path, max_queue, batch, flush_interval, rotate_bytes,
+                 rotate_seconds, compress, policy):
+        if compress not in compressions:
+            raise ValueError("compress must be one of {}".format(
+                compressions))
+        if policy not in policies:
+            raise ValueError("policy must be one of {}".format(policies))
+        self._zstd = None
+        if compress == "zstd":
+            import zstandard
+            self._zstd = zstandard.ZstdCompressor()
+        self._path = path
+        self._batch = batch
+        self._flush_interval = flush_interval
+        self._rotate_bytes = rotate_bytes
+        self._rotate_seconds = rotate_seconds
+        self._compress = compress
+        self._block = policy == "block"
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = ProcessThread(self._run, "stubby-journal",
+                                     self._after_fork)
+        self._closed = False
+        self._file = None
+        self.written = 0
+        self.dropped = 0
+        self.rotated = 0
+
+    def _inert_state(self):
+        return {"_queued": self.queued()}
+
+    def queued(self):
+        return self._queue.qsize() if self.live else self._queued
+
+    def put(self, record):
+        self._thread.start()
+        if self._closed:
+            self.dropped += 1
+            return
+        if self._block:
+            self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _after_fork(self):
+        # Forked workers write journals of their own.
+        self._path = "{}.{}".format(self._path, os.getpid())
+        self._file = None
+        self._closed = False
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+
+    def close(self):
+        """
+        Writes out the queued records and closes the file, which ends the
+        compressed stream properly.
+        """
+        with self._lock:
+            if not self._thread.started or self._closed:
+                return
+            self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _filename(self):
+        suffix = {"gzip": ".gz", "zstd": ".zst"}.get(self._compress, "")
+        return self._path + suffix
+
+    def _open(self):
+        name = self._filename()
+        if self._compress == "gzip":
+            f = gzip.open(name, "ab")
+        elif self._compress == "zstd":
+            f = self._zstd.stream_writer(open(name, "ab"))
+        else:
+            f = open(name, "ab")
+        self._file = f
+        self._opened = time.time()
+        self._size = 0
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        name = self._filename()
+        self.rotated += 1
+        os.rename(name, "{}.{}-{}{}".format(
+            self._path, time.strftime("%Y%m%d-%H%M%S"), self.rotated,
+            name[len(self._path):]))
+
+    def _run(self):
+        q = self._queue
+        closing = False
+        while not closing:
+            try:
+                batch = [q.get(timeout=self._flush_interval)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self._batch:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            # `close` queues None after the last record.
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                closing = True
+            try:
+                self._write(batch)
+            except Exception as e:
+                log.exception(e)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, batch):
+        if self._file is not None:
+            age = time.time() - self._opened
+            if (self._rotate_bytes and self._size >= self._rotate_bytes) or \
+                    (self._rotate_seconds and age >= self._rotate_seconds):
+                self._rotate()
+        if not batch:
+            return
+        if self._file is None:
+            self._open()
+        data = "".join(json.dumps(r) + "\n" for r in batch).encode("utf-8")
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        self.written += len(batch)
+
+
+@traceable
+class JournalCollector(BaseCollector):
+    """
+    Journals every request as a line of JSON (NDJSON) to `path`, or to
+    the `--journal` of `cfg`. Without either, nothing is journaled. When
+    the queue of `max_queue` records is full, records are dropped (and
+    counted) with the `drop` policy, or the request thread waits with
+    `block`. Files can be compressed with `gzip`, or `zstd` (needs
+    `zstandard`). Bodies are journaled when the app captures them (see
+    `--capture-body`).
+    """
+
+    kind = "journal"
+    fields = ("headers", "body", "ts")
+
+    def __init__(self, name, path=None, max_queue=100000, batch=1000,
+                 flush_interval=1.0, rotate_bytes=256 * 1024 * 1024,
+                 rotate_seconds=3600, compress="none", policy="drop",
+                 cfg=None):
+        super(JournalCollector, self).__init__(name)
+        if cfg is not None and cfg.get_config().journal:
+            path = cfg.get_config().journal
+        self._writer = None
+        if not path:
+            # Nothing to read off the requests.
+            self.fields = ()
+            return
+        self._writer = JournalWriter(path, max_queue, batch, flush_interval,
+                                     rotate_bytes, rotate_seconds, compress,
+                                     policy)
+
+    def new_record(self, method, url, headers=None, body=None, ts=None,
+                   **kwargs):
+        if self._writer is None:
+            return
+        path, _, query = url.partition("?")
+        record = {"ts": ts or time.time(), "method": method, "path": path,
+                  "query": query}
+        if headers is not None:
+            record["headers"] = dict(headers)
+        if body:
+            try:
+                record["body"] = body.decode("utf-8")
+            except UnicodeDecodeError:
+                record["body"] = base64.b64encode(body).decode("ascii")
+                record["body-encoding"] = "base64"
+        self._writer.put(record)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    def merge(self, other):
+        # Shards share the writer. Snapshots from other processes carry
+        # counters of their own, which add up.
+        mine, theirs = self._writer, other._writer
+        if mine is theirs or mine is None or mine.live:
+            return
+        mine.merge_counters(theirs)
+        mine._queued += theirs.queued()
+
+    def reset_stats(self):
+        pass
+
+    def get_stats(self, query=None):
+        w = self._writer
+        if w is None:
+            return {}
+        return {"written": w.written, "dropped": w.dropped,
+                "queued": w.queued(), "rotated": w.rotated}
@@ -26,7 +26,7 @@ from __future__ import unicode_literals, print_function
 
 """
 
-This module caters to the logging nees of the application. There are three
+This module caters to the logging nees of the application. There are four
 loggers to choose from (mainly to demonstrate configuration through Aglyph).
 
 """
@@ -35,7 +35,12 @@ loggers to choose from (mainly to demonstrate configuration through Aglyph).
 __author__ = "Praveen Shirali <praveengshirali@gmail.com>"
 
 
+import os
+import atexit
 import logging
+
+from six.moves import queue
+
 from .trace import traceable
 log = logging.getLogger(__name__)
 
@@ -56,13 +61,19 @@ class BasicLogger(Logger):
         self._config = cfg.get_config()
         self._logger = logging.getLogger("stubby")
         self._sh = logging.StreamHandler()
-        self._logger.addHandler(self._sh)
+        self._loggers = [self._logger]
         level = "DEBUG" if self._config.debug is True else "INFO"
         self._logger.setLevel(level)
         if self._config.aglyph is True:
             self._aglyph = logging.getLogger("aglyph")
             self._aglyph.setLevel(level)
-            self._aglyph.addHandler(self._sh)
+            self._loggers.append(self._aglyph)
+        for logger in self._loggers:
+            logger.addHandler(self._handler())
+
+    def _handler(self):
+        """Returns the handler to attach to the loggers."""
+        return self._sh
 
 
 @traceable
@@ -71,6 +82,13 @@ class ColorLogger(BasicLogger):
 
     def __init__(self, cfg):
         super(ColorLogger, self).__init__(cfg)
+        if not self._sh.stream.isatty():
+            # Colors are of no use off a terminal, and colorlog takes a
+            # while to import.
+            self._sh.setFormatter(logging.Formatter(
+                "%(asctime)s.%(msecs)03d %(levelname)10s | %(message)s",
+                datefmt="%Y-%m-%d %H:%M:%S"))
+            return
         from colorlog import ColoredFormatter
         formatter = ColoredFormatter(
             "%(asctime)s.%(msecs)03d %(log_color)s%(levelname)10s%(reset)s "
@@ -96,3 +114,103 @@ class ColorLogger(BasicLogger):
             style="%"
         )
         self._sh.setFormatter(formatter)
+
+
+class DroppingQueueHandler(logging.Handler):
+    """
+    Puts records on a bounded queue, for a `QueueListener` to format and
+    emit. When the queue is full, records are dropped and counted, and a
+    warning with the count is queued once there is room again.
+    """
+
+    def __init__(self, records, on_close=None):
+        logging.Handler.__init__(self)
+        self._records = records
+        self._on_close = on_close
+        self.dropped = 0
+        self._unreported = 0
+
+    def close(self):
+        # Called by `logging.shutdown()`, so that processes which exit
+        # without running `atexit` handlers can still write out the queue.
+        if self._on_close is not None:
+            self._on_close()
+        logging.Handler.close(self)
+
+    def emit(self, record):
+        # The message is merged with its args here, as the args may change
+        # once the record is queued. Formatting is left to the listener.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        try:
+            if self._unreported:
+                self._records.put_nowait(logging.makeLogRecord({
+                    "name": log.name, "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": "Dropped {} log records".format(
+                        self._unreported)}))
+                self._unreported = 0
+            self._records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+
+
+@traceable
+class QueueLogger(ColorLogger):
+    """
+    A ColorLogger which formats and writes records on a background
+    thread, so that logging never holds up requests. Up to `max_queue`
+    records wait to be written; records beyond that are dropped.
+    """
+
+    def __init__(self, cfg, max_queue=10000):
+        self._records = queue.Queue(maxsize=max_queue)
+        self._qh = DroppingQueueHandler(self._records, self._stop)
+        super(QueueLogger, self).__init__(cfg)
+        self._listener = self._start()
+        atexit.register(self._stop)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _stop(self):
+        listener, self._listener = self._listener, None
+        if listener is None:
+            return
+        listener.stop()
+        if self.dropped:
+            self._sh.handle(logging.makeLogRecord({
+                "name": log.name, "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": "Dropped {} log records in all".format(
+                    self.dropped)}))
+
+    def _after_fork(self):
+        # The listener's thread doesn't survive a fork, and the queue's
+        # lock may have been held by it. Start afresh in the child.
+        self._records = queue.Queue(maxsize=self._records.maxsize)
+        self._qh._records = self._records
+        self._listener = self._start()
+
+    def _start(self):
+        from logging.handlers import QueueListener
+
+        class Listener(QueueListener):
+            def enqueue_sentinel(self):
+                # Wait for room, as the queue may be full when stopping.
+                self.queue.put(self._sentinel)
+
+        listener = Listener(self._records, self._sh)
+        listener.start()
+        return listener
+
+    def _handler(self):
+        return self._qh
+
+    @property
+    def dropped(self):
+        return self._qh.dropped
@@ -0,0 +1,222 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+
+"""
+
+This module renders the stats in the OpenMetrics text format, for
+Prometheus to scrape from `/metrics`.
+
+The URL, method and word counters can hold a great many series, so their
+rendered lines are cached, and a scrape re-renders only the series which
+changed since the previous scrape (see `since` in `stubby.stats`). The
+histograms are bounded by their collectors, and are rendered in full.
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import threading
+
+from .trace import traceable
+
+
+content_type = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+other = "<other>"
+quantiles = (("p50", "0.5"), ("p90", "0.9"), ("p99", "0.99"),
+             ("p999", "0.999"))
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace(
+        "\"", "\\\"")
+
+
+def sample(name, names, values, value):
+    """Returns a sample line, such as `name{label="value"} 1`."""
+    labels = ",".join("{}=\"{}\"".format(n, escape(v))
+                      for n, v in zip(names, values))
+    return "{}{{{}}} {}\n".format(name, labels, value)
+
+
+class CounterFamily(object):
+    """
+    A counter metric whose series' lines are rendered as they change.
+    Series beyond the first `max_series` are summed into a series whose
+    last label is `<other>`, so that the label cardinality stays bounded.
+    """
+
+    def __init__(self, name, help, labels, max_series):
+        self._name = name
+        self._header = "# TYPE {0} counter\n# HELP {0} {1}\n".format(
+            name, help)
+        self._labels = labels
+        self._max_series = max_series
+        self._lines = {}
+        self._others = {}
+        self._text = None
+
+    def clear(self):
+        self._lines.clear()
+        self._others.clear()
+        self._text = None
+
+    def set(self, values, value):
+        lines = self._lines
+        if values in lines or len(lines) < self._max_series:
+            lines[values] = sample(self._name + "_total", self._labels,
+                                   values, value)
+        else:
+            self._others[values] = value
+        self._text = None
+
+    def render(self):
+        if self._text is None:
+            parts = [self._header]
+            parts.extend(self._lines.values())
+            totals = {}
+            for values, value in self._others.items():
+                key = values[:-1]
+                totals[key] = totals.get(key, 0) + value
+            for key, value in sorted(totals.items()):
+                parts.append(sample(self._name + "_total", self._labels,
+                                    key + (other,), value))
+            self._text = "".join(parts)
+        return self._text
+
+
+def render_summaries(name, help, unit_scale, rows):
+    """
+    Renders a summary metric. `rows` are (label names, label values,
+    histogram summary) from the histogram collectors. A metric without
+    samples isn't rendered at all.
+    """
+    parts = ["# TYPE {0} summary\n# HELP {0} {1}\n".format(name, help)]
+    for names, values, summary in rows:
+        if not summary["count"]:
+            continue
+        for key, q in quantiles:
+            value = "{:.6g}".format(summary[key] * unit_scale)
+            parts.append(sample(name, names + ("quantile",), values + (q,),
+                                value))
+        parts.append(sample(name + "_count", names, values,
+                            summary["count"]))
+    return "".join(parts) if len(parts) > 1 else ""
+
+
+@traceable
+class MetricsRenderer(object):
+    """
+    Renders the counters of the collectors named `method_hits`,
+    `url_hits` and `word_hits`, and the histograms of every `histogram`
+    collector. The URL counts may be the estimates of a
+    TopURLHitCollector, which is reported in full on every scrape, as it
+    doesn't track its changes. At most `max_series` URLs and words get
+    series of their own.
+    """
+
+    def __init__(self, method_hits="method-hits", url_hits="url-hits",
+                 word_hits="word-hits", max_series=10000):
+        self._names = {"method": method_hits, "url": url_hits,
+                       "word": word_hits}
+        self._families = {
+            "method": CounterFamily(
+                "stubby_requests", "Requests received, by method.",
+                ("method",), max_series),
+            "url": CounterFamily(
+                "stubby_url_requests", "Requests received, by URL.",
+                ("method", "url"), max_series),
+            "word": CounterFamily(
+                "stubby_word_requests",
+                "Requests received, by URL path segment.",
+                ("word",), max_series),
+        }
+        self._version = -1
+        self._lock = threading.Lock()
+
+    def render(self, get_stats):
+        """
+        Returns the metrics as text. `get_stats` is the stats collector's
+        (or the cluster's) `get_stats`.
+        """
+        with self._lock:
+            self._update(get_stats)
+            parts = [self._families[k].render()
+                     for k in ("method", "url", "word")]
+        parts.append(self._render_histograms(get_stats({"kind":
+                                                        "histogram"})))
+        parts.append("# EOF\n")
+        return "".join(parts)
+
+    def _update(self, get_stats):
+        names = self._names
+        result = get_stats({"since": str(self._version),
+                            "collector": ",".join(names.values())})
+        self._version = result["version"]
+        full = set(result["full"])
+        stats = result["stats"]
+        for key, name in names.items():
+            family = self._families[key]
+            if name in full:
+                family.clear()
+            changes = stats.get(name)
+            if not changes:
+                continue
+            if key == "url":
+                for method, counts in changes.items():
+                    for url, value in counts.items():
+                        if isinstance(value, dict):
+                            # An estimate, with its error.
+                            value = value["count"]
+                        family.set((method, url), value)
+            else:
+                for k, value in changes.items():
+                    family.set((k,), value)
+
+    def _render_histograms(self, stats):
+        latency, size = [], []
+        for name, result in sorted(stats.items()):
+            for method, h in sorted(result.get("methods", {}).items()):
+                labels = ("collector", "method")
+                latency.append((labels, (name, method), h["latency-us"]))
+                size.append((labels, (name, method), h["size-bytes"]))
+            for route, h in sorted(result.get("routes", {}).items()):
+                method, _, path = route.partition(" ")
+                if not path:
+                    method, path = "", route
+                labels = ("collector", "method", "path")
+                latency.append((labels, (name, method, path),
+                                h["latency-us"]))
+                size.append((labels, (name, method, path),
+                             h["size-bytes"]))
+        return render_summaries(
+            "stubby_request_latency_seconds",
+            "Time taken to handle requests.", 1e-6, latency) + \
+            render_summaries(
+                "stubby_request_size_bytes",
+                "Sizes of request bodies.", 1, size)
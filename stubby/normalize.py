@@ -0,0 +1,215 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+
+"""
+
+This module has the URL normalizer, which collapses the high-cardinality
+parts of a URL (numeric IDs, UUIDs, hashes and user defined patterns) into
+templates, so that `/users/1234/orders/98765` is counted as
+`/users/{id}/orders/{id}`. It also has the query parser, which turns query
+strings into bounded lists of parameters.
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import re
+import collections
+
+from six.moves.urllib.parse import unquote_plus
+
+from .trace import traceable
+
+
+builtin_patterns = (
+    (r"[0-9]+", "{id}"),
+    (r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-"
+     r"[0-9a-fA-F]{4}-[0-9a-fA-F]{12}", "{uuid}"),
+    (r"[0-9a-fA-F]{16,}", "{hash}"),
+)
+query_modes = ("keep", "sort", "drop")
+
+
+class LRUCache(object):
+    """
+    A dict bounded to `maxsize` entries, which evicts the least recently
+    used entry. It may be shared by threads; a race between two threads
+    costs at most a cache miss.
+    """
+
+    def __init__(self, maxsize=65536):
+        self._maxsize = maxsize
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        data = self._data
+        try:
+            value = data.pop(key)
+        except KeyError:
+            return default
+        data[key] = value
+        return value
+
+    def put(self, key, value):
+        data = self._data
+        data[key] = value
+        while len(data) > self._maxsize:
+            try:
+                data.popitem(last=False)
+            except KeyError:
+                break
+
+    def clear(self):
+        self._data.clear()
+
+
+@traceable
+class URLNormalizer(object):
+    """
+    Turns URLs into templates. Each path segment is matched (in full)
+    against the user defined patterns first, and then against the builtin
+    patterns. The first pattern which matches replaces the segment. The
+    query string is kept as is, sorted by parameter, or dropped.
+
+    Results are memoized in an LRU cache, so repeated URLs cost about a
+    dict lookup.
+    """
+
+    def __init__(self, patterns=None, query="keep", builtins=True,
+                 cache_size=65536):
+        """
+        Args:
+            patterns (dict): Maps a regex to the template which replaces
+                the path segments it matches.
+            query (str): One of `keep`, `sort` or `drop`.
+            builtins (bool): Whether numeric IDs, UUIDs and hex hashes
+                are collapsed.
+            cache_size (int): The number of URLs to memoize.
+        """
+        if query not in query_modes:
+            raise ValueError("query must be one of {}".format(query_modes))
+        rules = list((patterns or {}).items())
+        if builtins:
+            rules.extend(builtin_patterns)
+        self._rules = [(re.compile(r"(?:{})\Z".format(p)), t)
+                       for p, t in rules]
+        self._query = query
+        self._cache_size = cache_size
+        self._cache = LRUCache(cache_size)
+
+    def __deepcopy__(self, memo):
+        # Shards of a collector share the normalizer and its cache.
+        return self
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_cache"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache = LRUCache(self._cache_size)
+
+    def normalize(self, url):
+        template = self._cache.get(url)
+        if template is None:
+            template = self._template(url)
+            self._cache.put(url, template)
+        return template
+
+    def _segment(self, segment):
+        for pattern, template in self._rules:
+            if pattern.match(segment):
+                return template
+        return segment
+
+    def _template(self, url):
+        path, sep, query = url.partition("?")
+        path = "/".join(self._segment(s) for s in path.split("/"))
+        if not sep or self._query == "drop":
+            return path
+        if self._query == "sort":
+            query = "&".join(sorted(query.split("&")))
+        return "{}?{}".format(path, query)
+
+
+@traceable
+class QueryParser(object):
+    """
+    Parses query strings into tuples of (key, value) pairs, decoded. At
+    most `max_params` parameters of a query are parsed, and keys and
+    values are cut to `max_length` characters, so that a hostile query
+    string costs bounded memory. Results are memoized in an LRU cache of
+    `cache_size` query strings.
+    """
+
+    def __init__(self, max_params=64, max_length=128, cache_size=4096):
+        self._max_params = max_params
+        self._max_length = max_length
+        self._cache_size = cache_size
+        self._cache = LRUCache(cache_size)
+
+    def __deepcopy__(self, memo):
+        # Shards of a collector share the parser and its cache.
+        return self
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_cache"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache = LRUCache(self._cache_size)
+
+    def parse(self, query):
+        if not query:
+            return ()
+        params = self._cache.get(query)
+        if params is None:
+            params = self._parse(query)
+            if len(query) <= self._max_params * self._max_length:
+                self._cache.put(query, params)
+        return params
+
+    def _parse(self, query):
+        n = self._max_params
+        size = self._max_length
+        params = []
+        for part in query.split("&", n)[:n]:
+            if not part:
+                continue
+            key, _, value = part.partition("=")
+            # An escaped character takes up to 3 characters.
+            params.append((unquote_plus(key[:size * 3])[:size],
+                           unquote_plus(value[:size * 3])[:size]))
+        return tuple(params)
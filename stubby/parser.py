@@ -40,6 +40,12 @@ import sys
 import argparse
 from .trace import set_trace
 from .contract import ConfigContract
+from .body import algorithms
+
+
+# The servers `stubby.server.ServerFactory` can run. Kept here, so that
+# parsing the command line doesn't import the servers (and bottle).
+server_names = ("wsgiref", "threaded", "asyncio")
 
 
 class CLIParser(ConfigContract):
@@ -74,6 +80,78 @@ class CLIParser(ConfigContract):
             "-p", "--port", type=int, default=8080,
             help="Port for the HTTP server."
         )
+        self._parser.add_argument(
+            "-s", "--server", default="threaded", choices=server_names,
+            help=("The HTTP server to run on. `wsgiref` serves a single "
+                  "connection at a time. `threaded` serves connections "
+                  "from a pool of worker threads. `asyncio` serves all "
+                  "connections on an event loop (Python 3 only).")
+        )
+        self._parser.add_argument(
+            "--threads", type=int, default=32,
+            help="Number of worker threads for the `threaded` server."
+        )
+        self._parser.add_argument(
+            "--backlog", type=int, default=1024,
+            help="Size of the listen backlog for the server's socket."
+        )
+        self._parser.add_argument(
+            "-w", "--workers", type=int, default=1,
+            help=("Number of worker processes which share the listening "
+                  "socket. Stats are merged across all workers. Needs the "
+                  "`threaded` or `asyncio` server.")
+        )
+        self._parser.add_argument(
+            "--keepalive", type=int, default=15,
+            help=("Seconds for which an idle persistent connection is kept "
+                  "open. Use 0 to close connections after every response.")
+        )
+        self._parser.add_argument(
+            "--persist", default=None, metavar="PATH",
+            help=("Save the stats to PATH periodically, and restore them "
+                  "from it on startup. Workers save to PATH.<n>.")
+        )
+        self._parser.add_argument(
+            "--persist-interval", type=float, default=10.0,
+            help="Seconds between saves of the stats."
+        )
+        self._parser.add_argument(
+            "--capture-body", type=int, default=0, metavar="BYTES",
+            help="Pass up to BYTES of each request body to the collectors."
+        )
+        self._parser.add_argument(
+            "--journal", default=None, metavar="PATH",
+            help=("Journal every request as a line of JSON to PATH. "
+                  "Workers journal to PATH.<pid>.")
+        )
+        self._parser.add_argument(
+            "--body", choices=("discard", "stream"), default="discard",
+            help=("What to do with request bodies. 'discard' leaves them "
+                  "to the server to discard, unread. 'stream' reads them "
+                  "in chunks, and records their sizes (and hashes).")
+        )
+        self._parser.add_argument(
+            "--body-chunk", type=int, default=65536, metavar="BYTES",
+            help="Size of the chunks in which request bodies are read."
+        )
+        self._parser.add_argument(
+            "--body-hash", choices=algorithms, default=None,
+            help="Hash streamed request bodies, to spot repeated ones."
+        )
+        self._parser.add_argument(
+            "--profile-dir", default=None, metavar="DIR",
+            help="Directory to save profiles in. Defaults to the system's "
+                 "temporary directory."
+        )
+        self._parser.add_argument(
+            "--dump", default=None, metavar="PATH",
+            help="File, or directory, to dump stats to on SIGUSR1. "
+                 "Defaults to the system's temporary directory."
+        )
+        self._parser.add_argument(
+            "--access-log", type=float, default=0.0, metavar="RATE",
+            help="Log this fraction (0 to 1) of requests to the access log."
+        )
         self._parser.add_argument(
             "-d", "--debug", action="store_true", default=False,
             help="Enable debug logging on the application."
@@ -97,7 +175,11 @@ class CLIParser(ConfigContract):
     def _parse(self, args=None):
         if not args:
             args = sys.argv[1:]
-        return self._parser.parse_args(args)
+        config = self._parser.parse_args(args)
+        if config.workers > 1 and config.server == "wsgiref":
+            self._parser.error("--workers needs the `threaded` or "
+                               "`asyncio` server")
+        return config
 
     def get_config(self):
         """
@@ -0,0 +1,235 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+
+"""
+
+This module persists the stats, so that a restart doesn't lose them. A
+background thread periodically appends the counters which changed to a
+delta log, and every so often writes a full snapshot (and starts a new
+log). On startup, the latest snapshot is read through a memory map, and
+the deltas logged after it are applied on top.
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import os
+import mmap
+import time
+import struct
+import pickle
+import logging
+import threading
+
+from .trace import traceable
+
+
+log = logging.getLogger(__name__)
+magic = b"STUBBY-STATS-1\n"
+record = struct.Struct("<I")
+
+
+def _read(path):
+    """Returns a read-only memory map of a file, or None if it's empty."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_snapshot(path):
+    """Returns the snapshot stored at path, or None."""
+    if not os.path.exists(path):
+        return None
+    mm = _read(path)
+    if mm is None or mm[:len(magic)] != magic:
+        log.warning("Ignoring {}: not a stats snapshot".format(path))
+        return None
+    view = memoryview(mm)
+    try:
+        return pickle.loads(view[len(magic):])
+    finally:
+        view.release()
+        mm.close()
+
+
+def read_deltas(path):
+    """
+    Yields the records of a delta log. A record cut short by a crash ends
+    the log.
+    """
+    if not os.path.exists(path):
+        return
+    mm = _read(path)
+    if mm is None:
+        return
+    view = memoryview(mm)
+    try:
+        offset = 0
+        while offset + record.size <= len(mm):
+            size, = record.unpack_from(mm, offset)
+            offset += record.size
+            if offset + size > len(mm):
+                log.warning("Ignoring a partial record at the end of "
+                            "{}".format(path))
+                break
+            yield pickle.loads(view[offset:offset + size])
+            offset += size
+    finally:
+        view.release()
+        mm.close()
+
+
+@traceable
+class StatsPersister(object):
+    """
+    Writes the stats of a stats collector to `--persist` every
+    `--persist-interval` seconds, and restores them on startup. Only the
+    changed counters are logged on most intervals; a full snapshot is
+    written every `full_every` intervals. Collectors which don't track
+    their changes are restored as of the last full snapshot.
+    """
+
+    def __init__(self, cfg, stats_collector, full_every=30):
+        """
+        Args:
+            cfg (stubby.contract.ConfigContract): The config instance
+                from which to retrieve the path and interval.
+            stats_collector (stubby.stats.StatsCollector): The collector
+                whose stats are persisted. It must support `snapshot()`
+                and `restore()`.
+            full_every (int): The number of intervals between snapshots.
+        """
+        config = cfg.get_config()
+        self._path = config.persist
+        self._interval = config.persist_interval
+        self._stats = stats_collector
+        self._full_every = full_every
+        self._version = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self):
+        return bool(self._path)
+
+    def start(self, worker=None):
+        """
+        Restores the stats and starts persisting them. Each worker of a
+        multi-process server persists into files of its own.
+        """
+        if not self.enabled:
+            return
+        if worker is not None:
+            self._path = "{}.{}".format(self._path, worker)
+        self._log_path = self._path + ".log"
+        self.restore()
+        self._snapshot()
+        self._thread = threading.Thread(target=self._run,
+                                        name="stubby-persist")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread, and writes a final snapshot."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._snapshot()
+
+    def restore(self):
+        t0 = time.time()
+        state = read_snapshot(self._path)
+        if state is None:
+            return
+        collectors = state["collectors"]
+        by_name = {c.name: c for c in collectors}
+        deltas = 0
+        for delta in read_deltas(self._log_path):
+            if delta["version"] <= state["version"]:
+                continue
+            for name, changes in delta["stats"].items():
+                c = by_name.get(name)
+                if c is not None:
+                    c.apply_changes(changes, name in delta["full"])
+            deltas += 1
+        self._stats.restore(collectors)
+        log.info("Restored stats from {} (+{} deltas) in {:.3f}s".format(
+            self._path, deltas, time.time() - t0))
+
+    def _changes(self):
+        changes = self._stats.get_stats(
+            {"since": str(self._version), "tracked": "1"})
+        self._version = changes["version"]
+        return changes
+
+    def _snapshot(self):
+        # Checkpoint first: changes made while the snapshot is taken are
+        # logged again later, which is harmless as deltas are absolute.
+        self._changes()
+        state = {"version": self._version, "time": time.time(),
+                 "collectors": self._stats.snapshot()}
+        tmp = self._path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(magic)
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self._path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        with open(self._log_path, "wb"):
+            pass
+
+    def _append(self):
+        changes = self._changes()
+        if not changes["full"] and not any(changes["stats"].values()):
+            return
+        data = pickle.dumps(changes, pickle.HIGHEST_PROTOCOL)
+        with open(self._log_path, "ab") as f:
+            f.write(record.pack(len(data)) + data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _run(self):
+        intervals = 0
+        while not self._stop.wait(self._interval):
+            intervals += 1
+            try:
+                if intervals % self._full_every == 0:
+                    self._snapshot()
+                else:
+                    self._append()
+            except Exception as e:
+                log.exception(e)
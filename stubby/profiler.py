@@ -0,0 +1,246 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+
+"""
+
+This module profiles a running Stubby, on demand, for a window of time.
+
+The `cprofile` mode profiles request handling with cProfile. Before
+Python 3.12, cProfile only sees the thread it is enabled on, so each
+thread handling requests gets a profile of its own, which is enabled
+around every request, and the profiles are merged into a single pstats
+file when the window closes. From Python 3.12, cProfile is built on
+`sys.monitoring`, which sees every thread but allows one profile at a
+time in the process, so a single profile is enabled for the window.
+
+The `sample` mode has a background thread sample the stacks of every
+thread (through `sys._current_frames`) at a fixed interval, and writes
+them as collapsed stacks, which flamegraph.pl and speedscope can read.
+Request threads are left alone, so its overhead stays low. The summary
+of the top functions leaves out threads waiting for work.
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import os
+import sys
+import time
+import logging
+import threading
+import collections
+
+from .trace import traceable
+
+
+log = logging.getLogger(__name__)
+modes = ("cprofile", "sample")
+# Functions in which threads wait for work, rather than do work.
+idle = ("wait", "select", "readinto", "accept", "sleep", "poll")
+get_ident = getattr(threading, "get_ident", None) or threading._get_ident
+
+
+@traceable
+class Profiler(object):
+    """
+    Profiles the application for `seconds` at a time, in one of `modes`,
+    and saves the results under `--profile-dir`. One profile runs at a
+    time, for at most `max_seconds`. Samples are taken every `interval`
+    seconds.
+    """
+
+    def __init__(self, cfg, interval=0.01, max_seconds=600, top=20):
+        """
+        Args:
+            cfg (stubby.contract.ConfigContract): The config instance
+                from which to retrieve the directory for the results.
+        """
+        self._dir = cfg.get_config().profile_dir
+        self._interval = interval
+        self._max_seconds = max_seconds
+        self._top = top
+        self._lock = threading.Lock()
+        self._profiles = None
+        self._status = {"running": False}
+        self.tracing = False
+
+    def status(self):
+        """Returns the state of the current, or the last, profile."""
+        return dict(self._status)
+
+    def start(self, seconds=30, mode="sample"):
+        """
+        Starts profiling in the background, and returns its status.
+        Raises ValueError on bad arguments, and RuntimeError if a profile
+        is running already.
+        """
+        if mode not in modes:
+            raise ValueError("mode must be one of {}".format(modes))
+        if not 0 < seconds <= self._max_seconds:
+            raise ValueError("seconds must be between 0 and {}".format(
+                self._max_seconds))
+        with self._lock:
+            if self._status["running"]:
+                raise RuntimeError("A profile is running already")
+            directory = self._dir
+            if directory is None:
+                import tempfile
+                directory = tempfile.gettempdir()
+            path = os.path.join(directory, "stubby-{}-{}.{}".format(
+                os.getpid(), time.strftime("%Y%m%d-%H%M%S"),
+                "pstats" if mode == "cprofile" else "collapsed"))
+            self._status = {"running": True, "mode": mode,
+                            "seconds": seconds, "path": path,
+                            "started": time.time()}
+        run = self._run_cprofile if mode == "cprofile" else self._run_sample
+        t = threading.Thread(target=self._run, args=(run, seconds, path),
+                             name="stubby-profiler")
+        t.daemon = True
+        t.start()
+        log.info("Profiling ({}) for {}s into {}".format(mode, seconds, path))
+        return self.status()
+
+    def _run(self, run, seconds, path):
+        try:
+            result = run(seconds, path)
+        except Exception as e:
+            log.exception(e)
+            result = {"error": "{}".format(e)}
+        result["running"] = False
+        status = dict(self._status)
+        status.update(result)
+        self._status = status
+        log.info("Profile saved to {}".format(path))
+
+    def call(self, app, environ, start_response):
+        """Calls the WSGI `app` under the profile of the calling thread."""
+        profiles = self._profiles
+        if profiles is None:
+            return app(environ, start_response)
+        ident = get_ident()
+        profile = profiles.get(ident)
+        if profile is None:
+            import cProfile
+            profile = profiles[ident] = cProfile.Profile()
+        profile.enable()
+        try:
+            return app(environ, start_response)
+        finally:
+            profile.disable()
+
+    def _run_cprofile(self, seconds, path):
+        import pstats
+        if hasattr(sys, "monitoring"):
+            import cProfile
+            profile = cProfile.Profile()
+            # Raises ValueError if another tool (such as a debugger) is
+            # profiling the process already.
+            profile.enable()
+            try:
+                time.sleep(seconds)
+            finally:
+                profile.disable()
+            profiles = [profile]
+        else:
+            profiles = self._profile_threads(seconds)
+        if not profiles:
+            return {"requests": 0}
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(path)
+        rows = sorted(stats.stats.items(), key=lambda i: i[1][3],
+                      reverse=True)[:self._top]
+        return {
+            "calls": stats.total_calls,
+            "seconds-profiled": round(stats.total_tt, 6),
+            "top": [{"function": "{} ({}:{})".format(func, file, line),
+                     "calls": nc, "own": round(tt, 6),
+                     "cumulative": round(ct, 6)}
+                    for (file, line, func), (_, nc, tt, ct, _) in rows],
+        }
+
+    def _profile_threads(self, seconds):
+        """Profiles each thread calling `call` for `seconds`."""
+        self._profiles = {}
+        self.tracing = True
+        time.sleep(seconds)
+        self.tracing = False
+        profiles = list(self._profiles.values())
+        # Let the requests in flight finish, and disable their profiles.
+        time.sleep(0.1)
+        self._profiles = None
+        return profiles
+
+    def _run_sample(self, seconds, path):
+        me = get_ident()
+        labels = {}
+        names = {}
+        stacks = collections.Counter()
+        samples = 0
+        end = time.time() + seconds
+        while time.time() < end:
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = "{} ({}:{})".format(
+                            code.co_name, os.path.basename(code.co_filename),
+                            code.co_firstlineno)
+                    stack.append(label)
+                    frame = frame.f_back
+                name = names.get(ident)
+                if name is None:
+                    names.update((t.ident, t.name)
+                                 for t in threading.enumerate())
+                    name = names.get(ident, "thread-{}".format(ident))
+                stack.append(name)
+                stacks[";".join(reversed(stack))] += 1
+            del frames
+            samples += 1
+            time.sleep(self._interval)
+        with open(path, "w") as f:
+            for stack, n in stacks.most_common():
+                f.write("{} {}\n".format(stack, n))
+        leaves = collections.Counter()
+        for stack, n in stacks.items():
+            leaf = stack.rpartition(";")[2]
+            if leaf.partition(" ")[0] not in idle:
+                leaves[leaf] += n
+        total = sum(leaves.values()) or 1
+        return {
+            "samples": samples,
+            "busy": sum(leaves.values()),
+            "top": [{"function": leaf, "samples": n,
+                     "percent": round(100.0 * n / total, 2)}
+                    for leaf, n in leaves.most_common(self._top)],
+        }
@@ -0,0 +1,323 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+
+"""
+
+This module has the load generator behind the `replay` script. It replays
+request journals (see `stubby.journal`), or requests for a synthetic
+Zipf-distributed set of URLs, against a Stubby instance.
+
+Requests are sent by a pool of threads, each holding a keep-alive
+connection. With `--rate`, requests are scheduled open-loop, at fixed
+intervals or with Poisson arrivals, and latencies are measured from the
+scheduled send time, so that a slow server can't hide its queueing delay.
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import io
+import sys
+import gzip
+import json
+import time
+import base64
+import bisect
+import random
+import argparse
+import threading
+
+from six.moves import http_client
+from six.moves.urllib.parse import urlsplit
+
+from .stats import LogLinearHistogram
+
+
+skipped_headers = ("host", "content-length", "connection",
+                   "transfer-encoding")
+arrivals = ("fixed", "poisson")
+
+
+def open_journal(path):
+    """Opens a journal for reading text, decompressing `.gz` and `.zst`."""
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8")
+    if path.endswith(".zst"):
+        import zstandard
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        return io.TextIOWrapper(reader, encoding="utf-8")
+    return io.open(path, encoding="utf-8")
+
+
+def read_journal(path):
+    """Yields the records of a journal."""
+    with open_journal(path) as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except EOFError:
+            pass
+
+
+def load_journal(paths):
+    """
+    Returns the requests in the given journals as a list of
+    (method, url, body, headers). Requests for the `/_st/` routes are
+    skipped, as they aren't recorded in the stats. Compressed journals
+    cut short (by a worker which was stopped) are read up to the cut.
+    """
+    requests = []
+    for path in paths:
+        for r in read_journal(path):
+            if r["path"].startswith("/_st/"):
+                continue
+            url = r["path"] + ("?" + r["query"] if r.get("query") else "")
+            body = r.get("body")
+            if body is not None:
+                if r.get("body-encoding") == "base64":
+                    body = base64.b64decode(body)
+                else:
+                    body = body.encode("utf-8")
+            headers = {k: v for k, v in r.get("headers", {}).items()
+                       if k.lower() not in skipped_headers}
+            requests.append((r["method"], url, body, headers))
+    return requests
+
+
+class Zipf(object):
+    """Picks one of `n` synthetic URLs, the i-th with weight 1/i^s."""
+
+    def __init__(self, n, s=1.1, seed=None):
+        total = 0.0
+        self._cumulative = []
+        for i in range(1, n + 1):
+            total += 1.0 / i ** s
+            self._cumulative.append(total)
+        self._random = random.Random(seed)
+
+    def __call__(self):
+        c = self._cumulative
+        i = bisect.bisect_left(c, self._random.random() * c[-1])
+        return ("GET", "/synthetic/{}".format(i), None, {})
+
+
+class Schedule(object):
+    """
+    Hands out the requests to send, along with the time each is due.
+    With no `rate`, every request is due immediately (closed loop).
+    """
+
+    def __init__(self, pick, count, rate=0, arrival="fixed", seed=None):
+        self._pick = pick
+        self._count = count
+        self._rate = rate
+        self._poisson = arrival == "poisson"
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._due = None
+
+    def next(self):
+        with self._lock:
+            if self._sent >= self._count:
+                return None
+            now = time.time()
+            if self._due is None or not self._rate:
+                self._due = now
+            elif self._poisson:
+                self._due += self._random.expovariate(self._rate)
+            else:
+                self._due += 1.0 / self._rate
+            request = self._pick(self._sent)
+            self._sent += 1
+            return self._due, request
+
+
+class Result(object):
+    """The latencies and outcomes of the requests sent by one thread."""
+
+    def __init__(self):
+        self.latency = LogLinearHistogram()
+        self.statuses = dict()
+        self.methods = dict()
+        self.errors = 0
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        for status, n in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + n
+        for method, n in other.methods.items():
+            self.methods[method] = self.methods.get(method, 0) + n
+        self.errors += other.errors
+
+
+def connect(target, timeout):
+    parts = urlsplit(target)
+    cls = http_client.HTTPSConnection if parts.scheme == "https" \
+        else http_client.HTTPConnection
+    return cls(parts.hostname, parts.port, timeout=timeout)
+
+
+def send(target, schedule, result, timeout):
+    conn = connect(target, timeout)
+    while True:
+        item = schedule.next()
+        if item is None:
+            break
+        due, (method, url, body, headers) = item
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            conn.request(method, url, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except (http_client.HTTPException, IOError):
+            result.errors += 1
+            conn.close()
+            conn = connect(target, timeout)
+            continue
+        result.latency.add(int((time.time() - due) * 1e6))
+        result.statuses[response.status] = \
+            result.statuses.get(response.status, 0) + 1
+        result.methods[method] = result.methods.get(method, 0) + 1
+    conn.close()
+
+
+def method_hits(target, timeout):
+    """Returns the method hit counts reported by the target."""
+    conn = connect(target, timeout)
+    try:
+        conn.request("GET", "/_st/stats?collector=method-hits")
+        response = conn.getresponse()
+        stats = json.loads(response.read().decode("utf-8"))
+    finally:
+        conn.close()
+    return stats.get("method-hits", {})
+
+
+def run(target, requests, count, connections=16, rate=0, arrival="fixed",
+        timeout=10.0, verify=False, seed=None):
+    """
+    Sends `count` requests to `target`, picking them from `requests`,
+    a list which is cycled through, or a callable. Returns the report.
+    """
+    if callable(requests):
+        pick = lambda i: requests()
+    else:
+        pick = lambda i: requests[i % len(requests)]
+    before = method_hits(target, timeout) if verify else None
+    schedule = Schedule(pick, count, rate, arrival, seed)
+    results = [Result() for _ in range(connections)]
+    threads = [threading.Thread(target=send,
+                                args=(target, schedule, r, timeout))
+               for r in results]
+    t0 = time.time()
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+    total = Result()
+    for r in results:
+        total.merge(r)
+    report = {
+        "requests": total.latency.count,
+        "errors": total.errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(total.latency.count / elapsed, 1),
+        "latency-us": total.latency.summary(),
+        "statuses": {str(k): v for k, v in total.statuses.items()},
+    }
+    if verify:
+        after = method_hits(target, timeout)
+        counted = {m: after.get(m, 0) - before.get(m, 0)
+                   for m in total.methods}
+        report["verified"] = counted == total.methods
+        report["counted"] = counted
+    return report
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="replay",
+        description="Replays request journals, or synthetic requests, "
+                    "against a Stubby instance.")
+    parser.add_argument(
+        "target", nargs="?", default="http://localhost:8080",
+        help="Base URL of the Stubby instance.")
+    parser.add_argument(
+        "-j", "--journal", nargs="+", default=[], metavar="PATH",
+        help="Journals (NDJSON, optionally .gz or .zst) to replay.")
+    parser.add_argument(
+        "-u", "--urls", type=int, default=1000,
+        help="Number of synthetic URLs, when no journal is given.")
+    parser.add_argument(
+        "-n", "--requests", type=int, default=None,
+        help="Number of requests to send. Defaults to the journal length, "
+             "or 10000.")
+    parser.add_argument(
+        "-c", "--connections", type=int, default=16,
+        help="Number of sending threads, each with its own connection.")
+    parser.add_argument(
+        "-r", "--rate", type=float, default=0,
+        help="Requests per second to schedule. 0 sends as fast as the "
+             "connections allow.")
+    parser.add_argument(
+        "-a", "--arrival", choices=arrivals, default="fixed",
+        help="Spacing of scheduled requests, with --rate.")
+    parser.add_argument(
+        "--timeout", type=float, default=10.0,
+        help="Socket timeout in seconds.")
+    parser.add_argument(
+        "--verify", action="store_true", default=False,
+        help="Check that the target's method hit counts grew by the "
+             "number of requests sent.")
+    parser.add_argument(
+        "--seed", type=int, default=None,
+        help="Seed for synthetic URLs and Poisson arrivals.")
+    config = parser.parse_args(args)
+
+    if config.journal:
+        requests = load_journal(config.journal)
+        if not requests:
+            parser.error("no requests in the journal")
+        count = config.requests or len(requests)
+    else:
+        requests = Zipf(config.urls, seed=config.seed)
+        count = config.requests or 10000
+
+    report = run(config.target, requests, count, config.connections,
+                 config.rate, config.arrival, config.timeout, config.verify,
+                 config.seed)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if config.verify and not report["verified"]:
+        sys.exit(1)
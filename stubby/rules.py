@@ -0,0 +1,295 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+
+"""
+
+This module has the response rules, which let Stubby answer requests with
+a given status, headers and body, instead of an empty 200.
+
+Rules are read from a JSON file, a list of objects such as:
+
+    {
+        "method": ["GET", "HEAD"],
+        "path": "/users/{id}/orders/*",
+        "query": {"expand": "items", "page": null},
+        "headers": {"X-Api-Key": "secret"},
+        "response": {"status": 200, "headers": {"X-Stub": "1"},
+                     "json": {"orders": []}}
+    }
+
+`method`, `query` and `headers` are optional. A `{name}` path segment
+matches any one segment, and a trailing `*` matches the rest of the path.
+Query parameters and headers must be equal to the given values, or just
+present for `null`. The response body is given as `body` (text), `json`
+or `file` (a path read at startup). When several rules match a request,
+the first one in the file wins.
+
+A rule can also inject faults, with a `fault` object such as:
+
+    {"delay": {"exponential": 200}, "drop": 0.01, "error": 0.05,
+     "status": 503}
+
+`delay` is in milliseconds: a number, or a distribution given as
+`{"uniform": [min, max]}`, `{"normal": [mean, stddev]}` or
+`{"exponential": mean}`. `drop` and `error` are the fractions of requests
+whose connection is reset, or which are answered with `status` (503 by
+default) instead of the rule's response. Delays apply to every outcome.
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import io
+import os
+import json
+import heapq
+import random
+import logging
+
+import bottle
+
+from .trace import traceable
+
+
+log = logging.getLogger(__name__)
+
+
+def environ_key(header):
+    """Returns the WSGI environ key which holds a request header."""
+    key = header.upper().replace("-", "_")
+    if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+        return key
+    return "HTTP_" + key
+
+
+class Response(object):
+    """A response rendered once, with its body and headers as bytes."""
+
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, spec, base):
+        code = int(spec.get("status", 200))
+        self.status = "{} {}".format(code, bottle.HTTP_CODES.get(code, ""))
+        headers = dict(spec.get("headers", {}))
+        if "json" in spec:
+            body = json.dumps(spec["json"]).encode("utf-8")
+            content_type = "application/json"
+        elif "file" in spec:
+            with open(os.path.join(base, spec["file"]), "rb") as f:
+                body = f.read()
+            content_type = "application/octet-stream"
+        else:
+            body = spec.get("body", "").encode("utf-8")
+            content_type = "text/plain; charset=UTF-8"
+        names = set(k.lower() for k in headers)
+        if body and "content-type" not in names:
+            headers["Content-Type"] = content_type
+        headers["Content-Length"] = str(len(body))
+        self.headers = [(str(k), str(v)) for k, v in headers.items()]
+        self.body = body
+
+
+class Fault(object):
+    """Decides the faults to inject into a request, as per a rule."""
+
+    __slots__ = ("delay", "drop", "error", "response")
+
+    def __init__(self, spec, base):
+        self.delay = delay_sampler(spec.get("delay"))
+        self.drop = float(spec.get("drop", 0))
+        self.error = float(spec.get("error", 0))
+        self.response = Response({"status": spec.get("status", 503)}, base)
+
+    def decide(self):
+        """Returns the fault (`drop`, `error` or None) and the delay."""
+        delay = self.delay() if self.delay else 0
+        r = random.random()
+        if r < self.drop:
+            return "drop", delay
+        if r < self.drop + self.error:
+            return "error", delay
+        return None, delay
+
+
+def delay_sampler(spec):
+    """Returns a function which samples delays (in seconds), or None."""
+    if not spec:
+        return None
+    if isinstance(spec, (int, float)):
+        return lambda: spec / 1000.0
+    if len(spec) != 1:
+        raise ValueError("A delay has a single distribution: {}".format(spec))
+    dist, args = list(spec.items())[0]
+    if dist == "uniform":
+        low, high = args
+        return lambda: random.uniform(low, high) / 1000.0
+    if dist == "normal":
+        mean, stddev = args
+        return lambda: max(0.0, random.gauss(mean, stddev)) / 1000.0
+    if dist == "exponential":
+        return lambda: random.expovariate(1.0 / args) / 1000.0
+    raise ValueError("Unknown delay distribution: {}".format(dist))
+
+
+class Rule(object):
+    """A rule's conditions besides the path, its response and faults."""
+
+    __slots__ = ("index", "methods", "query", "headers", "response",
+                 "fault", "name")
+
+    def __init__(self, index, spec, base):
+        self.index = index
+        self.name = spec.get("name") or "{} {}".format(index, spec["path"])
+        methods = spec.get("method")
+        if isinstance(methods, (str, type(""))):
+            methods = [methods]
+        self.methods = frozenset(m.upper() for m in methods) \
+            if methods else None
+        self.query = sorted(spec.get("query", {}).items())
+        self.headers = sorted((environ_key(k), v) for k, v in
+                              spec.get("headers", {}).items())
+        self.response = Response(spec.get("response", {}), base)
+        fault = spec.get("fault")
+        self.fault = Fault(fault, base) if fault else None
+
+    def __lt__(self, other):
+        return self.index < other.index
+
+    def accepts(self, method, query, environ):
+        if self.methods is not None and method not in self.methods:
+            return False
+        for key, value in self.query:
+            got = query.get(key)
+            if got is None or (value is not None and got != value):
+                return False
+        for key, value in self.headers:
+            got = environ.get(key)
+            if got is None or (value is not None and got != value):
+                return False
+        return True
+
+
+class Node(object):
+    """A node of the path trie, for one path segment."""
+
+    __slots__ = ("children", "param", "rules", "rest")
+
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.rules = []
+        self.rest = []
+
+
+def split(path):
+    return [s for s in path.split("/") if s]
+
+
+@traceable
+class ResponseRules(object):
+    """
+    Matches requests against the rules in `path`, compiled into a trie of
+    path segments. A lookup walks the segments of the request path, so
+    its cost depends on the depth of the path rather than the number of
+    rules. A missing file means there are no rules, unless `required`.
+    """
+
+    def __init__(self, path, required=False):
+        self._root = Node()
+        self._count = 0
+        if not os.path.exists(path) and not required:
+            log.debug("No response rules at {}".format(path))
+            return
+        with io.open(path, encoding="utf-8") as f:
+            specs = json.load(f)
+        base = os.path.dirname(os.path.abspath(path))
+        for index, spec in enumerate(specs):
+            self._add(Rule(index, spec, base), spec["path"])
+        self._count = len(specs)
+        log.info("Loaded {} response rules from {}".format(self._count,
+                                                            path))
+
+    def __len__(self):
+        return self._count
+
+    def _add(self, rule, path):
+        node = self._root
+        segments = split(path)
+        for i, segment in enumerate(segments):
+            if segment == "*" and i == len(segments) - 1:
+                node.rest.append(rule)
+                return
+            if segment.startswith("{") and segment.endswith("}"):
+                if node.param is None:
+                    node.param = Node()
+                node = node.param
+            else:
+                node = node.children.setdefault(segment, Node())
+        node.rules.append(rule)
+
+    def _candidates(self, segments):
+        """Returns the rule lists of the trie nodes matching the path."""
+        found = []
+        stack = [(self._root, 0)]
+        end = len(segments)
+        while stack:
+            node, i = stack.pop()
+            if node.rest:
+                found.append(node.rest)
+            if i == end:
+                if node.rules:
+                    found.append(node.rules)
+                continue
+            child = node.children.get(segments[i])
+            if child is not None:
+                stack.append((child, i + 1))
+            if node.param is not None:
+                stack.append((node.param, i + 1))
+        return found
+
+    def match(self, method, path, query, environ):
+        """
+        Returns the first rule matching the request, or None.
+
+        Args:
+            method (str): The request method.
+            path (str): The request path, without the query.
+            query (dict): The query parameters.
+            environ (dict): The WSGI environ, for the headers.
+        """
+        if not self._count:
+            return None
+        found = self._candidates(split(path))
+        if not found:
+            return None
+        rules = found[0] if len(found) == 1 else heapq.merge(*found)
+        for rule in rules:
+            if rule.accepts(method, query, environ):
+                return rule
+        return None
@@ -0,0 +1,647 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2016 Praveen Shirali <praveengshirali@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+
+"""
+
+This module contains the HTTP server backends on which Bottle can run the
+application. Bottle's default `wsgiref` server serves one connection at a
+time and closes it after every response. The `threaded` server dispatches
+accepted connections to a fixed pool of worker threads and keeps HTTP/1.1
+connections alive. The `asyncio` server (Python 3 only) lives in its own
+module and is imported only when selected.
+
+The application can ask for its response to be delayed, or for the
+connection to be dropped, by setting `stubby.delay` (in seconds) or
+`stubby.drop` in the WSGI environ. Servers which set `stubby.defer` in
+the environ do this without holding a thread through the delay.
+
+"""
+
+
+__author__ = "Praveen Shirali <praveengshirali@gmail.com>"
+
+
+import io
+import time
+import heapq
+import socket
+import struct
+import logging
+import itertools
+import threading
+import bottle
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+from six.moves import queue
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from wsgiref.simple_server import ServerHandler
+
+from .contract import ServerContract
+from .trace import traceable
+
+
+log = logging.getLogger(__name__)
+
+
+def bind_socket(host, port, backlog=1024):
+    """
+    Returns a listening TCP socket bound to the given address. Used when
+    several worker processes accept connections on the same socket.
+    """
+    info = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                              socket.SOCK_STREAM, 0, socket.AI_PASSIVE)
+    family, socktype, proto, _, address = info[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+class BodyReader(object):
+    """
+    Restricts reads on the connection's input stream to the request body,
+    so that the next request on a persistent connection is left intact.
+    """
+
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self._left = length
+
+    def read(self, size=-1):
+        if self._left <= 0:
+            return b""
+        if size is None or size < 0 or size > self._left:
+            size = self._left
+        data = self._rfile.read(size)
+        self._left -= len(data)
+        if not data:
+            self._left = 0
+        return data
+
+    def readline(self, size=-1):
+        if self._left <= 0:
+            return b""
+        if size is None or size < 0 or size > self._left:
+            size = self._left
+        data = self._rfile.readline(size)
+        self._left -= len(data)
+        if not data:
+            self._left = 0
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b""))
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def drain(self, chunk=65536):
+        """Discards whatever the application left unread."""
+        while self.read(chunk):
+            pass
+
+
+class KeepAliveServerHandler(ServerHandler):
+    """
+    A wsgiref ServerHandler which speaks HTTP/1.1 to HTTP/1.1 clients.
+    Responses without a `Content-Length` are sent chunked, so that the
+    connection can still be reused.
+    """
+
+    _chunked = False
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        rh = self.request_handler
+        if "Content-Length" in self.headers:
+            pass
+        elif self.http_version == "1.1" and not rh.close_connection:
+            self.headers["Transfer-Encoding"] = "chunked"
+            self._chunked = True
+        else:
+            rh.close_connection = True
+        if rh.close_connection:
+            self.headers["Connection"] = "close"
+        elif self.http_version == "1.0":
+            self.headers["Connection"] = "keep-alive"
+
+    def write(self, data):
+        if self.status and not self.headers_sent:
+            # The framing is decided while the headers are sent. Send
+            # them ahead of the first chunk of data.
+            self.send_headers()
+        if self._chunked:
+            if not data:
+                return
+            data = b"%x\r\n" % len(data) + data + b"\r\n"
+        ServerHandler.write(self, data)
+
+    def finish_content(self):
+        ServerHandler.finish_content(self)
+        if self._chunked:
+            self._write(b"0\r\n\r\n")
+            self._flush()
+
+    def finish_response(self):
+        rh = self.request_handler
+        delay = self.environ.get("stubby.delay") or 0
+        if self.environ.get("stubby.drop"):
+            if hasattr(self.result, "close"):
+                self.result.close()
+            rh.close_connection = True
+            rh.deferred = (delay, None)
+            return
+        if delay:
+            # The response is rendered now and sent when it is due.
+            self.stdout = io.BytesIO()
+            rh.deferred = (delay, self.stdout)
+        ServerHandler.finish_response(self)
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    Serves requests on a connection until the client asks for it to be
+    closed, or it stays idle for longer than `timeout` seconds. While the
+    connection is idle, it is watched by the server's `IdleConnections`
+    rather than by a worker.
+    """
+
+    protocol_version = "HTTP/1.1"
+    timeout = 15
+    quiet = True
+    # Headers and body go out in separate writes. With Nagle's algorithm,
+    # the body would wait on the client's delayed ACK of the headers.
+    disable_nagle_algorithm = True
+    # Seconds for which a worker waits for the next request on a
+    # persistent connection, before handing it to `IdleConnections`.
+    idle_grace = 0.002
+
+    def address_string(self):
+        return self.client_address[0]
+
+    def log_request(self, *args, **kwargs):
+        if not self.quiet:
+            WSGIRequestHandler.log_request(self, *args, **kwargs)
+
+    detached = False
+    deferred = None
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one()
+        while not self.close_connection and not self.detached:
+            if self._park():
+                return
+            self.handle_one()
+
+    def _park(self):
+        """
+        Hands the idle connection over to the server's watcher of idle
+        connections, unless the next request arrives within `idle_grace`
+        seconds. Returns whether this handler is done with the connection.
+        """
+        if getattr(self.server, "idle", None) is None:
+            return False
+        sock = self.connection
+        # Busy clients send their next request within a moment. Waiting
+        # for it briefly saves a round trip through the watcher.
+        sock.settimeout(self.idle_grace)
+        try:
+            if self.rfile.peek(1):
+                return False
+        except socket.timeout:
+            # The stream can't be read after a timeout. The connection
+            # gets a new stream when it is handed back to a worker.
+            pass
+        except (socket.error, ValueError):
+            return False
+        finally:
+            sock.settimeout(self.timeout)
+        if not self.server.park(sock, self.client_address, self.timeout):
+            self.close_connection = True
+            return True
+        self.detached = True
+        return True
+
+    def handle_one(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, socket.error):
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+        environ = self.get_environ()
+        environ["stubby.defer"] = True
+        self.deferred = None
+        body = self._body_reader(environ)
+        handler = KeepAliveServerHandler(
+            body, self.wfile, self.get_stderr(), environ,
+            multithread=True
+        )
+        handler.http_version = self.request_version[5:] or "1.0"
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if self.deferred is None or self.deferred[1] is not None:
+            if body is self.rfile:
+                self.close_connection = True
+            else:
+                body.drain()
+        if self.deferred is not None:
+            # Hand the connection over to the server's timer, which sends
+            # the response (or drops the connection) when it is due.
+            delay, out = self.deferred
+            data = None if out is None else out.getvalue()
+            self.server.defer(delay, self.connection, self.client_address,
+                              data, not self.close_connection)
+            self.close_connection = True
+            self.detached = True
+
+    def _body_reader(self, environ):
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            # The application reads the chunked body off the raw stream.
+            # It may not read all of it, so the connection can't be reused.
+            return self.rfile
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            return self.rfile
+        return BodyReader(self.rfile, length)
+
+
+class DelayedResponses(object):
+    """
+    Holds delayed responses in a heap ordered by due time, and sends them
+    from a single timer thread. Connections waiting on a delayed response
+    cost memory, not threads. Once its response is sent, a persistent
+    connection is watched by the server's `IdleConnections`.
+    """
+
+    def __init__(self, server):
+        self._server = server
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                                        name="stubby-delays")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, delay, sock, address, data, keep_alive):
+        item = (time.time() + delay, next(self._seq), sock, address, data,
+                keep_alive)
+        with self._cond:
+            heapq.heappush(self._heap, item)
+            if self._heap[0] is item:
+                self._cond.notify()
+
+    def _run(self):
+        heap = self._heap
+        while True:
+            with self._cond:
+                while not heap or heap[0][0] > time.time():
+                    self._cond.wait(heap[0][0] - time.time() if heap
+                                    else None)
+                due = []
+                now = time.time()
+                while heap and heap[0][0] <= now:
+                    due.append(heapq.heappop(heap))
+            for _, _, sock, address, data, keep_alive in due:
+                try:
+                    self._send(sock, address, data, keep_alive)
+                except Exception:
+                    self._server.handle_error(sock, address)
+                    self._server.shutdown_request(sock)
+
+    def _send(self, sock, address, data, keep_alive):
+        if data is None:
+            # Reset the connection, instead of closing it gracefully.
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                            struct.pack(b"ii", 1, 0))
+            sock.close()
+            return
+        try:
+            sock.sendall(data)
+        except socket.error:
+            self._server.shutdown_request(sock)
+            return
+        if not keep_alive or not self._server.park(sock, address):
+            self._server.shutdown_request(sock)
+
+
+class IdleConnections(object):
+    """
+    Watches idle persistent connections with a selector, from a single
+    thread. A connection goes back to the server's pool of workers when
+    its next request arrives, and is closed once it stays idle for longer
+    than its timeout. Idle connections cost memory, not workers.
+    """
+
+    def __init__(self, server):
+        self._server = server
+        self._selector = selectors.DefaultSelector()
+        self._added = []
+        self._deadlines = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run,
+                                        name="stubby-idle")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._selector.get_map()) - 1
+
+    def add(self, sock, address, timeout=None):
+        """Watches `sock` until it is readable, or `timeout` runs out."""
+        deadline = time.time() + timeout if timeout else None
+        with self._lock:
+            if self._closed:
+                return False
+            self._added.append((sock, address, deadline))
+        self._wake()
+        return True
+
+    def close(self):
+        """Stops watching, and closes the idle connections."""
+        with self._lock:
+            self._closed = True
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"x")
+        except socket.error:
+            # The watcher has a wakeup pending already.
+            pass
+
+    def _run(self):
+        selector = self._selector
+        while True:
+            with self._lock:
+                added, self._added = self._added, []
+                closed = self._closed
+            if closed:
+                break
+            for sock, address, deadline in added:
+                try:
+                    selector.register(sock, selectors.EVENT_READ,
+                                      (address, deadline))
+                except (ValueError, KeyError, OSError):
+                    self._server.shutdown_request(sock)
+                    continue
+                if deadline is not None:
+                    heapq.heappush(self._deadlines,
+                                   (deadline, next(self._seq), sock))
+            timeout = None
+            if self._deadlines:
+                timeout = max(0, self._deadlines[0][0] - time.time())
+            for key, _ in selector.select(timeout):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except socket.error:
+                        pass
+                    continue
+                selector.unregister(key.fileobj)
+                self._server.resume(key.fileobj, key.data[0])
+            self._expire()
+        for key in list(selector.get_map().values()):
+            if key.fileobj is not self._wake_r:
+                selector.unregister(key.fileobj)
+                self._server.shutdown_request(key.fileobj)
+        selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _expire(self):
+        now = time.time()
+        deadlines = self._deadlines
+        keys = self._selector.get_map()
+        while deadlines and deadlines[0][0] <= now:
+            deadline, _, sock = heapq.heappop(deadlines)
+            try:
+                key = keys[sock]
+            except (KeyError, ValueError):
+                # The connection became active, or was closed, since.
+                continue
+            if key.data[1] != deadline:
+                continue
+            self._selector.unregister(sock)
+            self._server.shutdown_request(sock)
+
+
+class PooledWSGIServer(WSGIServer):
+    """
+    A WSGIServer whose accepted connections are handled by a fixed pool of
+    worker threads. Connections wait in a bounded queue when all workers
+    are busy; once the queue is full, the accept loop stops and further
+    connections wait in the socket's listen backlog.
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, address, handler_cls, threads=32, backlog=1024,
+                 sock=None):
+        self.request_queue_size = backlog
+        WSGIServer.__init__(self, address, handler_cls,
+                            bind_and_activate=sock is None)
+        if sock is not None:
+            # Serve on a socket which was bound and activated elsewhere.
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+            self.server_name = socket.getfqdn(self.server_address[0])
+            self.server_port = self.server_address[1]
+            self.setup_environ()
+        self._pending = queue.Queue(maxsize=backlog)
+        self._delayed = DelayedResponses(self)
+        self.idle = IdleConnections(self) if selectors else None
+        self._workers = []
+        for i in range(threads):
+            t = threading.Thread(target=self._work,
+                                 name="stubby-worker-{}".format(i))
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def process_request(self, request, client_address):
+        self._pending.put((request, client_address))
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def defer(self, delay, request, client_address, data, keep_alive):
+        """
+        Sends `data` on the connection after `delay` seconds, or drops
+        the connection if `data` is None.
+        """
+        self._delayed.add(delay, request, client_address, data, keep_alive)
+
+    def park(self, request, client_address, timeout=None):
+        """
+        Watches an idle persistent connection until its next request
+        arrives, without holding a worker. Returns False if it can't.
+        """
+        if self.idle is None:
+            return False
+        if timeout is None:
+            timeout = self.RequestHandlerClass.timeout
+        return self.idle.add(request, client_address, timeout)
+
+    def resume(self, request, client_address):
+        """Hands a connection whose next request arrived to the workers."""
+        try:
+            self._pending.put_nowait((request, client_address))
+        except queue.Full:
+            self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            request, client_address = item
+            handler = None
+            try:
+                handler = self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if not getattr(handler, "detached", False):
+                    self.shutdown_request(request)
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        if self.idle is not None:
+            self.idle.close()
+        # Drop the connections still waiting for a worker, so that the
+        # workers can be told to stop without blocking on a full queue.
+        while True:
+            try:
+                item = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self.shutdown_request(item[0])
+        for _ in self._workers:
+            try:
+                self._pending.put_nowait(None)
+            except queue.Full:
+                break
+
+
+class ThreadedServer(bottle.ServerAdapter):
+    """Runs the application on a `PooledWSGIServer`."""
+
+    def run(self, handler):
+        threads = self.options.get("threads", 32)
+        backlog = self.options.get("backlog", 1024)
+        keepalive = self.options.get("keepalive", 15)
+        quiet = self.quiet
+
+        class RequestHandler(KeepAliveRequestHandler):
+            pass
+
+        RequestHandler.timeout = keepalive or None
+        RequestHandler.quiet = quiet
+        if keepalive == 0:
+            RequestHandler.protocol_version = "HTTP/1.0"
+
+        server_cls = PooledWSGIServer
+        if ":" in self.host:
+            class server_cls(PooledWSGIServer):
+                address_family = socket.AF_INET6
+
+        self.srv = server_cls((self.host, self.port), RequestHandler,
+                              threads=threads, backlog=backlog,
+                              sock=self.options.get("sock"))
+        self.srv.set_app(handler)
+        self.port = self.srv.server_port
+        try:
+            self.srv.serve_forever()
+        finally:
+            self.srv.server_close()
+
+
+@traceable
+class ServerFactory(ServerContract):
+    """
+    Builds the server adapter on which Bottle runs the application, as
+    selected by `--server`.
+    """
+
+    def __init__(self, cfg):
+        """
+        Args:
+            cfg (stubby.contract.ConfigContract): The config instance
+                from which to retrieve the server options
+        """
+        self._config = cfg.get_config()
+
+    @property
+    def name(self):
+        return self._config.server
+
+    def get_server(self, host, port, sock=None):
+        name = self._config.server
+        opts = dict(threads=self._config.threads,
+                    backlog=self._config.backlog,
+                    keepalive=self._config.keepalive,
+                    sock=sock)
+        if name == "threaded":
+            return ThreadedServer(host=host, port=port, **opts)
+        if name == "asyncio":
+            from .aioserver import AsyncioServer
+            return AsyncioServer(host=host, port=port, **opts)
+        if sock is not None:
+            raise ValueError("The wsgiref server can't share a socket")
+        return bottle.WSGIRefServer(host=host, port=port)
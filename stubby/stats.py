@@ -34,11 +34,25 @@ This module has the implementation for the various stats collectors.
 __author__ = "Praveen Shirali <praveengshirali@gmail.com>"
 
 
+import os
+import copy
+import functools
+import time
+import math
+import heapq
+import struct
+import hashlib
 import logging
 import threading
 import collections
 
-from .contract import StatsCollectorContract
+from array import array
+from itertools import compress
+from operator import add, itemgetter
+
+from .contract import StatsCollectorContract, CollectorContract
+from .contract import TrackedCollectorContract
+from .normalize import QueryParser
 from .trace import traceable
 
 
@@ -56,100 +70,2012 @@ class StatsCollector(StatsCollectorContract):
 
     def __init__(self, name, *collectors):
         super(StatsCollector, self).__init__()
+        self._name = name
         self._collectors = collectors
         self._lock = threading.Lock()
+        self._version = 0
 
     @property
     def name(self):
         return self._name
 
-    def _call(self, member, *args):
+    def _call(self, member, *args, **kwargs):
         result = {}
-        for c in self._collectors:
-            with self._lock:
+        with self._lock:
+            for c in self._collectors:
                 try:
                     member_obj = getattr(c, member)
-                    result[c.name] = member_obj(*args)
+                    result[c.name] = member_obj(*args, **kwargs)
                 except Exception as e:
                     log.exception(e)
-        args_msg = " ".join(["{}".format(a) for a in args])
-        suffix = " with args {}".format(args_msg) if len(args) else ""
-        log.debug("Method '{}' called{}".format(member, suffix))
+        if log.isEnabledFor(logging.DEBUG):
+            args_msg = " ".join(["{}".format(a) for a in args])
+            suffix = " with args {}".format(args_msg) if len(args) else ""
+            log.debug("Method '{}' called{}".format(member, suffix))
         return result
 
-    def new_record(self, method, url):
-        self._call("new_record", method, url)
+    def new_record(self, method, url, **kwargs):
+        self._call("new_record", method, url, **kwargs)
 
     def reset_stats(self):
         self._call("reset_stats")
 
-    def get_stats(self):
-        return self._call("get_stats")
+    def close(self):
+        """Closes the collectors, once no more records are added."""
+        self._call("close")
+
+    def get_stats(self, query=None):
+        with self._lock:
+            if query and "since" in query:
+                self._version += 1
+                for c in self._collectors:
+                    c.checkpoint(self._version)
+                return collate_changes(self._collectors, [self._collectors],
+                                       query, self._version)
+            return collate(self._collectors, query)
+
+    def snapshot(self):
+        """
+        Returns a consistent copy of every collector. The copies can be
+        merged with snapshots from other processes using `merge_snapshots`.
+        """
+        with self._lock:
+            return copy.deepcopy(list(self._collectors))
+
+    def restore(self, collectors):
+        """
+        Adds the records of previously saved collectors (such as a
+        snapshot) into the collectors of the same name.
+        """
+        with self._lock:
+            restore_into(self._collectors, collectors)
 
 
 @traceable
-class BaseCollector(StatsCollectorContract):
+class ShardedStatsCollector(StatsCollector):
+    """
+    A StatsCollector which gives every thread its own shard (a private
+    copy of each collector). Threads record into their shard without
+    taking a lock. Reading the stats merges all shards; resetting them
+    retires all shards, and threads start fresh ones on their next record.
 
-    def __init__(self, name):
+    The collectors passed in serve as templates for the shards and must
+    be empty. Collectors must support `merge`.
+    """
+
+    def __init__(self, name, *collectors):
+        super(ShardedStatsCollector, self).__init__(name, *collectors)
+        self._local = threading.local()
+        self._shards = {}
+        self._retired = None
+        self._retired_at = 0
+        self._generation = 0
+
+    def _shard(self):
+        local = self._local
+        if getattr(local, "generation", None) != self._generation:
+            with self._lock:
+                local.generation = self._generation
+                local.shard = copy.deepcopy(self._collectors)
+                self._shards[threading.current_thread()] = local.shard
+        return local.shard
+
+    def _live_shards(self):
+        """Returns the shards to read from. Call with the lock held."""
+        for thread, shard in list(self._shards.items()):
+            if thread.is_alive():
+                continue
+            # Fold the shards of finished threads into one, so that
+            # short-lived threads don't pile up shards. Their changes are
+            # no longer tracked from then on.
+            if self._retired is None:
+                self._retired = shard
+            else:
+                for into, c in zip(self._retired, shard):
+                    into.merge(c)
+            self._retired_at = self._version
+            del self._shards[thread]
+        return list(self._shards.values())
+
+    def _merge(self, shards):
+        merged = copy.deepcopy(self._collectors)
+        for shard in shards:
+            for into, c in zip(merged, shard):
+                try:
+                    into.merge(c)
+                except Exception as e:
+                    log.exception(e)
+        return merged
+
+    def _merged(self):
+        with self._lock:
+            shards = self._live_shards()
+            if self._retired is not None:
+                shards.append(self._retired)
+        return self._merge(shards)
+
+    def new_record(self, method, url, **kwargs):
+        for c in self._shard():
+            try:
+                c.new_record(method, url, **kwargs)
+            except Exception as e:
+                log.exception(e)
+
+    def reset_stats(self):
+        with self._lock:
+            self._generation += 1
+            self._shards.clear()
+            self._retired = None
+            # The templates are reset too, so that the shards to come
+            # don't hold on to what the retired ones interned.
+            for c in self._collectors:
+                try:
+                    c.reset_stats()
+                except Exception as e:
+                    log.exception(e)
+
+    def get_stats(self, query=None):
+        if not query or "since" not in query:
+            return collate(self._merged(), query)
+        with self._lock:
+            self._version += 1
+            version = self._version
+            shards = self._live_shards()
+            for shard in shards:
+                for c in shard:
+                    c.checkpoint(version)
+            retired = self._retired
+        merged = self._merge(shards + ([retired] if retired else []))
+        if int(query["since"]) < self._retired_at:
+            query = dict(query, since=-1)
+        return collate_changes(merged, shards, query, version)
+
+    def snapshot(self):
+        return self._merged()
+
+    def restore(self, collectors):
+        # Restored records are kept as though a finished thread had
+        # recorded them.
+        with self._lock:
+            if self._retired is None:
+                self._retired = copy.deepcopy(self._collectors)
+            restore_into(self._retired, collectors)
+
+
+class ProcessLocal(object):
+    """
+    A mixin for the state which a collector and its copies share, and
+    which only works in the process that made it (such as a queue which
+    a thread drains). Copies (by `copy.deepcopy`, such as the shards of a
+    `ShardedStatsCollector`) are the object itself. A pickled object (such
+    as in a snapshot from a worker process) is unpickled as an inert one,
+    whose `live` is False, and which only holds its `counters` and what
+    `_inert_state` returns.
+    """
+
+    live = True
+    counters = ()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        state = {k: getattr(self, k) for k in self.counters}
+        state.update(self._inert_state())
+        state["live"] = False
+        return state
+
+    def _inert_state(self):
+        """Returns the state, besides the counters, of an inert copy."""
+        return {}
+
+    def merge_counters(self, other):
+        """Adds the counters of `other` into those of this inert copy."""
+        for k in self.counters:
+            setattr(self, k, getattr(self, k) + getattr(other, k))
+
+
+class ProcessThread(object):
+    """
+    A daemon thread which runs `target`, started by the first call to
+    `start` in each process. Threads don't survive a fork, so a forked
+    process starts a thread of its own, after calling `after_fork` to
+    replace the state it would otherwise share with its parent.
+    """
+
+    def __init__(self, target, name, after_fork=None):
+        self._target = target
+        self._name = name
+        self._after_fork = after_fork
+        self._lock = threading.Lock()
+        self._origin = os.getpid()
+        self._pid = None
+        self._thread = None
+
+    @property
+    def started(self):
+        return self._pid == os.getpid()
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            forked = self._pid is not None or self._origin != os.getpid()
+            if forked and self._after_fork is not None:
+                self._after_fork()
+            self._pid = os.getpid()
+            t = threading.Thread(target=self._target, name=self._name)
+            t.daemon = True
+            t.start()
+            self._thread = t
+
+    def join(self):
+        if self.started:
+            self._thread.join()
+
+
+class RecordRing(ProcessLocal):
+    """
+    A preallocated ring of `capacity` records, which any number of threads
+    put records into, and one thread takes them out of. Records are tuples
+    whose third item is the time at which the record was put.
+    """
+
+    counters = ("applied", "batches", "dropped")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._head = 0
+        self._tail = 0
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self.applied = 0
+        self.batches = 0
+        self.dropped = 0
+
+    def _inert_state(self):
+        return {"_pending": self.pending(), "_lag": self.lag()}
+
+    def pending(self):
+        """The number of records in the ring."""
+        return self._tail - self._head if self.live else self._pending
+
+    def lag(self):
+        """Seconds since the oldest record in the ring was put."""
+        if not self.live:
+            return self._lag
+        with self._lock:
+            if self._tail == self._head:
+                return 0.0
+            oldest = self._slots[self._head % self.capacity]
+        return max(0.0, time.time() - oldest[2])
+
+    def put(self, record, block=False):
+        """
+        Puts a record into the ring, and returns the number of records in
+        it. When the ring is full, the record is dropped (and 0 returned),
+        or the caller waits if `block`.
+        """
+        with self._lock:
+            while self._tail - self._head >= self.capacity:
+                if not block:
+                    self.dropped += 1
+                    return 0
+                self._not_full.wait()
+            self._slots[self._tail % self.capacity] = record
+            self._tail += 1
+            return self._tail - self._head
+
+    def take(self, n):
+        """Takes out up to `n` of the oldest records, in a list."""
+        with self._lock:
+            n = min(n, self._tail - self._head)
+            start = self._head % self.capacity
+            end = start + n
+            slots = self._slots
+            if end <= self.capacity:
+                batch = slots[start:end]
+                slots[start:end] = [None] * n
+            else:
+                end -= self.capacity
+                batch = slots[start:] + slots[:end]
+                slots[start:] = [None] * (self.capacity - start)
+                slots[:end] = [None] * end
+            self._head += n
+            if n:
+                self._not_full.notify_all()
+        return batch
+
+
+@traceable
+class BufferedStatsCollector(StatsCollector):
+    """
+    A StatsCollector which records by putting records into a preallocated
+    ring of `capacity` records, and returning. A consumer thread takes the
+    records out in batches of up to `batch` records, as soon as a batch is
+    full or every `interval` seconds, and adds each batch to the
+    collectors at once (see `BaseCollector.new_records`). When the ring is
+    full, records are dropped (and counted) with the `drop` policy, or the
+    recording thread waits with `block`. Unless `flush` is off, the
+    pending records are added before the stats are read.
+
+    Records only keep the keyword arguments which the collectors read
+    (see `BaseCollector.fields`), and copy the request's headers, so that
+    pending records don't keep whole requests alive.
+
+    The state of the ring is reported by a collector named `ingest`: the
+    records `pending` in it (its depth), the `lag-ms` of the oldest of
+    them, and the records `applied` (in `batches`) and `dropped`.
+    """
+
+    def __init__(self, name, *collectors, **kwargs):
+        capacity = kwargs.pop("capacity", 65536)
+        self._batch = kwargs.pop("batch", 1024)
+        self._interval = kwargs.pop("interval", 0.05)
+        self._block = kwargs.pop("policy", "drop") == "block"
+        self._flush = kwargs.pop("flush", True)
+        if kwargs:
+            raise TypeError("Unexpected arguments: {}".format(
+                ", ".join(sorted(kwargs))))
+        self._ingest = IngestCollector("ingest", RecordRing(capacity))
+        collectors = collectors + (self._ingest,)
+        super(BufferedStatsCollector, self).__init__(name, *collectors)
+        fields = set()
+        for c in collectors:
+            fields.update(getattr(c, "fields", ()))
+        fields.discard("ts")
+        self._fields = tuple(sorted(fields))
+        self._copy_headers = "headers" in fields
+        self._ready = threading.Event()
+        self._drain_lock = threading.Lock()
+        self._consumer = ProcessThread(self._run, "stubby-ingest",
+                                       self._after_fork)
+
+    def _after_fork(self):
+        # Forked workers get a ring of their own, so that records pending
+        # at the fork aren't added twice.
+        self._ingest.ring = RecordRing(self._ingest.ring.capacity)
+        self._ready = threading.Event()
+        self._drain_lock = threading.Lock()
+
+    def _run(self):
+        while True:
+            self._ready.wait(self._interval)
+            self._ready.clear()
+            self.flush()
+
+    def new_record(self, method, url, **kwargs):
+        self._consumer.start()
+        if self._copy_headers and kwargs.get("headers") is not None:
+            kwargs["headers"] = dict(kwargs["headers"])
+        record = (method, url, time.time(),
+                  tuple(map(kwargs.get, self._fields)))
+        pending = self._ingest.ring.put(record, self._block)
+        if pending == self._batch:
+            self._ready.set()
+
+    def flush(self):
+        """Adds all the pending records to the collectors."""
+        ring = self._ingest.ring
+        with self._drain_lock:
+            while True:
+                batch = ring.take(self._batch)
+                if not batch:
+                    return
+                fields = self._fields
+                batch = [(method, url, dict(zip(fields, values), ts=ts))
+                         for method, url, ts, values in batch]
+                with self._lock:
+                    for c in self._collectors:
+                        try:
+                            c.new_records(batch)
+                        except Exception as e:
+                            log.exception(e)
+                ring.applied += len(batch)
+                ring.batches += 1
+
+    def reset_stats(self):
+        self.flush()
+        super(BufferedStatsCollector, self).reset_stats()
+
+    def close(self):
+        self.flush()
+        super(BufferedStatsCollector, self).close()
+
+    def get_stats(self, query=None):
+        if self._flush:
+            self.flush()
+        return super(BufferedStatsCollector, self).get_stats(query)
+
+    def snapshot(self):
+        if self._flush:
+            self.flush()
+        return super(BufferedStatsCollector, self).snapshot()
+
+
+def merge_snapshots(snapshots):
+    """
+    Merges a sequence of snapshots (as returned by `StatsCollector.snapshot`)
+    collector by collector, and returns the merged snapshot.
+    """
+    merged = None
+    for snapshot in snapshots:
+        if merged is None:
+            merged = snapshot
+            continue
+        for into, other in zip(merged, snapshot):
+            into.merge(other)
+    return merged or []
+
+
+def restore_into(collectors, saved):
+    saved = {c.name: c for c in saved}
+    for c in collectors:
+        other = saved.get(c.name)
+        if other is None or type(other) is not type(c):
+            log.warning("No saved stats to restore for '{}'".format(c.name))
+            continue
+        c.merge(other)
+
+
+def selected(collector, query):
+    """
+    Whether the query selects the collector. A query may name collectors
+    (`collector=<name>[,<name>...]`), a kind of collector (`kind=`), or
+    ask for the collectors which track their changes (`tracked=`). A
+    point query for a `url` selects the collectors which answer them,
+    unless it names collectors or a kind.
+    """
+    if not query:
+        return True
+    names = query.get("collector")
+    if names and collector.name not in names.split(","):
+        return False
+    kind = query.get("kind")
+    if kind and getattr(collector, "kind", None) != kind:
+        return False
+    if query.get("url") and not names and not kind and \
+            not getattr(collector, "point_queries", False):
+        return False
+    if query.get("tracked") and not isinstance(collector, TrackedCollector):
+        return False
+    return True
+
+
+def select_counts(counter, query):
+    """
+    Returns the counts (as a dict) whose keys start with the query's
+    `prefix`, keeping only the `top` highest counts if asked to.
+    """
+    prefix = query.get("prefix") if query else None
+    top = query.get("top") if query else None
+    if not prefix and not top:
+        return dict(counter)
+    items = counter.items()
+    if prefix:
+        items = [kv for kv in items if kv[0].startswith(prefix)]
+    if top:
+        items = heapq.nlargest(int(top), items, key=itemgetter(1))
+    return dict(items)
+
+
+def select_methods(collector, query):
+    """Returns the (method, value) items selected by the query's `method`."""
+    method = query.get("method") if query else None
+    if not method:
+        return list(collector.items())
+    return [(method, collector[method])] if method in collector else []
+
+
+def collate(collectors, query=None):
+    """
+    Returns the stats of the collectors selected by the query, keyed on
+    their names.
+    """
+    result = {}
+    for c in collectors:
+        if not selected(c, query):
+            continue
+        try:
+            result[c.name] = c.get_stats(query)
+        except Exception as e:
+            log.exception(e)
+    return result
+
+
+def collate_changes(collectors, shards, query, version):
+    """
+    Returns only the stats which changed since the version in the query's
+    `since`, along with the new version. `shards` are the collectors (one
+    list per shard) which track the changes. Collectors which can't tell
+    what changed (because they don't track changes, were reset, or the
+    version is too old) report in full, and are listed under `full`.
+    """
+    since = int(query["since"])
+    stats, full = {}, []
+    for i, c in enumerate(collectors):
+        if not selected(c, query):
+            continue
+        changed = set() if 0 <= since < version else None
+        for shard in shards:
+            if changed is None:
+                break
+            keys = shard[i].changed_since(since)
+            if keys is None:
+                changed = None
+            else:
+                changed.update(keys)
+        try:
+            if changed is None:
+                full.append(c.name)
+                stats[c.name] = c.get_stats(query)
+            else:
+                stats[c.name] = c.get_changes(changed, query)
+        except Exception as e:
+            log.exception(e)
+    return {"version": version, "full": full, "stats": stats}
+
+
+@traceable
+class BaseCollector(CollectorContract):
+
+    kind = "counter"
+    # The keyword arguments of `new_record` which the collector reads.
+    fields = ()
+    # Whether `get_stats` answers for the `url` in a query.
+    point_queries = False
+
+    def __init__(self, name, normalizer=None):
+        """
+        Args:
+            name (str): The name under which the stats are reported.
+            normalizer (stubby.normalize.URLNormalizer): If given, URLs
+                are turned into templates before they are recorded.
+        """
         super(BaseCollector, self).__init__()
         self._name = name
+        self._normalizer = normalizer
 
     @property
     def name(self):
         return self._name
 
+    def _normalize(self, url):
+        if self._normalizer is None:
+            return url
+        return self._normalizer.normalize(url)
+
+    def _route(self, method, url):
+        """Returns the route of a request: its method and normalized path."""
+        url = self._normalize(url)
+        q = url.find("?")
+        return "{} {}".format(method, url[:q] if q >= 0 else url)
+
+    def new_records(self, records):
+        """
+        Adds a batch of records, each a tuple of (method, url, kwargs).
+        Collectors may override this to add a batch faster than one record
+        at a time.
+        """
+        new_record = self.new_record
+        for method, url, kwargs in records:
+            new_record(method, url, **kwargs)
+
+    def checkpoint(self, version):
+        """
+        Closes the set of keys changed since the last checkpoint, and
+        tags it with `version`. Collectors which track changes override
+        this along with `changed_since` and `get_changes`.
+        """
+
+    def changed_since(self, since):
+        """
+        Returns the keys changed after the checkpoint `since`, or None if
+        that isn't known.
+        """
+        return None
+
+    def get_changes(self, keys, query=None):
+        """Returns the stats of the given keys, shaped like `get_stats`."""
+        return self.get_stats(query)
+
+    def close(self):
+        """
+        Releases what the collector holds outside the process (such as
+        files), once no more records are added.
+        """
+
 
 @traceable
-class URLHitCollector(BaseCollector):
+class TrackedCollector(BaseCollector, TrackedCollectorContract):
+    """
+    A collector which tracks the keys changed between checkpoints, so
+    that it can report only the changed counters. Tracking starts with
+    the first checkpoint, and stops when the stats are reset. Up to
+    `history` checkpoints are kept.
+    """
 
-    def __init__(self, name):
-        super(URLHitCollector, self).__init__(name)
+    history = 64
+    _tracking = False
+
+    def checkpoint(self, version):
+        if not self._tracking:
+            self._tracked_from = version
+            self._checkpoints = collections.deque(maxlen=self.history)
+            self._dirty = set()
+            # Created here rather than in __init__, as locks can't be
+            # copied along with the collector (into shards or snapshots).
+            self._dirty_lock = threading.Lock()
+            self._tracking = True
+            return
+        # The collector may be recorded into by another thread (such as the
+        # one owning a shard). Swapping the set under the lock it's marked
+        # under makes sure no key is added to a set once it's filed.
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+        self._checkpoints.append((version, dirty))
+
+    def _mark(self, keys):
+        """Marks keys as changed since the last checkpoint."""
+        with self._dirty_lock:
+            self._dirty.update(keys)
+
+    def changed_since(self, since):
+        if not self._tracking or since < self._tracked_from:
+            return None
+        checkpoints = list(self._checkpoints)
+        if checkpoints and checkpoints[0][0] > since + 1:
+            return None
+        changed = set()
+        for version, keys in checkpoints:
+            if version > since:
+                changed.update(keys)
+        return changed
+
+    def _untrack(self):
+        self._tracking = False
+        self._checkpoints = self._dirty = None
+
+    def __getstate__(self):
+        # Copies (merged shards, snapshots) don't carry the tracking state.
+        state = dict(self.__dict__)
+        for key in ("_tracking", "_tracked_from", "_checkpoints", "_dirty",
+                    "_dirty_lock"):
+            state.pop(key, None)
+        return state
+
+
+class InternTable(object):
+    """
+    Maps strings to dense integer IDs, in the order they are first seen.
+    Collectors keep their counts in arrays indexed by these IDs. Copies of
+    a table (by `copy.deepcopy`) are the table itself, so a collector and
+    all its copies (such as the shards of a `ShardedStatsCollector`) store
+    each string once. IDs are never reused: the table only grows, until
+    the collector's stats are reset and it starts a new table.
+
+    A table which is pickled (such as in a snapshot from a worker process)
+    is unpickled as a table of its own, and counts indexed by its IDs are
+    merged by key.
+    """
+
+    def __init__(self, keys=()):
+        self._keys = list(keys)
+        self._ids = {k: i for i, k in enumerate(self._keys)}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def id(self, key):
+        """Returns the ID of a string, assigning it one if it has none."""
+        i = self._ids.get(key)
+        if i is None:
+            with self._lock:
+                i = self._ids.get(key)
+                if i is None:
+                    i = len(self._keys)
+                    # The key is listed before its ID is published, so a
+                    # published ID can always be looked up.
+                    self._keys.append(key)
+                    self._ids[key] = i
+        return i
+
+    def ids(self, keys):
+        """Returns the IDs of a sequence of strings, like `id`."""
+        ids = list(map(self._ids.get, keys))
+        if None in ids:
+            ids = [self.id(k) for k in keys]
+        return ids
+
+    def key(self, i):
+        """Returns the string with the ID `i`."""
+        return self._keys[i]
+
+    def counts(self, counts):
+        """
+        Returns a dict of the non-zero counts in an array of counts indexed
+        by IDs of this table, keyed on their strings.
+        """
+        return dict(compress(zip(self._keys, counts), counts))
+
+    def select(self, counts, query=None):
+        """
+        Returns the counts selected by the query, as `select_counts` would
+        from `counts(counts)`. The `prefix` and `top` are applied while the
+        table is walked, so a narrow query copies only what it returns.
+        """
+        prefix = query.get("prefix") if query else None
+        top = query.get("top") if query else None
+        if not prefix and not top:
+            return self.counts(counts)
+        items = zip(self._keys, counts)
+        if prefix:
+            items = ((k, n) for k, n in items if n and k.startswith(prefix))
+        else:
+            items = ((k, n) for k, n in items if n)
+        if top:
+            return dict(heapq.nlargest(int(top), items, key=itemgetter(1)))
+        return dict(items)
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        return {"keys": list(self._keys)}
+
+    def __setstate__(self, state):
+        self.__init__(state["keys"])
+
+
+def counts_array(n=0):
+    """Returns an array of `n` zero counts."""
+    return array("L", [0]) * n
+
+
+def grow(counts, n):
+    """Grows an array of counts to hold at least `n` counts."""
+    if len(counts) < n:
+        counts.extend(counts_array(n - len(counts)))
+
+
+def _numpy():
+    """Returns the numpy module, or None if it isn't installed."""
+    global _numpy_module
+    if _numpy_module is False:
+        try:
+            import numpy
+            _numpy_module = numpy
+        except ImportError:
+            _numpy_module = None
+    return _numpy_module
+
+
+_numpy_module = False
+
+
+def nonzero(counts):
+    """Returns the indices of the non-zero counts in an array."""
+    return list(compress(range(len(counts)), counts))
+
+
+def merge_counts(into, table, counts, counts_table):
+    """
+    Adds an array of counts indexed by the IDs of `counts_table` into the
+    array `into`, indexed by the IDs of `table`. If both are the same
+    table, the arrays are added element-wise (with NumPy, if it's
+    installed). Otherwise, the non-zero counts are added by key.
+    """
+    # An atomic copy, as the counts may be recorded into concurrently.
+    counts = array("L", counts)
+    if not counts:
+        return
+    if counts_table is table:
+        n = len(counts)
+        grow(into, n)
+        np = _numpy()
+        if np is not None:
+            np.frombuffer(into, "L")[:n] += np.frombuffer(counts, "L")
+        else:
+            into[:n] = array("L", map(add, into[:n], counts))
+        return
+    indices = nonzero(counts)
+    ids = [table.id(counts_table.key(i)) for i in indices]
+    grow(into, len(table))
+    for i, j in zip(indices, ids):
+        into[j] += counts[i]
+
+
+@traceable
+class URLHitCollector(TrackedCollector):
+    """
+    Counts hits per method and URL. URLs are interned in an `InternTable`,
+    and the counts of each method are kept in an array indexed by the IDs
+    of the URLs.
+    """
+
+    def __init__(self, name, normalizer=None):
+        super(URLHitCollector, self).__init__(name, normalizer)
+        self._table = InternTable()
         self._collector = dict()
 
-    def new_record(self, method, url):
-        if method not in self._collector:
-            self._collector[method] = collections.Counter()
-        self._collector[method].update([url])
+    def new_record(self, method, url, **kwargs):
+        url = self._normalize(url)
+        i = self._table.id(url)
+        counts = self._collector.get(method)
+        if counts is None:
+            counts = self._collector[method] = counts_array()
+        if i >= len(counts):
+            grow(counts, len(self._table))
+        counts[i] += 1
+        if self._tracking:
+            self._mark(((method, i),))
+
+    def new_records(self, records):
+        urls = collections.defaultdict(list)
+        for method, url, _ in records:
+            urls[method].append(self._normalize(url))
+        for method, batch in urls.items():
+            ids = collections.Counter(self._table.ids(batch))
+            counts = self._collector.get(method)
+            if counts is None:
+                counts = self._collector[method] = counts_array()
+            grow(counts, len(self._table))
+            for i, n in ids.items():
+                counts[i] += n
+            if self._tracking:
+                self._mark((method, i) for i in ids)
+
+    def merge(self, other):
+        for method, counts in list(other._collector.items()):
+            if method not in self._collector:
+                self._collector[method] = counts_array()
+            merge_counts(self._collector[method], self._table, counts,
+                         other._table)
 
     def reset_stats(self):
-        self._collector.clear()
+        self._table = InternTable()
+        self._collector = dict()
+        self._untrack()
+
+    def get_stats(self, query=None):
+        return {k: self._table.select(v, query)
+                for k, v in select_methods(self._collector, query)}
+
+    def apply_changes(self, changes, full=False):
+        if full:
+            self._collector.clear()
+        for method, counts in changes.items():
+            if method not in self._collector:
+                self._collector[method] = counts_array()
+            into = self._collector[method]
+            ids = [(self._table.id(url), n) for url, n in counts.items()]
+            grow(into, len(self._table))
+            for i, n in ids:
+                into[i] = n
 
-    def get_stats(self):
-        return {k: dict(v) for k, v in self._collector.items()}
+    def get_changes(self, keys, query=None):
+        changes = collections.defaultdict(dict)
+        key = self._table.key
+        for method, i in keys:
+            counts = self._collector.get(method)
+            if counts is not None:
+                changes[method][key(i)] = counts[i] if i < len(counts) else 0
+        return {k: select_counts(v, query)
+                for k, v in select_methods(changes, query)}
 
 
 @traceable
-class MethodHitCollector(BaseCollector):
+class MethodHitCollector(TrackedCollector):
 
     def __init__(self, name):
         super(MethodHitCollector, self).__init__(name)
         self._collector = collections.Counter()
 
-    def new_record(self, method, url):
+    def new_record(self, method, url, **kwargs):
         self._collector.update([method])
+        if self._tracking:
+            self._mark((method,))
+
+    def new_records(self, records):
+        methods = [r[0] for r in records]
+        self._collector.update(methods)
+        if self._tracking:
+            self._mark(methods)
+
+    def merge(self, other):
+        self._collector.update(dict(other._collector))
 
     def reset_stats(self):
         self._collector.clear()
+        self._untrack()
+
+    def get_stats(self, query=None):
+        return dict(select_methods(self._collector, query))
+
+    def get_changes(self, keys, query=None):
+        changes = {k: self._collector[k] for k in keys}
+        return dict(select_methods(changes, query))
 
-    def get_stats(self):
-        return dict(self._collector)
+    def apply_changes(self, changes, full=False):
+        if full:
+            self._collector.clear()
+        # Set the counters, rather than add to them.
+        dict.update(self._collector, changes)
 
 
 @traceable
-class WordHitCollector(BaseCollector):
+class WordHitCollector(TrackedCollector):
+    """
+    Counts hits per path segment (word). Words are interned in an
+    `InternTable`, and their counts are kept in an array indexed by the
+    IDs of the words.
+    """
 
-    def __init__(self, name):
-        super(WordHitCollector, self).__init__(name)
-        self._collector = collections.Counter()
+    def __init__(self, name, normalizer=None):
+        super(WordHitCollector, self).__init__(name, normalizer)
+        self._table = InternTable()
+        self._collector = counts_array()
 
-    def new_record(self, method, url):
+    def new_record(self, method, url, **kwargs):
+        url = self._normalize(url)
         q = url.find("?")
         path = url[:q] if q >= 0 else url
-        path = [s.strip() for s in path.split("/") if s.strip()]
-        self._collector.update(path)
+        ids = self._table.ids([s.strip() for s in path.split("/")
+                               if s.strip()])
+        counts = self._collector
+        if ids and max(ids) >= len(counts):
+            grow(counts, len(self._table))
+        for i in ids:
+            counts[i] += 1
+        if self._tracking:
+            self._mark(ids)
+
+    def new_records(self, records):
+        words = []
+        for _, url, _ in records:
+            url = self._normalize(url)
+            q = url.find("?")
+            path = url[:q] if q >= 0 else url
+            words.extend(s.strip() for s in path.split("/") if s.strip())
+        ids = collections.Counter(self._table.ids(words))
+        counts = self._collector
+        grow(counts, len(self._table))
+        for i, n in ids.items():
+            counts[i] += n
+        if self._tracking:
+            self._mark(ids)
+
+    def merge(self, other):
+        merge_counts(self._collector, self._table, other._collector,
+                     other._table)
+
+    def reset_stats(self):
+        self._table = InternTable()
+        self._collector = counts_array()
+        self._untrack()
+
+    def get_stats(self, query=None):
+        return self._table.select(self._collector, query)
+
+    def get_changes(self, keys, query=None):
+        key, counts = self._table.key, self._collector
+        changes = {key(i): counts[i] if i < len(counts) else 0 for i in keys}
+        return select_counts(changes, query)
+
+    def apply_changes(self, changes, full=False):
+        if full:
+            self._collector = counts_array()
+        # Set the counters, rather than add to them.
+        ids = [(self._table.id(word), n) for word, n in changes.items()]
+        grow(self._collector, len(self._table))
+        for i, n in ids:
+            self._collector[i] = n
+
+
+class SpaceSaving(object):
+    """
+    Tracks the most frequent keys of a stream in a fixed number of
+    counters, using the Space-Saving algorithm (Metwally et al.). Every
+    key whose true count exceeds N/capacity (N being the stream length) is
+    guaranteed to be tracked. The count reported for a key overestimates
+    its true count by at most its reported error.
+    """
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._counts = {}
+        # A min-heap of (count, key). Counts only grow, so entries are
+        # refreshed lazily when they surface at the top of the heap.
+        self._heap = []
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, key, n=1):
+        entry = self._counts.get(key)
+        if entry is not None:
+            entry[0] += n
+            return
+        if len(self._counts) < self._capacity:
+            self._counts[key] = [n, 0]
+            heapq.heappush(self._heap, (n, key))
+            return
+        heap = self._heap
+        while True:
+            count, victim = heap[0]
+            current = self._counts[victim][0]
+            if current == count:
+                break
+            heapq.heapreplace(heap, (current, victim))
+        del self._counts[victim]
+        self._counts[key] = [count + n, count]
+        heapq.heapreplace(heap, (count + n, key))
+
+    def floor(self):
+        """The count any untracked key may have had, at most."""
+        if len(self._counts) < self._capacity:
+            return 0
+        return min(c for c, _ in list(self._counts.values()))
+
+    def estimate(self, key):
+        """Returns the (count, error) of a key, as `items` reports them."""
+        entry = self._counts.get(key)
+        if entry is None:
+            floor = self.floor()
+            return floor, floor
+        return tuple(entry)
+
+    def items(self):
+        """Returns (key, count, error) tuples, highest count first."""
+        items = [(k, c, e) for k, (c, e) in list(self._counts.items())]
+        items.sort(key=lambda i: i[1], reverse=True)
+        return items
+
+    def merge(self, other):
+        """
+        Merges another summary into this one. A key missing from either
+        summary is assumed to have that summary's floor count, which
+        keeps the error bound of the merged summary.
+        """
+        mine, theirs = self.items(), other.items()
+        floor, other_floor = self.floor(), other.floor()
+        merged = {k: [c + other_floor, e + other_floor] for k, c, e in mine}
+        for k, c, e in theirs:
+            if k in merged:
+                merged[k][0] += c - other_floor
+                merged[k][1] += e - other_floor
+            else:
+                merged[k] = [c + floor, e + floor]
+        top = heapq.nlargest(self._capacity, merged.items(),
+                             key=lambda i: i[1][0])
+        self._counts = dict(top)
+        self._heap = [(c, k) for k, (c, _) in top]
+        heapq.heapify(self._heap)
+
+    def clear(self):
+        self._counts.clear()
+        del self._heap[:]
+
+
+class BoundedRoutes(object):
+    """
+    Values (such as histograms) kept per route, for the `max_routes`
+    busiest routes. Routes are ranked by a `SpaceSaving` summary of their
+    request counts, which follows `candidates` times as many routes. A
+    route whose count (less its error) overtakes the least busy route
+    with a value of its own takes its place, and the value of that route
+    is merged into the value of `<other>`, where every other route is
+    recorded. `factory` makes new values, which must support `merge`.
+    """
+
+    other = "<other>"
+    candidates = 4
+
+    def __init__(self, max_routes, factory):
+        self._max_routes = max_routes
+        self._factory = factory
+        self._counts = SpaceSaving(max(1, max_routes) * self.candidates)
+        # The least count of a route with a value of its own, at most.
+        self._floor = 0
+        self.values = dict()
+
+    def get(self, route, n=1):
+        """Counts `n` requests on a route, and returns its value."""
+        self._counts.add(route, n)
+        value = self.values.get(route)
+        if value is None:
+            value = self._admit(route)
+        return value
+
+    def _other(self):
+        value = self.values.get(self.other)
+        if value is None:
+            value = self.values[self.other] = self._factory()
+        return value
+
+    def _admit(self, route):
+        values = self.values
+        if not self._max_routes:
+            return self._other()
+        if len(values) - (self.other in values) < self._max_routes:
+            value = values[route] = self._factory()
+            return value
+        count, error = self._counts.estimate(route)
+        if count - error > self._floor:
+            # Counts only grow, so the floor is refreshed only when a
+            # route may have overtaken it.
+            estimate = self._counts.estimate
+            least, self._floor = min(
+                ((r, estimate(r)[0]) for r in values if r != self.other),
+                key=itemgetter(1))
+            if count - error > self._floor:
+                self._other().merge(values.pop(least))
+                value = values[route] = self._factory()
+                return value
+        return self._other()
+
+    def merge(self, other):
+        self._counts.merge(other._counts)
+        self._floor = 0
+        for route, value in list(other.values.items()):
+            if route == self.other:
+                mine = self._other()
+            else:
+                mine = self.values.get(route)
+                if mine is None:
+                    mine = self._admit(route)
+            mine.merge(value)
+
+    def clear(self):
+        self._counts.clear()
+        self._floor = 0
+        self.values.clear()
+
+    def items(self):
+        return list(self.values.items())
+
+
+@traceable
+class TopURLHitCollector(BaseCollector):
+    """
+    Counts hits on the `capacity` most frequent URLs of each HTTP method,
+    in constant memory. For each URL it reports the estimated count, and
+    the most by which that estimate may exceed the true count.
+    """
+
+    def __init__(self, name, capacity=1000, normalizer=None):
+        super(TopURLHitCollector, self).__init__(name, normalizer)
+        self._capacity = capacity
+        self._collector = dict()
+
+    def new_record(self, method, url, **kwargs):
+        url = self._normalize(url)
+        if method not in self._collector:
+            self._collector[method] = SpaceSaving(self._capacity)
+        self._collector[method].add(url)
+
+    def merge(self, other):
+        for method, summary in list(other._collector.items()):
+            if method not in self._collector:
+                self._collector[method] = SpaceSaving(self._capacity)
+            self._collector[method].merge(summary)
 
     def reset_stats(self):
         self._collector.clear()
 
-    def get_stats(self):
-        return dict(self._collector)
+    def get_stats(self, query=None):
+        prefix = query.get("prefix") if query else None
+        top = int(query.get("top") or 0) if query else 0
+        result = {}
+        for method, summary in select_methods(self._collector, query):
+            items = summary.items()
+            if prefix:
+                items = [i for i in items if i[0].startswith(prefix)]
+            if top:
+                items = items[:top]
+            result[method] = {url: {"count": c, "error": e}
+                              for url, c, e in items}
+        return result
+
+
+def _hash128(key):
+    """Returns two 64 bit hashes of a string, stable across processes."""
+    digest = hashlib.md5(key.encode("utf-8")).digest()
+    return struct.unpack("<QQ", digest)
+
+
+class CountMinSketch(object):
+    """
+    A Count-Min sketch of `depth` rows of `width` counters. A point query
+    never underestimates a key's count; with probability 1 - e^-depth it
+    overestimates by no more than e/width of the total count.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._table = array("L", [0]) * (width * depth)
+
+    def _cells(self, key):
+        h1, h2 = _hash128(key)
+        w = self.width
+        return [row * w + (h1 + row * h2) % w for row in range(self.depth)]
+
+    def add(self, key, n=1):
+        table = self._table
+        for cell in self._cells(key):
+            table[cell] += n
+        self.total += n
+
+    def estimate(self, key):
+        table = self._table
+        return min(table[cell] for cell in self._cells(key))
+
+    def error_bound(self):
+        return int(math.ceil(math.e / self.width * self.total))
+
+    def merge(self, other):
+        table = self._table
+        for i, n in enumerate(array("L", other._table)):
+            if n:
+                table[i] += n
+        self.total += other.total
+
+    def clear(self):
+        self._table = array("L", [0]) * (self.width * self.depth)
+        self.total = 0
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct keys added to it, with a standard
+    error of 1.04/sqrt(2^precision), in 2^precision bytes.
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self._m = 1 << precision
+        self._registers = bytearray(self._m)
+
+    def add(self, key):
+        self.add_hash(_hash128(key)[0])
+
+    def add_hash(self, h):
+        """Adds a key by its hash, the first of its `_hash128`."""
+        p = self.precision
+        index = h >> (64 - p)
+        rest = (h << p) & 0xFFFFFFFFFFFFFFFF
+        rank = min(64 - rest.bit_length(), 64 - p) + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def estimate(self):
+        m = self._m
+        registers = self._registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -r for r in registers)
+        zeros = registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            return int(round(m * math.log(float(m) / zeros)))
+        return int(round(raw))
+
+    def merge(self, other):
+        registers = bytes(other._registers)
+        self._registers = bytearray(
+            a if a >= b else b
+            for a, b in zip(bytearray(self._registers), bytearray(registers))
+        )
+
+    def clear(self):
+        self._registers = bytearray(self._m)
+
+
+@traceable
+class CountMinURLCollector(BaseCollector):
+    """
+    Estimates how many times each URL was hit, in a fixed-size Count-Min
+    sketch. The count of a URL is a point query: `get_stats` answers for
+    the `url` (and optionally `method`) in the query. Without a `url`,
+    it describes the sketch.
+    """
+
+    point_queries = True
+
+    def __init__(self, name, width=2048, depth=4, normalizer=None):
+        super(CountMinURLCollector, self).__init__(name, normalizer)
+        self._sketch = CountMinSketch(width, depth)
+        self._methods = set()
+
+    def new_record(self, method, url, **kwargs):
+        url = self._normalize(url)
+        self._methods.add(method)
+        self._sketch.add("{} {}".format(method, url))
+
+    def merge(self, other):
+        self._methods.update(list(other._methods))
+        self._sketch.merge(other._sketch)
+
+    def reset_stats(self):
+        self._sketch.clear()
+        self._methods.clear()
+
+    def get_stats(self, query=None):
+        sketch = self._sketch
+        url = (query or {}).get("url")
+        if url is None:
+            return {"width": sketch.width, "depth": sketch.depth,
+                    "total": sketch.total,
+                    "error-bound": sketch.error_bound()}
+        url = self._normalize(url)
+        method = query.get("method")
+        methods = [method] if method else sorted(self._methods)
+        return {"url": url, "error-bound": sketch.error_bound(),
+                "estimate": {m: sketch.estimate("{} {}".format(m, url))
+                             for m in methods}}
+
+
+@traceable
+class DistinctCollector(BaseCollector):
+    """
+    Estimates the number of distinct URLs per method, distinct paths,
+    distinct words, and distinct words at each of the first `depth` path
+    segments, using HyperLogLog counters of a fixed size.
+    """
+
+    def __init__(self, name, precision=12, depth=8, normalizer=None):
+        super(DistinctCollector, self).__init__(name, normalizer)
+        self._precision = precision
+        self._depth = depth
+        self._urls = dict()
+        self._paths = HyperLogLog(precision)
+        self._words = HyperLogLog(precision)
+        self._segments = [HyperLogLog(precision) for _ in range(depth)]
+        # The hashes of recent words, which repeat across URLs.
+        self._word_hashes = {}
+
+    def new_record(self, method, url, **kwargs):
+        url = self._normalize(url)
+        if method not in self._urls:
+            self._urls[method] = HyperLogLog(self._precision)
+        self._urls[method].add(url)
+        q = url.find("?")
+        path = url[:q] if q >= 0 else url
+        self._paths.add(path)
+        words = [s.strip() for s in path.split("/") if s.strip()]
+        hashes = self._word_hashes
+        for i, word in enumerate(words):
+            h = hashes.get(word)
+            if h is None:
+                if len(hashes) >= 4096:
+                    hashes.clear()
+                h = hashes[word] = _hash128(word)[0]
+            self._words.add_hash(h)
+            if i < self._depth:
+                self._segments[i].add_hash(h)
+
+    def merge(self, other):
+        for method, hll in list(other._urls.items()):
+            if method not in self._urls:
+                self._urls[method] = HyperLogLog(self._precision)
+            self._urls[method].merge(hll)
+        self._paths.merge(other._paths)
+        self._words.merge(other._words)
+        for mine, theirs in zip(self._segments, other._segments):
+            mine.merge(theirs)
+
+    def reset_stats(self):
+        self._urls.clear()
+        for hll in [self._paths, self._words] + self._segments:
+            hll.clear()
+
+    def get_stats(self, query=None):
+        return {
+            "urls": {m: h.estimate() for m, h in list(self._urls.items())},
+            "paths": self._paths.estimate(),
+            "words": self._words.estimate(),
+            "segments": {str(i + 1): h.estimate()
+                         for i, h in enumerate(self._segments)
+                         if any(h._registers)},
+        }
+
+
+class LogLinearHistogram(object):
+    """
+    An HDR-style histogram of non-negative integers in a fixed array. Each
+    power of two range is split into 2^(sub_bits - 1) linear buckets, so
+    a value is recorded with a relative error under 2^(1 - sub_bits).
+    Values beyond 2^max_bits are recorded in the last bucket.
+    """
+
+    def __init__(self, sub_bits=6, max_bits=40):
+        self._sub_bits = sub_bits
+        self._half = 1 << (sub_bits - 1)
+        self._max_shift = max_bits - sub_bits
+        self._counts = array("L", [0]) * (self._half * (self._max_shift + 2))
+        self.count = 0
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self._sub_bits
+        if shift <= 0:
+            return value
+        if shift > self._max_shift:
+            return len(self._counts) - 1
+        return shift * self._half + (value >> shift)
+
+    def _value(self, index):
+        """Returns the highest value recorded in a bucket."""
+        if index < 2 * self._half:
+            return index
+        if index == len(self._counts) - 1:
+            # The last bucket has no upper bound.
+            return self.max
+        shift = index // self._half - 1
+        return ((index - shift * self._half + 1) << shift) - 1
+
+    def add(self, value):
+        value = int(value)
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentiles(self, *ps):
+        """Returns the given percentiles, in a single pass."""
+        if not self.count:
+            return [0] * len(ps)
+        targets = sorted((max(1, int(math.ceil(p / 100.0 * self.count))), i)
+                         for i, p in enumerate(ps))
+        result = [self.max] * len(ps)
+        seen, t = 0, 0
+        for index, n in enumerate(self._counts):
+            if not n:
+                continue
+            seen += n
+            while t < len(targets) and seen >= targets[t][0]:
+                result[targets[t][1]] = min(self._value(index), self.max)
+                t += 1
+            if t == len(targets):
+                break
+        return result
+
+    def summary(self):
+        p50, p90, p99, p999 = self.percentiles(50, 90, 99, 99.9)
+        return {"count": self.count, "max": self.max, "p50": p50,
+                "p90": p90, "p99": p99, "p999": p999}
+
+    def merge(self, other):
+        counts = self._counts
+        for i, n in enumerate(array("L", other._counts)):
+            if n:
+                counts[i] += n
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def clear(self):
+        self._counts = array("L", [0]) * len(self._counts)
+        self.count = 0
+        self.max = 0
+
+
+class RequestHistograms(object):
+    """Service time and request size histograms for a group of requests."""
+
+    def __init__(self):
+        self.latency = LogLinearHistogram()
+        self.size = LogLinearHistogram()
+
+    def add(self, elapsed, size):
+        if elapsed is not None:
+            self.latency.add(elapsed * 1000000)
+        if size is not None:
+            self.size.add(size)
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        self.size.merge(other.size)
+
+    def summary(self):
+        return {"latency-us": self.latency.summary(),
+                "size-bytes": self.size.summary()}
+
+
+@traceable
+class HistogramCollector(BaseCollector):
+    """
+    Records the service time (in microseconds) and the `Content-Length`
+    (in bytes) of requests into log-linear histograms, per method and per
+    route. A route is the method and the (normalized) path of a request.
+    Memory is bounded: only the `max_routes` busiest routes get histograms
+    of their own, and the other routes are recorded under `<other>` (see
+    `BoundedRoutes`).
+    """
+
+    kind = "histogram"
+    fields = ("elapsed", "size")
+
+    def __init__(self, name, max_routes=100, normalizer=None):
+        super(HistogramCollector, self).__init__(name, normalizer)
+        self._methods = dict()
+        self._routes = BoundedRoutes(max_routes, RequestHistograms)
+
+    def new_record(self, method, url, elapsed=None, size=None, **kwargs):
+        if elapsed is None and size is None:
+            return
+        if method not in self._methods:
+            self._methods[method] = RequestHistograms()
+        self._methods[method].add(elapsed, size)
+        self._routes.get(self._route(method, url)).add(elapsed, size)
+
+    def merge(self, other):
+        for method, histograms in list(other._methods.items()):
+            if method not in self._methods:
+                self._methods[method] = RequestHistograms()
+            self._methods[method].merge(histograms)
+        self._routes.merge(other._routes)
+
+    def reset_stats(self):
+        self._methods.clear()
+        self._routes.clear()
+
+    def get_stats(self, query=None):
+        return {
+            "methods": {k: v.summary()
+                        for k, v in list(self._methods.items())},
+            "routes": {k: v.summary() for k, v in self._routes.items()},
+        }
+
+
+@traceable
+class FaultCollector(BaseCollector):
+    """
+    Counts, per response rule, the requests which matched the rule, and
+    those which were delayed, dropped or answered with an error by fault
+    injection (see `stubby.rules`). Injected delays (in microseconds) are
+    recorded into a histogram.
+    """
+
+    kind = "faults"
+    fields = ("rule", "fault", "delay")
+
+    def __init__(self, name):
+        super(FaultCollector, self).__init__(name)
+        self._rules = dict()
+
+    def new_record(self, method, url, rule=None, fault=None, delay=None,
+                   **kwargs):
+        if rule is None:
+            return
+        entry = self._rules.get(rule)
+        if entry is None:
+            entry = self._rules[rule] = FaultCounts()
+        entry.add(fault, delay)
+
+    def merge(self, other):
+        for rule, counts in list(other._rules.items()):
+            self._rules.setdefault(rule, FaultCounts()).merge(counts)
+
+    def reset_stats(self):
+        self._rules.clear()
+
+    def get_stats(self, query=None):
+        return {k: v.summary() for k, v in list(self._rules.items())}
+
+
+class FaultCounts(object):
+    """The requests matching a rule, and the faults injected into them."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.delay = LogLinearHistogram()
+
+    def add(self, fault, delay):
+        self.counts["requests"] += 1
+        if fault is not None:
+            self.counts[fault] += 1
+        if delay:
+            self.counts["delayed"] += 1
+            self.delay.add(int(delay * 1e6))
+
+    def merge(self, other):
+        self.counts.update(dict(other.counts))
+        self.delay.merge(other.delay)
+
+    def summary(self):
+        result = {"requests": 0, "delayed": 0, "drop": 0, "error": 0}
+        result.update(self.counts)
+        result["delay-us"] = self.delay.summary()
+        return result
+
+
+@traceable
+class BodyCollector(BaseCollector):
+    """
+    Records the sizes of request bodies read by the app (see `--body
+    stream`), per method: the requests with a body, their total bytes, and
+    a histogram of their sizes. When bodies are hashed (`--body-hash`), it
+    estimates the number of distinct bodies, and reports the `top` most
+    repeated bodies by hash, tracked with `capacity` counters.
+    """
+
+    kind = "body"
+    fields = ("body_size", "body_hash")
+
+    def __init__(self, name, capacity=1000, top=10, precision=12):
+        super(BodyCollector, self).__init__(name)
+        self._capacity = capacity
+        self._top = top
+        self._methods = dict()
+        self._hashes = SpaceSaving(capacity)
+        self._distinct = HyperLogLog(precision)
+
+    def new_record(self, method, url, body_size=None, body_hash=None,
+                   **kwargs):
+        if body_size is None:
+            return
+        sizes = self._methods.get(method)
+        if sizes is None:
+            sizes = self._methods[method] = BodySizes()
+        sizes.add(body_size)
+        if body_hash is not None:
+            self._hashes.add(body_hash)
+            self._distinct.add(body_hash)
+
+    def merge(self, other):
+        for method, sizes in list(other._methods.items()):
+            self._methods.setdefault(method, BodySizes()).merge(sizes)
+        self._hashes.merge(other._hashes)
+        self._distinct.merge(other._distinct)
+
+    def reset_stats(self):
+        self._methods.clear()
+        self._hashes.clear()
+        self._distinct.clear()
+
+    def get_stats(self, query=None):
+        top = int((query or {}).get("top") or self._top)
+        result = {"methods": {k: v.summary()
+                              for k, v in list(self._methods.items())}}
+        if len(self._hashes):
+            result["distinct"] = self._distinct.estimate()
+            result["repeated"] = {h: {"count": c, "error": e}
+                                  for h, c, e in self._hashes.items()[:top]
+                                  if c - e > 1}
+        return result
+
+
+class BodySizes(object):
+    """The number, total bytes and sizes of request bodies."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.size = LogLinearHistogram()
+
+    def add(self, size):
+        self.bytes += size
+        self.size.add(size)
+
+    def merge(self, other):
+        self.bytes += other.bytes
+        self.size.merge(other.size)
+
+    def summary(self):
+        return {"requests": self.size.count, "bytes": self.bytes,
+                "size-bytes": self.size.summary()}
+
+
+@traceable
+class QueryCollector(BaseCollector):
+    """
+    Counts the query parameters which requests carry. Per route (the
+    method and the normalized path), it counts the requests, and the
+    requests carrying each parameter. Per parameter, it counts each of its
+    values, and estimates the number of distinct values.
+
+    Memory is bounded: routes beyond the `max_routes` busiest (see
+    `BoundedRoutes`), parameters of a route beyond `max_keys`, and values
+    of a parameter beyond `max_values` are counted under `<other>`.
+    Parameters are tracked for at most `max_keys` keys overall. Query
+    strings are parsed by a `QueryParser`, which bounds their parameters,
+    and caches the results.
+    """
+
+    kind = "query"
+    fields = ("query",)
+    other = "<other>"
+
+    def __init__(self, name, max_routes=100, max_keys=50, max_values=100,
+                 precision=10, parser=None, normalizer=None):
+        super(QueryCollector, self).__init__(name, normalizer)
+        self._max_keys = max_keys
+        self._max_values = max_values
+        self._precision = precision
+        self._parser = parser if parser is not None else QueryParser()
+        self._routes = BoundedRoutes(max_routes,
+                                     functools.partial(RouteParams, max_keys))
+        self._keys = dict()
+
+    def new_record(self, method, url, query=None, **kwargs):
+        if query is None:
+            query = url.partition("?")[2]
+        params = self._parser.parse(query)
+        self._routes.get(self._route(method, url)).add(params)
+        for key, value in params:
+            values = self._keys.get(key)
+            if values is None:
+                if len(self._keys) >= self._max_keys:
+                    key = self.other
+                    values = self._keys.get(key)
+                if values is None:
+                    values = self._keys[key] = ParamValues(
+                        self._max_values, self._precision)
+            values.add(value)
+
+    def merge(self, other):
+        self._routes.merge(other._routes)
+        for key, values in list(other._keys.items()):
+            if key not in self._keys:
+                if len(self._keys) >= self._max_keys:
+                    key = self.other
+                self._keys.setdefault(key, ParamValues(self._max_values,
+                                                       self._precision))
+            self._keys[key].merge(values)
+
+    def reset_stats(self):
+        self._routes.clear()
+        self._keys.clear()
+
+    def get_stats(self, query=None):
+        return {
+            "routes": {k: v.summary() for k, v in self._routes.items()},
+            "keys": {k: v.summary() for k, v in list(self._keys.items())},
+        }
+
+
+class RouteParams(object):
+    """The requests of a route, and how many carried each parameter."""
+
+    other = "<other>"
+
+    def __init__(self, max_keys):
+        self._max_keys = max_keys
+        self.requests = 0
+        self.keys = collections.Counter()
+
+    def add(self, params):
+        self.requests += 1
+        keys = self.keys
+        for key in set(k for k, _ in params):
+            if key not in keys and len(keys) >= self._max_keys:
+                key = self.other
+            keys[key] += 1
+
+    def merge(self, other):
+        self.requests += other.requests
+        for key, n in list(other.keys.items()):
+            if key not in self.keys and len(self.keys) >= self._max_keys:
+                key = self.other
+            self.keys[key] += n
+
+    def summary(self):
+        return {"requests": self.requests, "keys": dict(self.keys)}
+
+
+class ParamValues(object):
+    """The counts of the values of a parameter, and of distinct values."""
+
+    other = "<other>"
+
+    def __init__(self, max_values, precision):
+        self._max_values = max_values
+        self.values = collections.Counter()
+        self.distinct = HyperLogLog(precision)
+
+    def add(self, value):
+        values = self.values
+        if value not in values:
+            # Values counted on their own were added to `distinct` before.
+            self.distinct.add(value)
+            if len(values) >= self._max_values:
+                value = self.other
+        values[value] += 1
+
+    def merge(self, other):
+        self.distinct.merge(other.distinct)
+        for value, n in list(other.values.items()):
+            if value not in self.values and \
+                    len(self.values) >= self._max_values:
+                value = self.other
+            self.values[value] += n
+
+    def summary(self):
+        return {"count": sum(self.values.values()),
+                "distinct": self.distinct.estimate(),
+                "values": dict(self.values)}
+
+
+@traceable
+class IngestCollector(BaseCollector):
+    """
+    Reports on the `RecordRing` of a `BufferedStatsCollector`: the records
+    `pending` in it, the `lag-ms` of the oldest of them, and the records
+    `applied` (in `batches`) and `dropped`.
+    """
+
+    kind = "ingest"
+
+    def __init__(self, name, ring):
+        super(IngestCollector, self).__init__(name)
+        self.ring = ring
+
+    def new_record(self, method, url, **kwargs):
+        pass
+
+    def new_records(self, records):
+        pass
+
+    def merge(self, other):
+        # Copies share the ring. Snapshots from other processes carry
+        # counters of their own, which add up.
+        mine, theirs = self.ring, other.ring
+        if mine is theirs or mine.live:
+            return
+        mine.merge_counters(theirs)
+        mine._pending += theirs.pending()
+        mine._lag = max(mine._lag, theirs.lag())
+
+    def reset_stats(self):
+        ring = self.ring
+        ring.applied = ring.batches = ring.dropped = 0
+
+    def get_stats(self, query=None):
+        ring = self.ring
+        return {"pending": ring.pending(),
+                "lag-ms": round(ring.lag() * 1000, 3),
+                "applied": ring.applied, "batches": ring.batches,
+                "dropped": ring.dropped}
+
+
+class RateRing(object):
+    """
+    Counts events in a ring of `slots` buckets, each `resolution` seconds
+    wide. The ring is preallocated; a bucket is zeroed when the ring wraps
+    around to it.
+    """
+
+    def __init__(self, slots=60, resolution=1):
+        self.slots = slots
+        self.resolution = resolution
+        self._counts = array("l", [0]) * slots
+        self._stamps = array("l", [-1]) * slots
+
+    def add(self, now, n=1):
+        stamp = int(now // self.resolution)
+        i = stamp % self.slots
+        if self._stamps[i] != stamp:
+            self._stamps[i] = stamp
+            self._counts[i] = 0
+        self._counts[i] += n
+
+    def history(self, now, n):
+        """Counts in the last `n` complete buckets, the latest first."""
+        current = int(now // self.resolution)
+        counts, stamps = self._counts, self._stamps
+        result = []
+        for stamp in range(current - 1, current - 1 - min(n, self.slots), -1):
+            i = stamp % self.slots
+            result.append(counts[i] if stamps[i] == stamp else 0)
+        return result
+
+    def rate(self, now, seconds):
+        """Events per second over the last complete `seconds`."""
+        n = max(1, seconds // self.resolution)
+        return sum(self.history(now, n)) / float(n * self.resolution)
+
+    def merge(self, other):
+        counts, stamps = array("l", other._counts), array("l", other._stamps)
+        for i in range(self.slots):
+            if stamps[i] == self._stamps[i]:
+                self._counts[i] += counts[i]
+            elif stamps[i] > self._stamps[i]:
+                self._stamps[i] = stamps[i]
+                self._counts[i] = counts[i]
+
+
+class Rates(object):
+    """Per-second and per-minute request counts of a group of requests."""
+
+    windows = (1, 10, 60)
+
+    def __init__(self):
+        self.seconds = RateRing(60, 1)
+        self.minutes = RateRing(60, 60)
+
+    def add(self, now, n=1):
+        self.seconds.add(now, n)
+        self.minutes.add(now, n)
+
+    def merge(self, other):
+        self.seconds.merge(other.seconds)
+        self.minutes.merge(other.minutes)
+
+    def summary(self, now, history):
+        result = {"{}s".format(w): round(self.seconds.rate(now, w), 3)
+                  for w in self.windows}
+        result["seconds"] = self.seconds.history(now, history)
+        result["minutes"] = self.minutes.history(now, history)
+        return result
+
+
+@traceable
+class RateCollector(BaseCollector):
+    """
+    Tracks request rates over sliding windows, per method and per route
+    (the method and the normalized path), in preallocated ring buffers.
+    Reports 1s, 10s and 60s rates (in requests per second), and the
+    request counts of the last `history` seconds and minutes. Only the
+    `max_routes` busiest routes are tracked on their own, and the other
+    routes under `<other>` (see `BoundedRoutes`).
+    """
+
+    kind = "rates"
+    fields = ("ts",)
+
+    def __init__(self, name, max_routes=20, history=10, normalizer=None):
+        super(RateCollector, self).__init__(name, normalizer)
+        self._max_routes = max_routes
+        self._history = history
+        self._total = Rates()
+        self._methods = dict()
+        self._routes = BoundedRoutes(max_routes, Rates)
+
+    def new_record(self, method, url, ts=None, **kwargs):
+        self._add(method, url, ts or time.time())
+
+    def new_records(self, records):
+        # Records are added once per method, route and second.
+        now = time.time()
+        seconds = collections.Counter(
+            (method, url, int(kwargs.get("ts") or now))
+            for method, url, kwargs in records)
+        for (method, url, second), n in seconds.items():
+            self._add(method, url, second, n)
+
+    def _add(self, method, url, now, n=1):
+        self._total.add(now, n)
+        rates = self._methods.get(method)
+        if rates is None:
+            rates = self._methods[method] = Rates()
+        rates.add(now, n)
+        if not self._max_routes:
+            return
+        self._routes.get(self._route(method, url), n).add(now, n)
+
+    def merge(self, other):
+        self._total.merge(other._total)
+        for method, rates in list(other._methods.items()):
+            if method not in self._methods:
+                self._methods[method] = Rates()
+            self._methods[method].merge(rates)
+        self._routes.merge(other._routes)
+
+    def reset_stats(self):
+        self._total = Rates()
+        self._methods.clear()
+        self._routes.clear()
+
+    def get_stats(self, query=None):
+        now = time.time()
+        n = self._history
+        return {
+            "total": self._total.summary(now, n),
+            "methods": {k: v.summary(now, n)
+                        for k, v in list(self._methods.items())},
+            "routes": {k: v.summary(now, n)
+                       for k, v in self._routes.items()},
+        }
@@ -0,0 +1,91 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Fixtures which assemble the application from `app-context.xml`, as `st`
+does, and send it requests in-process.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import io
+import os
+import sys
+import json
+
+import pytest
+
+from stubby.assembly import PlanAssembler, to_plan
+
+
+context_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, "app-context.xml")
+_plan = []
+
+
+def plan():
+    """Returns the assembly plan of `app-context.xml`, with a quiet logger."""
+    if not _plan:
+        from aglyph.context import XMLContext
+        p = to_plan(XMLContext(context_path))
+        # The application's logger would add handlers for every test.
+        p["st-logger"]["dotted_name"] = "stubby.logger.Logger"
+        _plan.append(p)
+    return json.loads(json.dumps(_plan[0]))
+
+
+class Client(object):
+    """Sends requests to an application, through its WSGI callable."""
+
+    def __init__(self, assembler):
+        self.assembler = assembler
+        self.app = assembler.assemble("st-app")
+        self.app.register_routes()
+
+    def request(self, path, method="GET", body=b"", headers=None):
+        """Returns the status code, headers and body of a response."""
+        path, _, query = path.partition("?")
+        environ = {
+            "REQUEST_METHOD": method, "PATH_INFO": path,
+            "QUERY_STRING": query, "SERVER_NAME": "localhost",
+            "SERVER_PORT": "8080", "SERVER_PROTOCOL": "HTTP/1.1",
+            "REMOTE_ADDR": "127.0.0.1", "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body), "wsgi.errors": sys.stderr,
+            "wsgi.url_scheme": "http", "wsgi.version": (1, 0),
+            "wsgi.multithread": True, "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in (headers or {}).items():
+            environ["HTTP_" + name.upper().replace("-", "_")] = value
+        started = []
+
+        def start_response(status, response_headers, exc_info=None):
+            started.append((int(status.split()[0]), dict(response_headers)))
+
+        result = self.app._wsgi(environ, start_response)
+        try:
+            data = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        status, response_headers = started[0]
+        return status, response_headers, data
+
+    def json(self, path):
+        status, _, data = self.request(path)
+        assert status == 200, data
+        return json.loads(data.decode("utf-8"))
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """
+    Returns a function which assembles the application with the given
+    command line arguments, and returns a `Client` of it.
+    """
+    def client(*argv):
+        monkeypatch.setattr(sys, "argv", ["st"] + list(argv))
+        return Client(PlanAssembler(plan()))
+    return client
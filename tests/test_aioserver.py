@@ -0,0 +1,126 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for the asyncio server, which serve a WSGI application from a
+thread of their own.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import socket
+import hashlib
+import threading
+
+import pytest
+
+aioserver = pytest.importorskip("stubby.aioserver")
+
+import http.client  # noqa: E402 (Python 3 only, as the server is)
+
+from stubby.body import read_body  # noqa: E402
+
+
+@pytest.fixture
+def serve():
+    """
+    Returns a function which starts serving a WSGI application, and
+    returns the port it's served on. The server is stopped after the test.
+    """
+    servers = []
+
+    def serve(app):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        # Connections wait in the backlog until the loop is running.
+        sock.listen(16)
+
+        def stoppable(environ, start_response):
+            if environ["PATH_INFO"] == "/stop":
+                # Called on the loop, as stubbed requests are. The loop
+                # stops once the connection is closed, after the response.
+                loop = aioserver.asyncio.get_event_loop()
+                loop.call_soon(loop.stop)
+                start_response("200 OK", [("Content-Length", "0")])
+                return []
+            return app(environ, start_response)
+
+        port = sock.getsockname()[1]
+        server = aioserver.AsyncioServer("127.0.0.1", port, sock=sock)
+        t = threading.Thread(target=server.run, args=(stoppable,))
+        t.start()
+        servers.append((port, t))
+        return port
+
+    yield serve
+    for port, t in servers:
+        request(port, "/stop", headers={"Connection": "close"})
+        t.join(10)
+
+
+def request(port, path, method="GET", body=None, headers=None):
+    """Returns the status code and body of a response."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def test_control_routes_do_not_block_the_loop(serve):
+    waiting, released = threading.Event(), threading.Event()
+
+    def app(environ, start_response):
+        if environ["PATH_INFO"].startswith("/_st/"):
+            # Waits on a stubbed request, which the loop must still serve.
+            waiting.set()
+            data = b"released" if released.wait(5) else b"timed out"
+        else:
+            released.set()
+            data = b"ok"
+        start_response("200 OK", [("Content-Length", str(len(data)))])
+        return [data]
+
+    port = serve(app)
+    result = []
+    t = threading.Thread(
+        target=lambda: result.append(request(port, "/_st/stats")))
+    t.start()
+    assert waiting.wait(5)
+    assert request(port, "/a") == (200, b"ok")
+    t.join()
+    assert result == [(200, b"released")]
+
+
+def test_streamed_bodies_are_read_as_they_arrive(serve):
+    def app(environ, start_response):
+        if environ["PATH_INFO"] == "/hash":
+            size, _, digest = read_body(environ, 4096, algorithm="sha1")
+            data = "{} {}".format(size, digest).encode("ascii")
+        else:
+            # Leaves the body unread, for the server to discard.
+            data = b"ok"
+        start_response("200 OK", [("Content-Length", str(len(data)))])
+        return [data]
+
+    port = serve(app)
+    chunks = [bytes(bytearray([i])) * 50000 for i in range(4)]
+    digest = hashlib.sha1(b"".join(chunks)).hexdigest()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        conn.request("POST", "/hash", iter(chunks), encode_chunked=True)
+        assert conn.getresponse().read() == \
+            "200000 {}".format(digest).encode("ascii")
+        # The same connection serves a larger body which isn't read, and
+        # the request after it.
+        conn.request("POST", "/ignore", b"x" * 200000)
+        assert conn.getresponse().read() == b"ok"
+        conn.request("POST", "/hash", b"abc")
+        assert conn.getresponse().read() == "3 {}".format(
+            hashlib.sha1(b"abc").hexdigest()).encode("ascii")
+    finally:
+        conn.close()
@@ -0,0 +1,134 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for the application assembled from `app-context.xml`, and for the
+paging of the stats sent as NDJSON.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import json
+
+import pytest
+
+from stubby.app import iter_ndjson, decode_cursor
+
+
+def page(stats, cursor=None, limit=None):
+    """Returns the rows of a page, and the cursor of the next one."""
+    text = b"".join(iter_ndjson(stats, cursor, limit)).decode("utf-8")
+    rows = [json.loads(line) for line in text.splitlines()]
+    if rows and "cursor" in rows[-1]:
+        return rows[:-1], decode_cursor(rows.pop()["cursor"])
+    return rows, None
+
+
+def pages_from(stats, cursor, limit):
+    """Returns the rows of the pages which follow the cursor."""
+    rows = []
+    while cursor is not None:
+        more, cursor = page(stats, cursor, limit)
+        rows.extend(more)
+    return rows
+
+
+def pages(stats, limit):
+    rows, cursor = page(stats, limit=limit)
+    return rows + pages_from(stats, cursor, limit)
+
+
+def build(n):
+    return {
+        "url-hits": {"GET": {"/u/{}".format(i): i for i in range(n)},
+                     "POST": {"/p": 1}},
+        "method-hits": {"GET": n, "POST": 1},
+        "rates": {"history": [1, 2, 3]},
+    }
+
+
+@pytest.mark.parametrize("limit", [1, 2, 7, 1000])
+def test_pages_cover_every_row_once(limit):
+    stats = build(25)
+    assert pages(stats, limit) == page(stats)[0]
+    assert len(page(stats)[0]) == 25 + 1 + 2 + 1
+
+
+def test_rows_are_sorted_by_keys():
+    rows, _ = page(build(3))
+    paths = [[r["collector"]] + r["keys"] for r in rows]
+    assert paths == sorted(paths)
+    assert {"collector": "rates", "keys": ["history"],
+            "value": [1, 2, 3]} in rows
+
+
+def test_keys_added_between_pages_are_not_skipped_or_repeated():
+    stats = build(10)
+    first, cursor = page(stats, limit=5)
+    stats["url-hits"]["GET"]["/a"] = 1
+    stats["url-hits"]["GET"]["/u/99"] = 1
+    rest = pages_from(stats, cursor, 5)
+    keys = [tuple([r["collector"]] + r["keys"]) for r in first + rest]
+    assert len(keys) == len(set(keys))
+    assert ("url-hits", "GET", "/u/99") in keys
+    # `/a` sorts before the rows already sent, so it shows up only once
+    # paging starts over.
+    assert ("url-hits", "GET", "/a") not in keys
+
+
+def test_removed_cursor_row_resumes_after_it():
+    stats = build(10)
+    first, cursor = page(stats, limit=5)
+    assert first[-1]["keys"] == ["GET", "/u/1"]
+    del stats["url-hits"]["GET"]["/u/1"]
+    rest = pages_from(stats, cursor, 3)
+    assert first + rest == page(build(10))[0]
+
+
+def test_empty_stats_and_limit_on_the_last_row():
+    assert page({}) == ([], None)
+    stats = {"method-hits": {"GET": 1, "POST": 2}}
+    rows, cursor = page(stats, limit=2)
+    assert len(rows) == 2 and cursor is None
+
+
+@pytest.mark.parametrize("cursor", ["-1", "0", "e30=", "WzFd", "%%%"])
+def test_invalid_cursors_are_rejected(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_url_counts_stay_bounded(client):
+    c = client()
+    for i in range(2500):
+        c.request("/items?id={}".format(i))
+    for _ in range(50):
+        c.request("/hot")
+    stats = c.json("/_st/stats")
+    assert "url-hits" not in stats
+    urls = stats["top-url-hits"]["GET"]
+    assert len(urls) == 1000
+    assert urls["/hot"]["count"] - urls["/hot"]["error"] <= 50 <= \
+        urls["/hot"]["count"]
+    _, _, metrics = c.request("/metrics")
+    assert b'stubby_url_requests_total{method="GET",url="/hot"}' in metrics
+
+
+def test_url_point_query_and_distinct_counts(client):
+    c = client()
+    for i in range(30):
+        c.request("/users/{}".format(i % 10), method="GET")
+    c.request("/users/1", method="POST")
+    stats = c.json("/_st/stats?url=/users/1")
+    assert list(stats) == ["cms-url-hits"]
+    estimate = stats["cms-url-hits"]["estimate"]
+    assert 3 <= estimate["GET"] <= 3 + stats["cms-url-hits"]["error-bound"]
+    assert estimate["POST"] >= 1
+    stats = c.json("/_st/stats?url=/users/1&method=POST")
+    assert list(stats["cms-url-hits"]["estimate"]) == ["POST"]
+    distinct = c.json("/_st/stats?collector=distinct")["distinct"]
+    assert distinct["urls"] == {"GET": 10, "POST": 1}
+    assert distinct["paths"] == 10
+    assert distinct["segments"] == {"1": 1, "2": 10}
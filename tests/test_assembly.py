@@ -0,0 +1,33 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for assembling the application from a cached plan.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import shutil
+
+from stubby.assembly import PlanAssembler, get_assembler, cache_path
+
+from .conftest import context_path
+
+
+def test_cached_plan_is_used_while_the_context_is_unchanged(tmpdir):
+    path = str(tmpdir.join("app-context.xml"))
+    shutil.copy(context_path, path)
+    assert not isinstance(get_assembler(path), PlanAssembler)
+    assert os.path.exists(cache_path(path))
+    assembler = get_assembler(path)
+    assert isinstance(assembler, PlanAssembler)
+    assert type(assembler.assemble("st-urlhits")).__name__ == \
+        "URLHitCollector"
+
+    with open(path, "a") as f:
+        f.write("<!-- changed -->\n")
+    assert not isinstance(get_assembler(path), PlanAssembler)
+    assert isinstance(get_assembler(path), PlanAssembler)
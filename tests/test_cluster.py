@@ -0,0 +1,53 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for the stats of the pre-fork multi-process mode.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import shutil
+import socket
+import threading
+
+import pytest
+
+from stubby.stats import StatsCollector, URLHitCollector, MethodHitCollector
+
+if not hasattr(socket, "AF_UNIX"):
+    pytest.skip("Control sockets are Unix sockets", allow_module_level=True)
+
+from stubby.cluster import Cluster, ControlServer, ControlHandler  # noqa
+
+
+def build():
+    return StatsCollector("stats", URLHitCollector("url-hits"),
+                          MethodHitCollector("method-hits"))
+
+
+def test_stats_are_merged_across_workers():
+    cluster = Cluster(2, build())
+    servers = []
+    try:
+        # The control servers of two workers, as they'd run after a fork.
+        for index, urls in enumerate([["/a", "/b"], ["/a", "/c"]]):
+            stats = build()
+            for url in urls:
+                stats.new_record("GET", url)
+            control = ControlServer(cluster._address(index), ControlHandler)
+            control.stats_collector = stats
+            threading.Thread(target=control.serve_forever,
+                             args=(0.01,)).start()
+            servers.append(control)
+        assert cluster.get_stats() == {
+            "url-hits": {"GET": {"/a": 2, "/b": 1, "/c": 1}},
+            "method-hits": {"GET": 4},
+        }
+    finally:
+        for control in servers:
+            control.shutdown()
+            control.server_close()
+        shutil.rmtree(cluster._dir)
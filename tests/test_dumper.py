@@ -0,0 +1,56 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for dumping the stats on request.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import gzip
+import json
+import time
+import argparse
+import threading
+
+from stubby.dumper import StatsDumper
+
+
+class Config(object):
+
+    def __init__(self, path):
+        self._config = argparse.Namespace(dump=path)
+
+    def get_config(self):
+        return self._config
+
+
+def test_requests_while_a_dump_is_pending_are_coalesced(tmpdir):
+    path = str(tmpdir.join("stats.json.gz"))
+    dumper = StatsDumper(Config(path))
+    dumping, release = threading.Event(), threading.Event()
+    calls = []
+
+    def get_stats():
+        calls.append(None)
+        dumping.set()
+        release.wait(5)
+        return {"method-hits": {"GET": len(calls)}}
+
+    dumper.start(get_stats)
+    dumper.request()
+    assert dumping.wait(5)
+    # One more dump is pending while the first is taken.
+    dumper.request()
+    dumper.request()
+    release.set()
+    for _ in range(500):
+        if dumper.dumps == 2:
+            break
+        time.sleep(0.01)
+    assert (dumper.dumps, dumper.coalesced) == (2, 1)
+    with gzip.open(path, "rb") as f:
+        assert json.loads(f.read().decode("utf-8")) == \
+            {"method-hits": {"GET": 2}}
@@ -0,0 +1,38 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for the request journal.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import gzip
+import json
+
+
+def test_requests_are_journaled(client, tmpdir):
+    path = str(tmpdir.join("journal.ndjson"))
+    c = client("--journal", path, "--capture-body", "64")
+    c.request("/orders/7?x=1", method="POST", body=b'{"n": 1}',
+              headers={"X-Trace": "abc"})
+    stats = c.assembler.assemble("st-stats")
+    stats.close()
+    # st-journal compresses with gzip.
+    with gzip.open(path + ".gz", "rt") as f:
+        record, = [json.loads(line) for line in f]
+    assert record["method"] == "POST"
+    assert record["path"] == "/orders/7"
+    assert record["query"] == "x=1"
+    assert record["headers"]["X-Trace"] == "abc"
+    assert record["body"] == '{"n": 1}'
+    assert stats.get_stats({"collector": "journal"})["journal"] == {
+        "written": 1, "dropped": 0, "queued": 0, "rotated": 0}
+
+
+def test_nothing_is_journaled_without_a_path(client):
+    c = client()
+    c.request("/a")
+    assert c.json("/_st/stats?collector=journal") == {"journal": {}}
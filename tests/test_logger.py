@@ -0,0 +1,36 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for the queue based logging.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import logging
+
+from six.moves import queue
+
+from stubby.logger import DroppingQueueHandler
+
+
+def test_records_beyond_the_queue_are_dropped_and_reported():
+    records = queue.Queue(maxsize=2)
+    handler = DroppingQueueHandler(records)
+    logger = logging.getLogger("stubby.tests.logger")
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for i in range(5):
+            logger.warning("record %d", i)
+        assert handler.dropped == 3
+        assert [records.get_nowait().msg for _ in range(2)] == \
+            ["record 0", "record 1"]
+        logger.warning("record %d", 5)
+    finally:
+        logger.removeHandler(handler)
+    assert [records.get_nowait().msg for _ in range(2)] == \
+        ["Dropped 3 log records", "record 5"]
+    assert handler.dropped == 3
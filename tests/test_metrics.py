@@ -0,0 +1,37 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for the OpenMetrics exposition.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+from stubby.metrics import MetricsRenderer
+from stubby.stats import StatsCollector, URLHitCollector, MethodHitCollector
+from stubby.stats import WordHitCollector
+
+
+def test_scrapes_render_the_changed_counters():
+    stats = StatsCollector("stats", URLHitCollector("url-hits"),
+                           MethodHitCollector("method-hits"),
+                           WordHitCollector("word-hits"))
+    metrics = MetricsRenderer(max_series=2)
+    stats.new_record("GET", "/a")
+    stats.new_record("GET", "/b")
+    first = metrics.render(stats.get_stats)
+    assert 'stubby_url_requests_total{method="GET",url="/a"} 1\n' in first
+    assert first.endswith("# EOF\n")
+
+    stats.new_record("GET", "/a")
+    stats.new_record("POST", "/c")
+    stats.new_record("POST", "/d")
+    lines = metrics.render(stats.get_stats).splitlines()
+    assert 'stubby_requests_total{method="GET"} 3' in lines
+    assert 'stubby_url_requests_total{method="GET",url="/a"} 2' in lines
+    assert 'stubby_url_requests_total{method="GET",url="/b"} 1' in lines
+    # URLs beyond `max_series` are summed into `<other>`.
+    assert 'stubby_url_requests_total{method="POST",url="<other>"} 2' \
+        in lines
@@ -0,0 +1,30 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for the URL normalizer.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import pytest
+
+from stubby.normalize import URLNormalizer
+
+
+@pytest.mark.parametrize("url, template", [
+    ("/users/1234/orders/98765", "/users/{id}/orders/{id}"),
+    ("/items/123e4567-e89b-12d3-a456-426614174000",
+     "/items/{uuid}"),
+    ("/blobs/0123456789abcdef0123", "/blobs/{hash}"),
+    ("/users/v2/x1", "/users/v2/x1"),
+    ("/users/alice?b=2&a=1", "/users/{user}?a=1&b=2"),
+])
+def test_urls_are_templated(url, template):
+    normalizer = URLNormalizer({"alice|bob": "{user}"}, query="sort",
+                               cache_size=2)
+    assert normalizer.normalize(url) == template
+    # Once more, as memoized.
+    assert normalizer.normalize(url) == template
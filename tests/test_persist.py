@@ -0,0 +1,124 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for persisting the stats to a snapshot and a delta log.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import argparse
+
+import pytest
+
+from stubby.persist import StatsPersister, read_deltas
+from stubby.stats import StatsCollector, URLHitCollector
+from stubby.stats import MethodHitCollector, WordHitCollector
+from stubby.stats import HistogramCollector
+
+
+class Config(object):
+
+    def __init__(self, path):
+        self._config = argparse.Namespace(persist=path,
+                                          persist_interval=3600)
+
+    def get_config(self):
+        return self._config
+
+
+def build():
+    return StatsCollector("stats", URLHitCollector("url-hits"),
+                          MethodHitCollector("method-hits"),
+                          WordHitCollector("word-hits"),
+                          HistogramCollector("histograms"))
+
+
+def record(stats, urls):
+    for url in urls:
+        stats.new_record("GET", url, elapsed=0.001, size=1)
+
+
+def crash(persister):
+    """Stops the persister without the snapshot of a clean stop."""
+    persister._stop.set()
+    persister._thread.join()
+
+
+def restored(path):
+    """Returns the stats restored on startup."""
+    stats = build()
+    persister = StatsPersister(Config(path), stats)
+    persister.start()
+    crash(persister)
+    return stats
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join("stats"))
+
+
+def test_deltas_are_replayed_on_the_snapshot(path):
+    stats = build()
+    persister = StatsPersister(Config(path), stats)
+    record(stats, ["/a/b", "/a/c"])
+    persister.start()
+    record(stats, ["/a/b", "/d"])
+    persister._append()
+    record(stats, ["/a/b", "/e/f"])
+    persister._append()
+    crash(persister)
+    assert len(list(read_deltas(path + ".log"))) == 2
+
+    back = restored(path).get_stats()
+    expected = stats.get_stats()
+    for name in ("url-hits", "method-hits", "word-hits"):
+        assert back[name] == expected[name]
+    # Untracked collectors are restored as of the snapshot.
+    assert back["histograms"]["methods"]["GET"]["latency-us"]["count"] == 2
+
+
+def test_reset_between_deltas_is_replayed(path):
+    stats = build()
+    persister = StatsPersister(Config(path), stats)
+    persister.start()
+    record(stats, ["/a", "/b"])
+    persister._append()
+    stats.reset_stats()
+    record(stats, ["/c"])
+    persister._append()
+    crash(persister)
+    back = restored(path).get_stats()
+    assert back["url-hits"] == {"GET": {"/c": 1}}
+    assert back["method-hits"] == {"GET": 1}
+
+
+def test_partial_delta_is_ignored(path):
+    stats = build()
+    persister = StatsPersister(Config(path), stats)
+    persister.start()
+    record(stats, ["/a"])
+    persister._append()
+    record(stats, ["/b"])
+    persister._append()
+    crash(persister)
+    log = path + ".log"
+    os.truncate(log, os.path.getsize(log) - 3)
+    back = restored(path).get_stats()
+    assert back["url-hits"] == {"GET": {"/a": 1}}
+
+
+def test_snapshot_starts_a_new_log(path):
+    stats = build()
+    persister = StatsPersister(Config(path), stats)
+    persister.start()
+    record(stats, ["/a"])
+    persister._append()
+    persister.stop()
+    assert os.path.getsize(path + ".log") == 0
+    assert not os.path.exists(path + ".tmp")
+    assert restored(path).get_stats()["url-hits"] == {"GET": {"/a": 1}}
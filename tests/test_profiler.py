@@ -0,0 +1,78 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for profiling a running Stubby.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import time
+import pstats
+import argparse
+import threading
+
+from stubby.profiler import Profiler
+
+
+class Config(object):
+
+    def __init__(self, path):
+        self._config = argparse.Namespace(profile_dir=path)
+
+    def get_config(self):
+        return self._config
+
+
+def finished(profiler):
+    """Waits for the profile to finish, and returns its status."""
+    for _ in range(500):
+        status = profiler.status()
+        if not status["running"]:
+            return status
+        time.sleep(0.01)
+    raise AssertionError("The profile didn't finish")
+
+
+def test_cprofile_profiles_concurrent_requests(tmpdir):
+    profiler = Profiler(Config(str(tmpdir)))
+    both = threading.Barrier(2, timeout=5)
+
+    def app(environ, start_response):
+        # Both requests are in flight at once.
+        both.wait()
+        return [b"ok"]
+
+    profiler.start(0.5, "cprofile")
+    time.sleep(0.1)
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(profiler.call(app, {}, None)))
+        for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [[b"ok"], [b"ok"]]
+    status = finished(profiler)
+    assert "error" not in status, status
+    functions = [func for _, _, func in pstats.Stats(status["path"]).stats]
+    assert functions.count("app") == 1
+
+
+def test_profiles_are_started_and_shown_on_the_endpoint(client, tmpdir):
+    c = client("--profile-dir", str(tmpdir))
+    assert c.json("/_st/profile") == {"running": False}
+    assert c.request("/_st/profile?seconds=0")[0] == 400
+    assert c.request("/_st/profile?mode=other")[0] == 400
+    status = c.json("/_st/profile?seconds=0.2&mode=sample")
+    assert status["running"] and status["mode"] == "sample"
+    assert c.request("/_st/profile?seconds=1")[0] == 409
+    status = finished(c.assembler.assemble("st-profiler"))
+    assert status["samples"] > 0
+    assert status["path"] == c.json("/_st/profile")["path"]
+    assert os.path.dirname(status["path"]) == str(tmpdir)
+    assert os.path.exists(status["path"])
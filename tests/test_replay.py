@@ -0,0 +1,41 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for replaying request journals.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import gzip
+import json
+import binascii
+
+from stubby.replay import load_journal
+
+
+def test_journal_is_loaded_up_to_a_cut(tmpdir):
+    path = str(tmpdir.join("journal.ndjson.gz"))
+    records = [
+        {"method": "POST", "path": "/orders", "query": "x=1",
+         "headers": {"Host": "a", "X-Trace": "abc"},
+         "body": "AAE=", "body-encoding": "base64"},
+        {"method": "GET", "path": "/_st/stats", "query": ""},
+        {"method": "GET", "path": "/items/7", "query": ""},
+    ]
+    with gzip.open(path, "wb") as f:
+        for record in records:
+            f.write(json.dumps(record).encode("utf-8") + b"\n")
+        # A record to be cut short, as by a worker which was stopped.
+        body = binascii.hexlify(os.urandom(4096)).decode("ascii")
+        f.write(json.dumps({"method": "PUT", "path": "/cut", "query": "",
+                            "body": body}).encode("utf-8") + b"\n")
+    with open(path, "rb+") as f:
+        f.truncate(os.path.getsize(path) - 1024)
+    assert load_journal([path]) == [
+        ("POST", "/orders?x=1", b"\x00\x01", {"X-Trace": "abc"}),
+        ("GET", "/items/7", None, {}),
+    ]
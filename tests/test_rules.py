@@ -0,0 +1,39 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for the response rules.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import shutil
+
+from .conftest import context_path
+
+
+def test_requests_are_answered_by_the_first_matching_rule(client, tmpdir,
+                                                          monkeypatch):
+    example = os.path.join(os.path.dirname(context_path),
+                           "rules.example.json")
+    shutil.copy(example, str(tmpdir.join("rules.json")))
+    # `st-rules` reads `rules.json` from the working directory.
+    monkeypatch.chdir(str(tmpdir))
+    c = client()
+    key = {"X-Api-Key": "k"}
+
+    def answer(path, headers=None):
+        status, _, data = c.request(path, headers=headers)
+        return status, data
+
+    assert answer("/health") == (200, b'{"status": "ok"}')
+    assert answer("/admin/logs?debug=1", key) == \
+        (403, b"debugging is not allowed")
+    assert answer("/admin/logs", key) == (200, b"welcome")
+    assert answer("/admin/logs") == (401, b"")
+    assert answer("/other") == (200, b"")
+    assert c.json("/_st/stats?collector=method-hits") == \
+        {"method-hits": {"GET": 5}}
@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for the threaded server, which serve a WSGI application from a
+thread of their own.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import time
+import threading
+
+import pytest
+
+from six.moves import http_client
+
+from stubby.server import PooledWSGIServer, KeepAliveRequestHandler
+
+
+@pytest.fixture
+def serve():
+    """
+    Returns a function which starts serving a WSGI application on a pool
+    of `threads` workers, and returns the port it's served on.
+    """
+    servers = []
+
+    def serve(app, threads=1):
+        server = PooledWSGIServer(("127.0.0.1", 0), KeepAliveRequestHandler,
+                                  threads=threads)
+        server.set_app(app)
+        t = threading.Thread(target=server.serve_forever, args=(0.01,))
+        t.start()
+        servers.append((server, t))
+        return server.server_port
+
+    yield serve
+    for server, t in servers:
+        server.shutdown()
+        server.server_close()
+        t.join()
+
+
+def request(port, path):
+    """Returns the status code and body of a response."""
+    conn = http_client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def app(environ, start_response):
+    path = environ["PATH_INFO"]
+    if path == "/slow":
+        environ["stubby.delay"] = 0.5
+    elif path == "/drop":
+        environ["stubby.drop"] = True
+    start_response("200 OK", [("Content-Length", str(len(path)))])
+    return [path.encode("ascii")]
+
+
+def test_delays_and_drops_do_not_hold_a_worker(serve):
+    port = serve(app, threads=1)
+    slow = []
+    t = threading.Thread(target=lambda: slow.append(request(port, "/slow")))
+    start = time.time()
+    t.start()
+    time.sleep(0.1)
+    # The only worker is free while the slow response waits.
+    assert request(port, "/fast") == (200, b"/fast")
+    assert time.time() - start < 0.4
+    with pytest.raises((http_client.HTTPException, IOError)):
+        request(port, "/drop")
+    t.join()
+    assert slow == [(200, b"/slow")]
+    assert time.time() - start >= 0.5
+
+
+def test_idle_connections_do_not_hold_a_worker(serve):
+    port = serve(app, threads=1)
+    idle = http_client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        idle.request("GET", "/a")
+        assert idle.getresponse().read() == b"/a"
+        sock = idle.sock
+        # The only worker serves other connections while this one idles.
+        assert request(port, "/b") == (200, b"/b")
+        idle.request("GET", "/c")
+        assert idle.getresponse().read() == b"/c"
+        assert idle.sock is sock
+    finally:
+        idle.close()
@@ -0,0 +1,345 @@
+# -*- coding: UTF-8 -*-
+
+"""
+
+Tests for the stats collectors.
+
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import gc
+import random
+import pickle
+import weakref
+import threading
+
+import pytest
+
+from stubby.stats import StatsCollector, ShardedStatsCollector
+from stubby.stats import BufferedStatsCollector, merge_snapshots
+from stubby.stats import HistogramCollector, MethodHitCollector
+from stubby.stats import RateCollector, QueryCollector
+from stubby.stats import URLHitCollector, WordHitCollector
+from stubby.stats import BaseCollector, TrackedCollector, select_counts
+from stubby.stats import SpaceSaving, CountMinSketch, HyperLogLog
+from stubby.stats import LogLinearHistogram
+
+
+def build(cls):
+    return cls("stats", URLHitCollector("url-hits"),
+               WordHitCollector("word-hits"))
+
+
+def record_unique(stats, n):
+    for i in range(n):
+        stats.new_record("GET", "/items/{}/detail-{}".format(i, i))
+
+
+@pytest.mark.parametrize("cls", [StatsCollector, ShardedStatsCollector])
+def test_reset_frees_interned_urls(cls):
+    tracemalloc = pytest.importorskip("tracemalloc")
+    stats = build(cls)
+    # Record once first, so that lazily created state is not counted.
+    record_unique(stats, 1)
+    stats.get_stats()
+    stats.reset_stats()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        # Recorded from a thread which finishes, as shards are per thread.
+        t = threading.Thread(target=record_unique, args=(stats, 20000))
+        t.start()
+        t.join()
+        stats.get_stats()
+        grown = tracemalloc.get_traced_memory()[0] - baseline
+        stats.reset_stats()
+        gc.collect()
+        kept = tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+    assert grown > 1000000
+    assert kept < grown / 20, (grown, kept)
+    assert stats.get_stats() == {"url-hits": {}, "word-hits": {}}
+
+
+def test_counts_after_reset():
+    stats = build(StatsCollector)
+    stats.new_record("GET", "/a/b")
+    stats.reset_stats()
+    stats.new_record("GET", "/b/c")
+    stats.new_record("POST", "/b/c")
+    assert stats.get_stats() == {
+        "url-hits": {"GET": {"/b/c": 1}, "POST": {"/b/c": 1}},
+        "word-hits": {"b": 2, "c": 2},
+    }
+
+
+@pytest.mark.parametrize("query", [None, {"prefix": "/items/1"},
+                                   {"top": "5"},
+                                   {"prefix": "/items/2", "top": "3"},
+                                   {"prefix": "/none"}])
+def test_narrow_queries_select_like_the_full_counts(query):
+    stats = URLHitCollector("url-hits")
+    for i in range(300):
+        for _ in range(i % 7):
+            stats.new_record("GET", "/items/{}".format(i))
+    counts = stats._table.counts(stats._collector["GET"])
+    assert stats.get_stats(query)["GET"] == select_counts(counts, query)
+
+
+def test_narrow_queries_copy_only_what_they_return():
+    tracemalloc = pytest.importorskip("tracemalloc")
+    stats = URLHitCollector("url-hits")
+    record_unique(stats, 50000)
+
+    def peak(query):
+        tracemalloc.start()
+        try:
+            stats.get_stats(query)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    assert peak({"prefix": "/items/7", "top": "5"}) < peak(None) / 20
+
+
+def test_keys_marked_during_a_checkpoint_are_reported():
+    stats = URLHitCollector("url-hits")
+    stats.checkpoint(1)
+    # Hold the writer after it counts the hit, but before it marks it.
+    stats._dirty_lock.acquire()
+    t = threading.Thread(target=stats.new_record, args=("GET", "/a"))
+    t.start()
+    while not any(stats._collector.get("GET", ())):
+        t.join(0.001)
+    stats._dirty_lock.release()
+    stats.checkpoint(2)
+    changed = stats.changed_since(1)
+    t.join()
+    stats.checkpoint(3)
+    changed |= stats.changed_since(2)
+    assert changed == {("GET", 0)}
+
+
+def test_collectors_must_merge_and_apply_changes():
+    class Unmergeable(BaseCollector):
+        def new_record(self, method, url, **kwargs):
+            pass
+
+        def reset_stats(self):
+            pass
+
+        def get_stats(self, query=None):
+            return {}
+
+    class Untracked(Unmergeable, TrackedCollector):
+        def merge(self, other):
+            pass
+
+    with pytest.raises(TypeError):
+        Unmergeable("x")
+    with pytest.raises(TypeError):
+        Untracked("x")
+
+
+class Headers(dict):
+    """Stands in for a request's headers, which can be weakly referenced."""
+
+
+def test_buffered_records_keep_only_what_collectors_read():
+    stats = BufferedStatsCollector(
+        "stats", MethodHitCollector("method-hits"),
+        HistogramCollector("histograms"), flush=False, interval=60)
+    headers = Headers(Host="a")
+    ref = weakref.ref(headers)
+    stats.new_record("GET", "/a?x=1", elapsed=0.001, size=10,
+                     headers=headers, query="x=1", body=b"x" * 1000)
+    del headers
+    assert ref() is None
+    record, = stats._ingest.ring.take(1)
+    assert record[:2] == ("GET", "/a?x=1")
+    assert record[3] == (0.001, 10)
+
+
+def test_pending_records_are_added_when_the_stats_are_read():
+    # The consumer waits for a full batch, or a minute.
+    stats = BufferedStatsCollector(
+        "stats", MethodHitCollector("method-hits"), interval=60)
+    for method in ("GET", "POST", "GET"):
+        stats.new_record(method, "/a")
+    assert stats._ingest.get_stats()["pending"] == 3
+    result = stats.get_stats()
+    assert result["method-hits"] == {"GET": 2, "POST": 1}
+    assert result["ingest"]["pending"] == 0
+    assert result["ingest"]["applied"] == 3
+
+
+def test_buffered_stats_match_and_merge():
+    def build():
+        return BufferedStatsCollector(
+            "stats", URLHitCollector("url-hits"),
+            HistogramCollector("histograms"))
+
+    a, b = build(), build()
+    for i in range(100):
+        a.new_record("GET", "/a/{}".format(i % 10), elapsed=0.001, size=i)
+        b.new_record("POST", "/b", elapsed=0.002)
+    # Snapshots from other processes arrive pickled.
+    snapshots = [pickle.loads(pickle.dumps(x.snapshot())) for x in (a, b)]
+    merged = {c.name: c.get_stats() for c in merge_snapshots(snapshots)}
+    assert merged["url-hits"]["GET"]["/a/3"] == 10
+    assert merged["url-hits"]["POST"] == {"/b": 100}
+    assert merged["histograms"]["methods"]["GET"]["size-bytes"]["count"] \
+        == 100
+    assert merged["ingest"]["applied"] == 200
+
+
+def record_routes(c, hits):
+    for url, n in hits:
+        for _ in range(n):
+            c.new_record("GET", url, elapsed=0.001, query="a=1")
+
+
+@pytest.mark.parametrize("cls", [RateCollector, HistogramCollector,
+                                 QueryCollector])
+def test_busiest_routes_are_tracked(cls):
+    c = cls("c", max_routes=2)
+    record_routes(c, [("/a", 1), ("/b", 1), ("/c", 20), ("/d", 10),
+                      ("/e", 1)])
+    routes = c.get_stats()["routes"]
+    assert sorted(routes) == ["<other>", "GET /c", "GET /d"]
+
+
+def test_routes_evicted_into_other_keep_their_counts():
+    c = HistogramCollector("c", max_routes=2)
+    record_routes(c, [("/a", 3), ("/b", 3), ("/c", 20), ("/d", 10)])
+    routes = c.get_stats()["routes"]
+    counts = {k: v["latency-us"]["count"] for k, v in routes.items()}
+    assert sum(counts.values()) == 36
+    # Requests counted before a route got its own histogram stay in
+    # `<other>`.
+    assert counts["GET /c"] + counts["GET /d"] >= 20
+
+
+def test_merged_routes_are_ranked():
+    a = HistogramCollector("c", max_routes=2)
+    b = HistogramCollector("c", max_routes=2)
+    record_routes(a, [("/a", 5), ("/b", 4)])
+    record_routes(b, [("/c", 30), ("/d", 20)])
+    a.merge(pickle.loads(pickle.dumps(b)))
+    routes = a.get_stats()["routes"]
+    counts = {k: v["latency-us"]["count"] for k, v in routes.items()}
+    assert counts == {"GET /c": 30, "GET /d": 20, "<other>": 9}
+
+
+def zipf_stream(n, keys, seed):
+    rnd = random.Random(seed)
+    weights = [1.0 / (i + 1) for i in range(keys)]
+    return rnd.choices(["k{}".format(i) for i in range(keys)], weights, k=n)
+
+
+def test_space_saving_bounds_hold_after_merge():
+    streams = [zipf_stream(5000, 500, seed) for seed in (1, 2, 3)]
+    merged = SpaceSaving(50)
+    for stream in streams:
+        summary = SpaceSaving(50)
+        for key in stream:
+            summary.add(key)
+        merged.merge(pickle.loads(pickle.dumps(summary)))
+    true = {}
+    for key in sum(streams, []):
+        true[key] = true.get(key, 0) + 1
+    items = merged.items()
+    assert len(items) == 50
+    for key, count, error in items:
+        assert count - error <= true[key] <= count
+    # Keys above N/capacity are guaranteed to be tracked, and ranked.
+    tracked = {key for key, _, _ in items}
+    assert {k for k, n in true.items() if n > 15000 / 50} <= tracked
+    assert items[0][0] == "k0"
+
+
+def test_space_saving_merge_of_disjoint_summaries():
+    a, b = SpaceSaving(2), SpaceSaving(2)
+    for key, n in [("a", 5), ("b", 3), ("c", 1)]:
+        a.add(key, n)
+    b.add("d", 4)
+    a.merge(b)
+    # "d" may have been counted among the 4 "a" saw for its floor.
+    assert a.items() == [("d", 8, 4), ("a", 5, 0)]
+
+
+def test_count_min_merge_never_underestimates():
+    a, b = CountMinSketch(width=64, depth=4), CountMinSketch(width=64,
+                                                            depth=4)
+    stream = zipf_stream(4000, 300, 4)
+    true = {}
+    for i, key in enumerate(stream):
+        (a if i % 2 else b).add(key)
+        true[key] = true.get(key, 0) + 1
+    a.merge(pickle.loads(pickle.dumps(b)))
+    assert a.total == len(stream)
+    for key, n in true.items():
+        assert n <= a.estimate(key)
+    over = [a.estimate(k) - n for k, n in true.items()]
+    assert sum(e > a.error_bound() for e in over) < len(over) * 0.05
+
+
+def test_hyperloglog_merge_is_a_union():
+    a, b = HyperLogLog(12), HyperLogLog(12)
+    for i in range(20000):
+        a.add("a{}".format(i))
+        b.add("a{}".format(i + 10000))
+    both = pickle.loads(pickle.dumps(a))
+    both.merge(b)
+    for hll, n in [(a, 20000), (b, 20000), (both, 30000)]:
+        # Four standard errors of 1.04/sqrt(4096).
+        assert abs(hll.estimate() - n) < n * 0.065, (hll.estimate(), n)
+    small = HyperLogLog(12)
+    for i in range(100):
+        small.add(str(i))
+    small.merge(small)
+    assert abs(small.estimate() - 100) <= 3
+
+
+def test_histogram_percentiles_are_within_its_precision():
+    h = LogLinearHistogram(sub_bits=6)
+    values = list(range(1, 100001))
+    random.Random(5).shuffle(values)
+    for v in values:
+        h.add(v)
+    p50, p90, p99, p999, p100 = h.percentiles(50, 90, 99, 99.9, 100)
+    for got, want in [(p50, 50000), (p90, 90000), (p99, 99000),
+                      (p999, 99900)]:
+        # Each bucket spans under 2^(1 - sub_bits) of its values.
+        assert want <= got <= want * (1 + 2.0 ** -5), (got, want)
+    assert p100 == h.max == 100000
+    assert h.summary()["count"] == 100000
+
+
+def test_histogram_small_values_are_exact_and_merge():
+    a, b = LogLinearHistogram(), LogLinearHistogram()
+    for v in range(64):
+        a.add(v)
+    b.add(1 << 50)
+    assert a.percentiles(1, 50, 100) == [0, 31, 63]
+    a.merge(pickle.loads(pickle.dumps(b)))
+    assert a.count == 65 and a.max == 1 << 50
+    # Values beyond 2^max_bits land in the last bucket, capped at max.
+    assert a.percentiles(100) == [1 << 50]
+    assert LogLinearHistogram().summary() == {
+        "count": 0, "max": 0, "p50": 0, "p90": 0, "p99": 0, "p999": 0}
+
+
+def test_histogram_collector_quantiles():
+    c = HistogramCollector("c")
+    for ms in range(1, 101):
+        c.new_record("GET", "/a", elapsed=ms / 1000.0, size=ms)
+    latency = c.get_stats()["methods"]["GET"]["latency-us"]
+    assert latency["count"] == 100
+    assert 50000 <= latency["p50"] <= 50000 * (1 + 2.0 ** -5)
+    assert 99000 <= latency["p99"] <= 99000 * (1 + 2.0 ** -5)
+    assert latency["max"] == 100000